@@ -56,7 +56,8 @@ class ShaderTerrainDemo(ShowBase):
                            2149, 1445, zoom=12)
         """
         self.mzen = Mapzen(self.camera, self.loader, self.render, taskMgr,
-                           773, 1607, zoom=12)
+                           773, 1607, zoom=12, rebase_distance=20000.0,
+                           snapshot="mapzen/rsc/snapshot")
         base.finalExitCallbacks.append(self.exit)
         base.exitFunc = self.exit
 
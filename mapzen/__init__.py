@@ -17,4 +17,4 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
 
-from .mapzen import Mapzen
+from .mapzen import Mapzen, REBASE_EVENT
@@ -0,0 +1,702 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import time
+import json
+import hashlib
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Windows, the statistics file is not locked
+    fcntl = None
+from distutils.dir_util import mkpath
+from .region import tile_range
+
+
+# Each cached file has a companion file with its size and checksum, written
+# after the file itself, such that a cached file without it (or not matching
+# it) is an unfinished or corrupted one
+SUM_EXT = '.sum'
+TMP_EXT = '.tmp'
+# Freshness metadata of the downloaded files: HTTP validators and fetch time
+META_EXT = '.meta'
+# Spatial index of the vector tiles, see spatial.FeatureIndex
+INDEX_EXT = '.idx.npz'
+# Companion files, removed along the cached file
+COMPANION_EXTS = (SUM_EXT, META_EXT, INDEX_EXT)
+# Cache usage statistics, shared by all the processes
+STATS_FILE = 'stats.json'
+# Lock file of the statistics read-merge-write
+STATS_LOCK = STATS_FILE + '.lock'
+POLICIES = ('lru', 'lfu')
+# Permissions of the cached files. mkstemp creates them readable just by the
+# owner, so the process umask is applied instead, as open() does. The umask
+# can only be read by setting it, so it is done once, before any thread starts
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+def checksum(path):
+    """ Compute the MD5 checksum of a file
+
+    Position arguments:
+    path -- File path
+
+    Returned value:
+    Hexadecimal checksum
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _replace(src, dst):
+    """ Atomically rename a file, overwriting the destination
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows is not allowing to overwrite files on rename
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def _write_atomic(path, writer):
+    """ Write a file in a temporal file of the same folder, renaming it when
+    it is done, such that the final path never holds a partial file
+
+    Position arguments:
+    path -- Final file path
+    writer -- Function writing the file, receiving the temporal path
+    """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        mkpath(folder)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix=os.path.basename(path),
+                               suffix=TMP_EXT)
+    os.close(fd)
+    try:
+        writer(tmp)
+        os.chmod(tmp, FILE_MODE)
+        _replace(tmp, path)
+    except:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+
+
+def record(path):
+    """ Store the size and checksum of a cached file
+
+    Position arguments:
+    path -- Cached file path
+    """
+    entry = '{} {}\n'.format(os.path.getsize(path), checksum(path))
+
+    def write_entry(tmp):
+        with open(tmp, 'w') as f:
+            f.write(entry)
+    _write_atomic(path + SUM_EXT, write_entry)
+
+
+def save(path, writer):
+    """ Crash safe save of a file in the cache
+
+    Position arguments:
+    path -- File path
+    writer -- Function writing the file, receiving the path where it should be
+              written. e.g. lambda fname: pic.save(fname, format='PNG')
+    """
+    _write_atomic(path, writer)
+    record(path)
+
+
+def write(path, data):
+    """ Crash safe save of a file in the cache. See save()
+
+    Position arguments:
+    path -- File path
+    data -- File content
+    """
+    def write_data(tmp):
+        with open(tmp, 'wb') as f:
+            f.write(data)
+    save(path, write_data)
+
+
+def read_meta(path):
+    """ Get the freshness metadata of a cached file
+
+    Position arguments:
+    path -- Cached file path
+
+    Returned value:
+    Dictionary with the 'etag' and 'last_modified' HTTP validators (None if
+    the server did not provide them), and the 'fetched' time. Files without
+    metadata are considered fetched when they were written
+    """
+    try:
+        with open(path + META_EXT, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        fetched = os.path.getmtime(path)
+    except OSError:
+        fetched = 0.0
+    return {'etag': None, 'last_modified': None, 'fetched': fetched}
+
+
+def write_meta(path, etag=None, last_modified=None):
+    """ Store the freshness metadata of a file just fetched (or revalidated)
+
+    Position arguments:
+    path -- Cached file path
+
+    Keyword arguments:
+    etag -- ETag HTTP header
+    last_modified -- Last-Modified HTTP header
+    """
+    data = json.dumps({'etag': etag, 'last_modified': last_modified,
+                       'fetched': time.time()})
+
+    def write_data(tmp):
+        with open(tmp, 'w') as f:
+            f.write(data)
+    _write_atomic(path + META_EXT, write_data)
+
+
+def is_fresh(path, ttl=None):
+    """ Check if a cached file is still fresh
+
+    Position arguments:
+    path -- Cached file path
+
+    Keyword arguments:
+    ttl -- Time to live, in seconds. None if the file never expires
+
+    Returned value:
+    True if the file has been fetched (or revalidated) in the last ttl
+    seconds, False otherwise
+    """
+    if ttl is None:
+        return True
+    return time.time() - read_meta(path)['fetched'] < ttl
+
+
+def read_record(path):
+    """ Get the size and checksum record of a cached file
+
+    Position arguments:
+    path -- Cached file path
+
+    Returned value:
+    Size and checksum, None if the file has not a record
+    """
+    try:
+        with open(path + SUM_EXT, 'r') as f:
+            size, md5 = f.read().split()
+    except (IOError, OSError, ValueError):
+        return None
+    return int(size), md5
+
+
+def check(path, full=False):
+    """ Check the integrity of a cached file
+
+    Position arguments:
+    path -- File path
+
+    Keyword arguments:
+    full -- True to compare the checksum, False to just compare the size
+
+    Returned value:
+    True if the file is valid, False if it is missing or corrupted, None if
+    the file exists but it has not a size and checksum record (e.g. it was
+    cached by an old version)
+    """
+    if not os.path.isfile(path):
+        return False
+    try:
+        with open(path + SUM_EXT, 'r') as f:
+            size, md5 = f.read().split()
+    except (IOError, OSError):
+        return None
+    except ValueError:
+        return False
+    if os.path.getsize(path) != int(size):
+        return False
+    if full and checksum(path) != md5:
+        return False
+    return True
+
+
+def is_cached(path, validate=None, full=False):
+    """ Check if a file is validly cached. Files without a size and checksum
+    record are validated with the provided function, recording them if they
+    are valid
+
+    Position arguments:
+    path -- File path
+
+    Keyword arguments:
+    validate -- Function receiving the path, and returning True if the file is
+                valid. None to consider as invalid the files not recorded
+    full -- True to compare the checksum, False to just compare the size
+
+    Returned value:
+    True if the file is cached and valid, False otherwise
+    """
+    valid = check(path, full)
+    if valid is None:
+        valid = False
+        if validate is not None:
+            try:
+                valid = validate(path)
+            except Exception:
+                valid = False
+            if valid:
+                record(path)
+    return valid
+
+
+def remove(path):
+    """ Remove a cached file, its record, its metadata and its index
+    """
+    for fname in (path,) + tuple(path + ext for ext in COMPANION_EXTS):
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+
+def verify(root, full=False, fix=False):
+    """ Scan the cache looking for corrupted files
+
+    Position arguments:
+    root -- Cache folder
+
+    Keyword arguments:
+    full -- True to compare the checksums, False to just compare the sizes
+    fix -- True to remove the corrupted files (so they are downloaded again
+           the next time they are required) and the unfinished temporal files
+
+    Returned value:
+    Number of checked files, list of corrupted files, list of files without
+    record, list of unfinished temporal files
+    """
+    n = 0
+    corrupted = []
+    unrecorded = []
+    unfinished = []
+    for folder, _, fnames in os.walk(root):
+        for fname in fnames:
+            path = os.path.join(folder, fname)
+            if folder == root.rstrip(os.sep) and \
+                    fname in (STATS_FILE, STATS_LOCK):
+                continue
+            if fname.endswith(TMP_EXT):
+                unfinished.append(path)
+                continue
+            ext = [e for e in COMPANION_EXTS if fname.endswith(e)]
+            if ext:
+                if not os.path.isfile(path[:-len(ext[0])]):
+                    unfinished.append(path)
+                continue
+            n += 1
+            valid = check(path, full)
+            if valid is None:
+                unrecorded.append(path)
+            elif not valid:
+                corrupted.append(path)
+    if fix:
+        for path in corrupted:
+            remove(path)
+        for path in unfinished:
+            os.remove(path)
+    return n, corrupted, unrecorded, unfinished
+
+
+def parse_path(path, root):
+    """ Get the layer and the tile of a cached file
+
+    Position arguments:
+    path -- Cached file path
+    root -- Cache folder
+
+    Returned value:
+    Layer name and tile (tilex, tiley, zoom). None if the path is not a tile
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    if len(parts) < 4:
+        return None
+    try:
+        tile = (int(parts[-2]), int(os.path.splitext(parts[-1])[0]),
+                int(parts[-3]))
+    except ValueError:
+        return None
+    return parts[0], tile
+
+
+class CacheManager(object):
+    def __init__(self, root, quotas=None, policy='lru', batch=256):
+        """Cache size manager. A byte quota can be set for each layer, such
+        that the files are evicted, least recently used (LRU) or least
+        frequently used (LFU) first, when it is exceeded. The cache is
+        scanned and evicted incrementally, a batch of files per step, such
+        that it can be executed in background without disturbing the flight.
+
+        The last access time of each file is recorded as the modification
+        time of its size and checksum record, so it is shared by all the
+        processes using the cache.
+
+        Position arguments:
+        root -- Cache folder
+
+        Keyword arguments:
+        quotas -- Dictionary with the maximum number of bytes of each layer.
+                  The layers not included are never evicted
+        policy -- Eviction policy, 'lru' or 'lfu'
+        batch -- Number of files scanned or evicted per step
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy {}'.format(policy))
+        self.root = root
+        self.quotas = quotas or {}
+        self.policy = policy
+        self.batch = batch
+        self.__pinned = []
+        self.__lock = threading.Lock()
+        # path -> [layer, zoom, size, last access time]
+        self.__index = {}
+        self.__scan = None
+        self.__scanned = False
+        # Usage counters not flushed yet to the statistics file
+        self.__hits = {}
+        self.__misses = {}
+        self.__counts = {}
+        # Evicted files, whose counts are removed from the statistics file
+        self.__evicted = set()
+        # Files found in the last whole scan, to remove the counts of the
+        # missing ones in the next flush
+        self.__found = None
+        # layer -> files sorted by eviction priority, the first to evict at
+        # the end, as [access time when sorted, path]
+        self.__queues = {}
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def pin(self, bbox, zooms=None):
+        """ Protect a region, such that its tiles are never evicted
+
+        Position arguments:
+        bbox -- Bounding box, (lat_min, lon_min, lat_max, lon_max)
+
+        Keyword arguments:
+        zooms -- List of zoom levels. None for all of them
+        """
+        self.__pinned.append((bbox, None if zooms is None else set(zooms)))
+
+    def pinned(self, tile):
+        """ Check if a tile is inside a pinned region
+
+        Position arguments:
+        tile -- Tuple of 3 values, tilex, tiley and zoom
+
+        Returned value:
+        True if the tile should not be evicted, False otherwise
+        """
+        for bbox, zooms in self.__pinned:
+            if zooms is not None and tile[2] not in zooms:
+                continue
+            txmin, txmax, tymin, tymax = tile_range(bbox, tile[2])
+            if txmin <= tile[0] <= txmax and tymin <= tile[1] <= tymax:
+                return True
+        return False
+
+    def access(self, path, hit):
+        """ Record an access to a cached file
+
+        Position arguments:
+        path -- Cached file path
+        hit -- True if the file was already cached, False if it has been
+               downloaded
+        """
+        parsed = parse_path(path, self.root)
+        if parsed is None:
+            return
+        layer, tile = parsed
+        now = time.time()
+        try:
+            os.utime(path + SUM_EXT, (now, now))
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.__lock.acquire()
+        counters = self.__hits if hit else self.__misses
+        counters[layer] = counters.get(layer, 0) + 1
+        key = os.path.relpath(path, self.root)
+        self.__counts[key] = self.__counts.get(key, 0) + 1
+        if self.__scanned or path in self.__index:
+            self.__index[path] = [layer, tile[2], size, now]
+        self.__lock.release()
+
+    def __read_stats(self):
+        try:
+            with open(os.path.join(self.root, STATS_FILE), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'hits': {}, 'misses': {}, 'counts': {}}
+
+    def __lock_stats(self):
+        """ Lock the statistics file among the processes
+
+        Returned value:
+        Lock file, to be passed to __unlock_stats()
+        """
+        if fcntl is None:
+            return None
+        if not os.path.isdir(self.root):
+            mkpath(self.root)
+        f = open(os.path.join(self.root, STATS_LOCK), 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def __unlock_stats(self, f):
+        if f is None:
+            return
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    def flush(self):
+        """ Merge the usage counters into the shared statistics file. The
+        counts of the evicted files are removed, and also the ones of the
+        files not found in the last whole scan of the cache
+        """
+        self.__lock.acquire()
+        hits, self.__hits = self.__hits, {}
+        misses, self.__misses = self.__misses, {}
+        counts, self.__counts = self.__counts, {}
+        evicted, self.__evicted = self.__evicted, set()
+        found, self.__found = self.__found, None
+        self.__lock.release()
+        if not (hits or misses or counts or evicted or found):
+            return
+        lock = self.__lock_stats()
+        try:
+            stats = self.__read_stats()
+            for name, delta in (('hits', hits), ('misses', misses),
+                                ('counts', counts)):
+                for k, v in delta.items():
+                    stats[name][k] = stats[name].get(k, 0) + v
+            for k in list(stats['counts'].keys()):
+                if k in evicted and k not in counts:
+                    del stats['counts'][k]
+                elif found is not None and k not in found and \
+                        not os.path.isfile(os.path.join(self.root, k)):
+                    del stats['counts'][k]
+            path = os.path.join(self.root, STATS_FILE)
+            data = json.dumps(stats)
+
+            def write_stats(tmp):
+                with open(tmp, 'w') as f:
+                    f.write(data)
+            _write_atomic(path, write_stats)
+        finally:
+            self.__unlock_stats(lock)
+
+    def __walk(self):
+        for folder, _, fnames in os.walk(self.root):
+            for fname in fnames:
+                if any(fname.endswith(ext)
+                       for ext in COMPANION_EXTS + (TMP_EXT,)):
+                    continue
+                yield os.path.join(folder, fname)
+
+    def __scan_step(self):
+        """ Scan a batch of files, restarting the scan when it is finished
+
+        Returned value:
+        True if a whole scan has been completed
+        """
+        if self.__scan is None:
+            self.__scan = self.__walk()
+        for _ in range(self.batch):
+            try:
+                path = next(self.__scan)
+            except StopIteration:
+                self.__scan = None
+                self.__scanned = True
+                self.__lock.acquire()
+                self.__found = set(os.path.relpath(p, self.root)
+                                   for p in self.__index)
+                self.__lock.release()
+                return True
+            parsed = parse_path(path, self.root)
+            if parsed is None:
+                continue
+            try:
+                size = os.path.getsize(path)
+                atime = os.path.getmtime(path + SUM_EXT)
+            except OSError:
+                atime = 0.0
+            self.__lock.acquire()
+            self.__index[path] = [parsed[0], parsed[1][2], size, atime]
+            self.__lock.release()
+        return False
+
+    def __queue(self, layer, entries):
+        """ Sort the files of a layer by eviction priority, just once, such
+        that the next steps keep evicting from it
+        """
+        if self.policy == 'lfu':
+            counts = self.__read_stats()['counts']
+            key = lambda pe: (counts.get(os.path.relpath(pe[0], self.root), 0),
+                              pe[1][3])
+        else:
+            key = lambda pe: pe[1][3]
+        entries.sort(key=key, reverse=True)
+        return [[e[3], path] for path, e in entries]
+
+    def __evict_step(self):
+        """ Evict a batch of files of the layers exceeding their quota
+
+        Returned value:
+        Number of evicted files
+        """
+        evicted = 0
+        for layer, quota in self.quotas.items():
+            self.__lock.acquire()
+            entries = [(path, e) for path, e in self.__index.items()
+                       if e[0] == layer]
+            self.__lock.release()
+            used = sum(e[2] for _, e in entries)
+            if used <= quota:
+                self.__queues.pop(layer, None)
+                continue
+            queue = self.__queues.get(layer)
+            if not queue:
+                queue = self.__queues[layer] = self.__queue(layer, entries)
+            while queue and used > quota and evicted < self.batch:
+                atime, path = queue.pop()
+                self.__lock.acquire()
+                e = self.__index.get(path)
+                self.__lock.release()
+                # Removed, or accessed after sorting the queue
+                if e is None or e[3] != atime:
+                    continue
+                if self.pinned(parse_path(path, self.root)[1]):
+                    continue
+                remove(path)
+                used -= e[2]
+                evicted += 1
+                self.__lock.acquire()
+                self.__index.pop(path, None)
+                self.__evicted.add(os.path.relpath(path, self.root))
+                self.__lock.release()
+        return evicted
+
+    def step(self):
+        """ Carry out an incremental scan and eviction step. The eviction
+        starts after the first whole scan of the cache
+
+        Returned value:
+        Number of evicted files
+        """
+        self.__scan_step()
+        if not self.__scanned:
+            return 0
+        return self.__evict_step()
+
+    def stats(self):
+        """ Compute the cache statistics, scanning it completely
+
+        Returned value:
+        Dictionary with the size, the number of files per zoom level, and the
+        hit ratio of each layer
+        """
+        while not self.__scan_step():
+            pass
+        shared = self.__read_stats()
+        stats = {}
+        self.__lock.acquire()
+        for layer, zoom, size, _ in self.__index.values():
+            s = stats.setdefault(layer, {'bytes': 0, 'zooms': {}})
+            s['bytes'] += size
+            s['zooms'][zoom] = s['zooms'].get(zoom, 0) + 1
+        self.__lock.release()
+        for layer, s in stats.items():
+            hits = shared['hits'].get(layer, 0) + self.__hits.get(layer, 0)
+            misses = shared['misses'].get(layer, 0) + \
+                self.__misses.get(layer, 0)
+            s['hit_ratio'] = hits / float(max(hits + misses, 1))
+        return stats
+
+    def __run(self, interval):
+        while not self.__stop.wait(interval):
+            self.step()
+            self.flush()
+
+    def start(self, interval=5.0):
+        """ Execute the incremental steps in a background thread
+
+        Keyword arguments:
+        interval -- Time between steps, in seconds
+        """
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(interval,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+
+if __name__ == "__main__":
+    # Call this script with the following commands:
+    # python -m mapzen.cache verify [--full] [--fix]
+    # python -m mapzen.cache stats
+    # where:
+    # --full compares the checksums, instead of just the sizes
+    # --fix removes the corrupted and unfinished files
+    from .download import CACHE_PATH
+    if len(sys.argv) < 2 or sys.argv[1] not in ('verify', 'stats'):
+        raise ValueError('Unknown command')
+    if sys.argv[1] == 'stats':
+        stats = CacheManager(CACHE_PATH).stats()
+        for layer in sorted(stats.keys()):
+            s = stats[layer]
+            print("{}: {:.1f} MB, hit ratio {:.2f}".format(
+                layer, s['bytes'] / 1048576.0, s['hit_ratio']))
+            for zoom in sorted(s['zooms'].keys()):
+                print("    zoom {}: {} files".format(zoom, s['zooms'][zoom]))
+        sys.exit()
+    n, corrupted, unrecorded, unfinished = verify(
+        CACHE_PATH, full='--full' in sys.argv, fix='--fix' in sys.argv)
+    for path in corrupted:
+        print("Corrupted: {}".format(path))
+    for path in unfinished:
+        print("Unfinished: {}".format(path))
+    print("{} files, {} corrupted, {} not recorded, {} unfinished".format(
+        n, len(corrupted), len(unrecorded), len(unfinished)))
@@ -19,22 +19,419 @@
 
 import sys
 import os.path
-from distutils.dir_util import mkpath
+import time
+import threading
+import itertools
+from collections import OrderedDict
 import numpy as np
 from PIL import Image
 import json
-import urllib2
 import StringIO
+from . import cache
+from . import sources
+from .region import region_tiles, count_tiles
 
 
 CACHE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                           "rsc/cache/")
-ELEVATION_URL = "https://terrain-preview.mapzen.com/"
-LANDCOVER_URL = "http://a.tile.stamen.com/"
-VECTOR_URL = "http://vector.mapzen.com/"
+# Maximum number of zoom levels to go up looking for a cached ancestor
+UPSAMPLE_LEVELS = 4
+LAYERS = ('terrarium', 'terrain-background', 'osm')
+# Approximated size of each tile, in bytes, for the seeding estimations
+TILE_BYTES = {'terrarium': 110000, 'terrain-background': 40000, 'osm': 60000}
+# Number of tiles downloaded in parallel between seeding manifest updates
+SEED_CHUNK = 64
+# Time to live of the cached tiles of each layer, in seconds. The expired
+# tiles are used anyway, but revalidated in background. None to never expire
+TTL = {'terrarium': None, 'terrain-background': None, 'osm': None}
+# cache.CacheManager notified of the cached tiles accesses, None to disable it
+CACHE_MANAGER = None
+# trace.TraceRecorder where the tile requests are recorded, None to disable it
+TRACE = None
+# Number of downloaded tiles remembered until they are read, such that their
+# first read is not traced as a hit
+TRACED_DOWNLOADS = 1024
 
+# Traced downloads in flight, and downloaded tiles not read yet
+_traced = {}
+_downloaded = OrderedDict()
+_traced_lock = threading.Lock()
 
-def elevation(tile, force=False):
+
+def _key(tile):
+    return (int(tile[2]), int(tile[0]), int(tile[1]))
+
+
+def _save_image(img, img_file, convert=None):
+    """ Validate a downloaded image and save it in the cache. This is
+    executed in the fetcher workers, so the concurrent requests of the same
+    tile are sharing it
+
+    Position arguments:
+    img -- Downloaded image data
+    img_file -- Cache file path
+
+    Keyword arguments:
+    convert -- Function to edit the image before saving it
+
+    Returned value:
+    PIL image
+    """
+    pic = Image.open(StringIO.StringIO(img))
+    # Check that it is a valid image
+    pic.verify()
+    pic = Image.open(StringIO.StringIO(img))
+    if convert is not None:
+        pic = convert(pic)
+    # Save it
+    cache.save(img_file, lambda fname: pic.save(fname, format='PNG'))
+    pic.load()
+    return pic
+
+
+def _save_json(json_txt, json_file):
+    """ Parse a downloaded JSON and save it in the cache. See _save_image()
+    """
+    data = json.load(StringIO.StringIO(json_txt))
+    # Save it
+    cache.write(json_file, json.dumps(data))
+    return data
+
+
+def _fetcher(layer):
+    return sources.get(layer).fetcher
+
+
+def _accessed(layer, tile, path, hit, t0, approximated=False):
+    """ Notify the cache manager and the trace recorder, if any, of a tile
+    request started at t0. The misses are traced by _download(), when the
+    tiles arrive, so just the hits are traced here, except the first read of
+    a downloaded tile. The requests answered with an approximation are not
+    reading the downloaded tile yet
+    """
+    if CACHE_MANAGER is not None:
+        CACHE_MANAGER.access(path, hit)
+    if TRACE is None or approximated:
+        return
+    key = (layer,) + _key(tile)
+    _traced_lock.acquire()
+    downloaded = _downloaded.pop(key, None) is not None
+    if key in _traced:
+        # The download has finished, but it has not been traced yet
+        _traced[key][1] = True
+        downloaded = True
+    _traced_lock.release()
+    if downloaded or not hit:
+        return
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    TRACE.record(t0, layer, tile, hit, time.time() - t0, size)
+
+
+def _download(layer, tile, url, process):
+    """ Start downloading a tile, tracing it as a miss when it arrives (or
+    fails), with the download latency
+
+    Position arguments:
+    layer -- 'terrarium', 'terrain-background' or 'osm'
+    tile -- Tuple of 3 values, tilex, tiley and zoom (<= 15)
+    url -- URL of the tile
+    process -- Function to process the downloaded tile, see _request()
+
+    Returned value:
+    Future of the download
+    """
+    key = (layer,) + _key(tile)
+    future = _fetcher(layer).submit(key, url, process)
+    trace = TRACE
+    if trace is None:
+        return future
+    _traced_lock.acquire()
+    if key in _traced and _traced[key][0] is future:
+        # Already traced, it is a request joining the download in flight
+        _traced_lock.release()
+        return future
+    # The future, and whether the tile has been already read
+    _traced[key] = [future, False]
+    _traced_lock.release()
+    t0 = time.time()
+
+    def done(f):
+        _traced_lock.acquire()
+        read = False
+        if key in _traced and _traced[key][0] is f:
+            read = _traced.pop(key)[1]
+        if f.exception() is None and not read:
+            _downloaded[key] = True
+            while len(_downloaded) > TRACED_DOWNLOADS:
+                _downloaded.popitem(last=False)
+        _traced_lock.release()
+        size = 0
+        if f.exception() is None:
+            try:
+                size = os.path.getsize(_request(layer, tile)[0])
+            except OSError:
+                pass
+        trace.record(t0, layer, tile, False, time.time() - t0, size)
+    future.add_done_callback(done)
+    return future
+
+
+def _valid_image(img_file):
+    """ Check that a cached image can be decoded
+    """
+    Image.open(img_file).load()
+    return True
+
+
+def _valid_json(json_file):
+    """ Check that a cached JSON file can be parsed
+    """
+    with open(json_file, 'r') as data_file:
+        json.load(data_file)
+    return True
+
+
+def _hue(pic):
+    """ Convert to HSV and remove Saturation and Value (we are interested
+    just in Hue)
+    """
+    hsv = pic.convert('HSV')
+    pix = np.array(hsv)
+    # pix[:,:,1] = 100
+    pix[:,:,2] = 255
+    hsv = Image.fromarray(pix, mode='HSV')
+    return hsv.convert('RGB')
+
+
+def _load_image(img_file):
+    pic = Image.open(img_file)
+    pic.load()
+    return pic
+
+
+def _load_json(json_file):
+    with open(json_file, 'r') as data_file:
+        return json.load(data_file)
+
+
+def _request(layer, tile):
+    """ Get the cache file, the URL, the downloaded data processing function,
+    and the cached file validation function of a tile layer
+
+    Position arguments:
+    layer -- 'terrarium', 'terrain-background' or 'osm'
+    tile -- Tuple of 3 values, tilex, tiley and zoom (<= 15)
+    """
+    if layer == 'terrarium':
+        fname = "terrarium/{}/{}/{}.png".format(*_key(tile))
+        save = lambda img: _save_image(img, CACHE_PATH + fname)
+        load, valid = _load_image, _valid_image
+    elif layer == 'terrain-background':
+        fname = "terrain-background/{}/{}/{}.png".format(*_key(tile))
+        save = lambda img: _save_image(img, CACHE_PATH + fname, _hue)
+        load, valid = _load_image, _valid_image
+    elif layer == 'osm':
+        fname = "osm/all/{}/{}/{}.json".format(*_key(tile))
+        save = lambda json_txt: _save_json(json_txt, CACHE_PATH + fname)
+        load, valid = _load_json, _valid_json
+    else:
+        raise ValueError('Unknown layer {}'.format(layer))
+    path = CACHE_PATH + fname
+    url = sources.get(layer).url(tile)
+
+    def process(data, info):
+        # On 304 (Not Modified) the cached file is still good
+        result = load(path) if data is None else save(data)
+        cache.write_meta(path, info['etag'], info['last_modified'])
+        return result
+    return path, url, process, valid
+
+
+def _stale(layer, path):
+    """ Check if a cached tile has exceeded its layer time to live
+    """
+    return not cache.is_fresh(path, TTL.get(layer))
+
+
+def _revalidate(layer, tile):
+    """ Start a conditional download of a cached tile, such that it is
+    transferred only if it has changed in the server
+
+    Position arguments:
+    layer -- 'terrarium', 'terrain-background' or 'osm'
+    tile -- Tuple of 3 values, tilex, tiley and zoom (<= 15)
+
+    Returned value:
+    Future of the download
+    """
+    path, url, process, _ = _request(layer, tile)
+    meta = cache.read_meta(path)
+    headers = {}
+    if meta['etag']:
+        headers['If-None-Match'] = meta['etag']
+    if meta['last_modified']:
+        headers['If-Modified-Since'] = meta['last_modified']
+    return _fetcher(layer).submit((layer,) + _key(tile), url, process,
+                                  headers)
+
+
+def prefetch(tiles, force=False, layers=('terrarium', 'terrain-background'),
+             refresh=False):
+    """ Start downloading, in parallel, the elevation and landcover of the
+    tiles not already available in the cache, without waiting for them. The
+    later calls to elevation() and landcover() are waiting for the in-flight
+    downloads, instead of starting new ones. The cached tiles exceeding their
+    time to live are revalidated in background
+
+    Position arguments:
+    tiles -- List of tiles, each one a tuple of 3 values, tilex, tiley and zoom
+
+    Keyword arguments:
+    force -- True if the images should be downloaded even though they are
+             already available in the cache
+    layers -- Layers to download
+    refresh -- True to revalidate all the cached tiles, downloading just the
+               ones changed in the server
+
+    Returned value:
+    Dictionary of futures of the started downloads (and revalidations, if
+    refresh is True), with (layer, zoom, tilex, tiley) keys
+    """
+    futures = {}
+    for tile in tiles:
+        for layer in layers:
+            path, url, process, valid = _request(layer, tile)
+            key = (layer,) + _key(tile)
+            if force or not cache.is_cached(path, valid):
+                futures[key] = _download(layer, tile, url, process)
+            elif refresh:
+                futures[key] = _revalidate(layer, tile)
+            elif _stale(layer, path):
+                # The cached one is good enough meanwhile
+                _revalidate(layer, tile)
+    return futures
+
+
+def decode_elevation(pic):
+    """ Decode the elevation of a terrarium image
+
+    Position arguments:
+    pic -- PIL terrarium image
+
+    Returned value:
+    Numpy array of elevations per pixel
+    """
+    pix = np.asarray(pic.convert('RGB'), dtype=np.float)
+    elevation = (pix[:,:,0] * 256 + pix[:,:,1] + pix[:,:,2] / 256) - 32768
+    return elevation
+
+
+def encode_elevation(elevation):
+    """ Encode the elevation as a terrarium image
+
+    Position arguments:
+    elevation -- Numpy array of elevations per pixel
+
+    Returned value:
+    PIL terrarium image
+    """
+    v = np.clip(elevation + 32768.0, 0.0, 65535.0 + 255.0 / 256.0)
+    pix = np.empty(v.shape + (3,), dtype=np.uint8)
+    pix[:,:,0] = np.floor(v / 256)
+    pix[:,:,1] = np.floor(v) % 256
+    pix[:,:,2] = np.minimum(np.round((v - np.floor(v)) * 256), 255)
+    return Image.fromarray(pix, mode='RGB')
+
+
+def _upsample(data, factor):
+    """ Bilinear upsampling of an image
+
+    Position arguments:
+    data -- Image, with the pixels in the first 2 dimensions
+    factor -- Integer upsampling factor
+
+    Returned value:
+    Upsampled image
+    """
+    dtype = data.dtype
+    data = data.astype(np.float)
+    for axis in (0, 1):
+        n = data.shape[axis]
+        # Pixel centers of the upsampled image, in the original pixels
+        x = np.clip((np.arange(n * factor) + 0.5) / factor - 0.5, 0, n - 1)
+        i0 = np.floor(x).astype(np.int)
+        i1 = np.minimum(i0 + 1, n - 1)
+        w = (x - i0).reshape((-1,) + (1,) * (data.ndim - 1))
+        data = np.swapaxes(data, 0, axis)
+        data = data[i0] * (1.0 - w) + data[i1] * w
+        data = np.swapaxes(data, 0, axis)
+    if dtype != data.dtype:
+        data = np.round(data).astype(dtype)
+    return data
+
+
+def upsampled(tile, layer, max_levels=UPSAMPLE_LEVELS):
+    """ Approximate a tile by upsampling the nearest ancestor available in
+    the cache. Nothing is downloaded
+
+    Position arguments:
+    tile -- Tuple of 3 values, tilex, tiley and zoom (<= 15)
+    layer -- 'terrarium' or 'terrain-background'
+
+    Keyword arguments:
+    max_levels -- Maximum number of zoom levels to go up
+
+    Returned value:
+    Numpy array of elevations per pixel (terrarium) or RGB image content
+    (terrain-background). None if there is no cached ancestor
+    """
+    tx, ty, zoom = int(tile[0]), int(tile[1]), int(tile[2])
+    for k in range(1, min(max_levels, zoom) + 1):
+        img_file = CACHE_PATH + layer + "/{}/{}/{}.png".format(
+            zoom - k, tx >> k, ty >> k)
+        if not cache.is_cached(img_file, _valid_image):
+            continue
+        pic = Image.open(img_file)
+        if layer == 'terrarium':
+            data = decode_elevation(pic)
+        else:
+            data = np.array(pic)
+        # Crop the region covered by the tile, and upsample it back
+        n = data.shape[0] >> k
+        i = (ty & ((1 << k) - 1)) * n
+        j = (tx & ((1 << k) - 1)) * n
+        return _upsample(data[i:i + n, j:j + n], 1 << k)
+    return None
+
+
+def _approximate(tile, layer, url, process, callback):
+    """ Approximate a tile which is not cached from its nearest cached
+    ancestor, starting the download of the real one in background
+
+    Position arguments:
+    tile -- Tuple of 3 values, tilex, tiley and zoom (<= 15)
+    layer -- 'terrarium' or 'terrain-background'
+    url -- URL of the real tile
+    process -- Function to process the downloaded real tile
+    callback -- Function called with the download future when the real tile
+                arrives (or fails). None to ignore it
+
+    Returned value:
+    The upsampled data, None if there is no cached ancestor
+    """
+    data = upsampled(tile, layer)
+    if data is None:
+        return None
+    future = _download(layer, tile, url, process)
+    if callback is not None:
+        future.add_done_callback(callback)
+    return data
+
+
+def elevation(tile, force=False, fallback=False, callback=None):
     """ Download a tile elevation image
 
     Position arguments:
@@ -43,38 +440,38 @@ def elevation(tile, force=False):
     Keyword arguments:
     force -- True if the image should be downloaded even though it is already
              available in the cache
+    fallback -- True to approximate the tile from its nearest cached ancestor
+                if it is not cached yet, instead of waiting for the download,
+                which is carried out in background
+    callback -- Function called with the download future when the real tile
+                arrives, if fallback has been used
 
     Returned value:
-    Numpy array of elevations per pixel
+    Numpy array of elevations per pixel. If fallback is True, a tuple with
+    the array and a flag, True if it is approximated
     """
-    img_file = CACHE_PATH + "terrarium/{}/{}/{}.png".format(
-        int(tile[2]), int(tile[0]), int(tile[1]))
-    if os.path.isfile(img_file) and not force:
+    t0 = time.time()
+    img_file, url, process, valid = _request('terrarium', tile)
+    hit = not force and cache.is_cached(img_file, valid)
+    if hit:
         # The image is already cached
+        if _stale('terrarium', img_file):
+            _revalidate('terrarium', tile)
         pic = Image.open(img_file)
     else:
         # Download the terrarium image
-        url = ELEVATION_URL + "terrarium/{}/{}/{}.png".format(
-            int(tile[2]), int(tile[0]), int(tile[1]))
-        print(url)
-        img = urllib2.urlopen(url).read()
-        pic = Image.open(StringIO.StringIO(img))
-        # Check that it is a valid image
-        pic.verify()
-        pic = Image.open(StringIO.StringIO(img))
-        # Save it
-        img_folder = os.path.dirname(img_file)
-        if not os.path.isdir(img_folder):
-            mkpath(img_folder)
-        pic.save(img_file)
-    # Decode the elevation
-    pix = np.array(pic.getdata(), dtype=np.float).reshape(
-        pic.size[0], pic.size[1], 3)
-    elevation = (pix[:,:,0] * 256 + pix[:,:,1] + pix[:,:,2] / 256) - 32768
-    return elevation
+        if fallback and not force:
+            data = _approximate(tile, 'terrarium', url, process, callback)
+            if data is not None:
+                _accessed('terrarium', tile, img_file, False, t0, True)
+                return data, True
+        pic = _download('terrarium', tile, url, process).result()
+    _accessed('terrarium', tile, img_file, hit, t0)
+    data = decode_elevation(pic)
+    return (data, False) if fallback else data
 
 
-def landcover(tile, force=False):
+def landcover(tile, force=False, fallback=False, callback=None):
     """ Download a tile elevation image
 
     Position arguments:
@@ -83,40 +480,38 @@ def landcover(tile, force=False):
     Keyword arguments:
     force -- True if the image should be downloaded even though it is already
              available in the cache
+    fallback -- True to approximate the tile from its nearest cached ancestor
+                if it is not cached yet, instead of waiting for the download,
+                which is carried out in background
+    callback -- Function called with the download future when the real tile
+                arrives, if fallback has been used
 
     Returned value:
-    Numpy array with the RGB image content
+    Numpy array with the RGB image content. If fallback is True, a tuple with
+    the array and a flag, True if it is approximated
     """
-    img_file = CACHE_PATH + "terrain-background/{}/{}/{}.png".format(
-        int(tile[2]), int(tile[0]), int(tile[1]))
-    if os.path.isfile(img_file) and not force:
+    t0 = time.time()
+    img_file, url, process, valid = _request('terrain-background', tile)
+    hit = not force and cache.is_cached(img_file, valid)
+    if hit:
         # The image is already cached
+        if _stale('terrain-background', img_file):
+            _revalidate('terrain-background', tile)
         pic = Image.open(img_file)
     else:
         # Download the shaded landscape image
-        url = LANDCOVER_URL + "terrain-background/{}/{}/{}.png".format(
-            int(tile[2]), int(tile[0]), int(tile[1]))
-        print(url)
-        img = urllib2.urlopen(url).read()
-        pic = Image.open(StringIO.StringIO(img))
-        # Check that it is a valid image
-        pic.verify()
-        pic = Image.open(StringIO.StringIO(img))
-        # Convert to HSV and remove Saturation and Value (we are interested
-        # just in Hue)
-        hsv = pic.convert('HSV')
-        pix = np.array(hsv)
-        # pix[:,:,1] = 100
-        pix[:,:,2] = 255
-        hsv = Image.fromarray(pix, mode='HSV')
-        pic = hsv.convert('RGB')
-        # Save it
-        img_folder = os.path.dirname(img_file)
-        if not os.path.isdir(img_folder):
-            mkpath(img_folder)
-        pic.save(img_file)
+        if fallback and not force:
+            data = _approximate(tile, 'terrain-background', url, process,
+                                callback)
+            if data is not None:
+                _accessed('terrain-background', tile, img_file, False,
+                          t0, True)
+                return data, True
+        pic = _download('terrain-background', tile, url, process).result()
+    _accessed('terrain-background', tile, img_file, hit, t0)
     # Return an scipy image
-    return np.array(pic)
+    data = np.array(pic)
+    return (data, False) if fallback else data
 
 
 def vector_data(tile, force=False):
@@ -132,25 +527,18 @@ def vector_data(tile, force=False):
     Returned value:
     JSON data
     """
-    json_file = CACHE_PATH + "osm/all/{}/{}/{}.json".format(
-        int(tile[2]), int(tile[0]), int(tile[1]))
-    if os.path.isfile(json_file) and not force:
+    t0 = time.time()
+    json_file, url, process, valid = _request('osm', tile)
+    hit = not force and cache.is_cached(json_file, valid)
+    if hit:
         # The data is already cached
-        with open(json_file, 'r') as data_file:
-            data = json.load(data_file)
+        if _stale('osm', json_file):
+            _revalidate('osm', tile)
+        data = _load_json(json_file)
     else:
-        # Download the shaded landscape image
-        url = VECTOR_URL + "osm/all/{}/{}/{}.json".format(
-            int(tile[2]), int(tile[0]), int(tile[1]))
-        print(url)
-        json_txt = urllib2.urlopen(url).read()
-        data = json.load(StringIO.StringIO(json_txt))
-        # Save it
-        json_folder = os.path.dirname(json_file)
-        if not os.path.isdir(json_folder):
-            mkpath(json_folder)
-        with open(json_file, 'w') as outfile:
-            json.dump(data, outfile)
+        # Download the vectorial data
+        data = _download('osm', tile, url, process).result()
+    _accessed('osm', tile, json_file, hit, t0)
     return data
 
 
@@ -176,19 +564,134 @@ def main(tilesx, tilesy, zoom, force=False):
                 print("Failed to download {}/{}/{}".format(tilex, tiley, zoom))
 
 
+def estimate(zooms, bbox=None, polygon=None, layers=LAYERS):
+    """ Estimate the number of tiles and bytes to download for a region
+
+    Position arguments:
+    zooms -- List of zoom levels
+
+    Keyword arguments:
+    bbox -- Bounding box, (lat_min, lon_min, lat_max, lon_max)
+    polygon -- List of (lat, lon) vertices
+    layers -- Layers to download
+
+    Returned value:
+    Number of tiles and bytes
+    """
+    n = count_tiles(zooms, bbox, polygon)
+    return n, n * sum(TILE_BYTES[layer] for layer in layers)
+
+
+def _save_manifest(manifest_file, job):
+    cache.write(manifest_file, json.dumps(job))
+
+
+def seed(manifest_file, zooms=None, bbox=None, polygon=None, layers=LAYERS,
+         force=False, chunk=SEED_CHUNK, refresh=False):
+    """ Download all the tiles of a region, along a set of zoom levels. The
+    progress is saved in a job manifest, such that if the manifest already
+    exists the job is resumed from the point where it was stopped
+
+    Position arguments:
+    manifest_file -- Job manifest path
+
+    Keyword arguments:
+    zooms -- List of zoom levels (ignored when resuming a job)
+    bbox -- Bounding box, (lat_min, lon_min, lat_max, lon_max) (ignored when
+            resuming a job)
+    polygon -- List of (lat, lon) vertices (ignored when resuming a job)
+    layers -- Layers to download (ignored when resuming a job)
+    force -- True if the tiles should be downloaded even though they are
+             already available in the cache
+    chunk -- Number of tiles downloaded in parallel between manifest updates
+    refresh -- True to revalidate the already cached tiles, downloading just
+               the ones changed in the server (ignored when resuming a job)
+
+    Returned value:
+    The job manifest, with the number of processed tiles and the list of
+    failed ones
+    """
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            job = json.load(f)
+    else:
+        n, n_bytes = estimate(zooms, bbox, polygon, layers)
+        job = {'zooms': list(zooms), 'bbox': bbox, 'polygon': polygon,
+               'layers': list(layers), 'tiles': n, 'bytes': n_bytes,
+               'done': 0, 'failed': [], 'refresh': refresh}
+        _save_manifest(manifest_file, job)
+    tiles = itertools.chain(*[region_tiles(z, job['bbox'], job['polygon'])
+                              for z in job['zooms']])
+    # Skip the already processed tiles, without checking the cache
+    tiles = itertools.islice(tiles, job['done'], None)
+    while True:
+        batch = list(itertools.islice(tiles, chunk))
+        if not batch:
+            break
+        futures = prefetch(batch, force, job['layers'],
+                           job.get('refresh', False))
+        for key, future in futures.items():
+            future.wait()
+            if future.exception() is not None:
+                job['failed'].append(list(key))
+        job['done'] += len(batch)
+        _save_manifest(manifest_file, job)
+        print("{} / {} tiles ({} failed)".format(
+            job['done'], job['tiles'], len(job['failed'])))
+    return job
+
+
 if __name__ == "__main__":
-    # Call this script with the following command:
-    # python zoom [startx endx starty endy]
+    # Call this script with the following commands:
+    # python -m mapzen.download zoom [startx endx starty endy]
+    # python -m mapzen.download bbox latmin lonmin latmax lonmax zmin zmax job
+    # python -m mapzen.download polygon polygon.json zmin zmax job
+    # python -m mapzen.download resume job
+    # python -m mapzen.download refresh job
     # where:
     # zoom is the zoom level (<= 14)
     # startx is the first x tile to download
-    # endx is the last x tile to download    
+    # endx is the last x tile to download
     # starty is the first y tile to download
     # endy is the last y tile to download
+    # latmin lonmin latmax lonmax is the region bounding box
+    # polygon.json is a JSON file with a list of [lat, lon] vertices
+    # zmin and zmax are the first and last zoom levels to download
+    # job is the job manifest file, used to resume the download
+    # refresh runs again a finished job, downloading just the changed tiles
     #
     # For instance, to download everything you may execute the following
     # command (BASH):
-    # for zoom in {1..15}; do python mapzen/download.py $zoom & done
+    # for zoom in {1..15}; do python -m mapzen.download $zoom & done
+    if len(sys.argv) < 2:
+        raise ValueError('Wrong number of arguments')
+    if sys.argv[1] in ('bbox', 'polygon', 'resume', 'refresh'):
+        bbox = polygon = zooms = None
+        if sys.argv[1] == 'bbox':
+            if len(sys.argv) != 9:
+                raise ValueError('Wrong number of arguments')
+            bbox = [float(v) for v in sys.argv[2:6]]
+        elif sys.argv[1] == 'polygon':
+            if len(sys.argv) != 6:
+                raise ValueError('Wrong number of arguments')
+            with open(sys.argv[2], 'r') as f:
+                polygon = json.load(f)
+        elif len(sys.argv) != 3:
+            raise ValueError('Wrong number of arguments')
+        if sys.argv[1] == 'refresh':
+            with open(sys.argv[2], 'r') as f:
+                job = json.load(f)
+            job.update({'done': 0, 'failed': [], 'refresh': True})
+            _save_manifest(sys.argv[2], job)
+        elif sys.argv[1] != 'resume':
+            zooms = list(range(int(sys.argv[-3]), int(sys.argv[-2]) + 1))
+            n, n_bytes = estimate(zooms, bbox, polygon)
+            print("{} tiles, {:.1f} MB approximately".format(
+                n, n_bytes / 1048576.0))
+        job = seed(sys.argv[-1], zooms, bbox, polygon)
+        for key in job['failed']:
+            print("Failed to download {}/{}/{}/{}".format(*key))
+        sys.exit()
     if len(sys.argv) != 6 and len(sys.argv) != 2:
         raise ValueError('Wrong number of arguments')
         sys.exit()
@@ -198,4 +701,4 @@ if __name__ == "__main__":
         tilesy = list(range(int(sys.argv[4]), int(sys.argv[5]) + 1))
     else:
         tilesx = tilesy = list(range(0, 2**zoom))
-    main(tilesx, tilesy, zoom)
\ No newline at end of file
+    main(tilesx, tilesy, zoom)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Heightmap export of large regions. The tiles are streamed into a memory
+# mapped .npy file by several processes, such that the memory usage does not
+# depend on the region size
+
+import sys
+import json
+import time
+import numpy as np
+from PIL import Image
+from . import cache
+from .download import elevation, decode_elevation, prefetch, _request
+from .region import mercator, tile_range
+
+
+# Maximum number of tiles along x written by each job
+JOB_TILES = 64
+# Elevation of the tiles which are not available
+NODATA = np.nan
+
+
+def _load(tile, download):
+    """ Load a tile elevation, None if it is not available
+    """
+    if download:
+        try:
+            return elevation(tile)
+        except Exception:
+            return None
+    img_file = _request('terrarium', tile)[0]
+    if not cache.is_cached(img_file):
+        return None
+    try:
+        return decode_elevation(Image.open(img_file))
+    except Exception:
+        # Corrupted tile, reported as missing
+        return None
+
+
+def _export_tiles(args):
+    """ Write a row of tiles in the exported heightmap
+
+    Position arguments:
+    args -- Tuple with the heightmap path, the tile y, the first and last
+            tiles x, the first tiles x and y of the heightmap, the zoom level
+            and True if the missing tiles should be downloaded
+
+    Returned value:
+    Number of tiles written, and list of tiles which are not available
+    """
+    path, ty, tx0, tx1, txmin, tymin, zoom, download = args
+    tiles = [(tx, ty, zoom) for tx in range(tx0, tx1 + 1)]
+    if download:
+        prefetch(tiles, layers=('terrarium',))
+    out = np.load(path, mmap_mode='r+')
+    n = mercator.tileSize
+    row = (ty - tymin) * n
+    missing = []
+    for tile in tiles:
+        col = (tile[0] - txmin) * n
+        data = _load(tile, download)
+        if data is None or data.shape != (n, n):
+            data = NODATA
+            missing.append(tile)
+        out[row:row + n, col:col + n] = data
+    out.flush()
+    del out
+    return len(tiles), missing
+
+
+def export(path, bbox, zoom, processes=None, download=False, verbose=True):
+    """ Export the elevation of a region as a memory mapped heightmap, a
+    float32 .npy file (see numpy.load(path, mmap_mode='r')), with the same
+    layout than the generator mosaics, i.e. the tile (tx, ty) is placed at
+    the rows (ty - tymin) * 256 and the columns (tx - txmin) * 256. The
+    tiles are read in parallel, each job writing up to JOB_TILES tiles of
+    a row directly in the file, such that the heightmap is never kept in
+    memory. The heightmap extent is saved in a JSON file next to it,
+    path + '.json'
+
+    Position arguments:
+    path -- Heightmap file path
+    bbox -- Bounding box, (lat_min, lon_min, lat_max, lon_max)
+    zoom -- Zoom level
+
+    Keyword arguments:
+    processes -- Number of parallel processes, None to use all the cores
+    download -- True to download the tiles not cached yet. Otherwise they
+                are filled with NODATA
+    verbose -- True to print the progress and the throughput
+
+    Returned value:
+    Dictionary with the number of tiles, the list of missing tiles, the
+    elapsed time and the throughput (tiles per second)
+    """
+    txmin, txmax, tymin, tymax = tile_range(bbox, zoom)
+    nx, ny = txmax - txmin + 1, tymax - tymin + 1
+    if nx <= 0 or ny <= 0:
+        raise ValueError('Empty region {}'.format(bbox))
+    n = mercator.tileSize
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                    shape=(ny * n, nx * n))
+    del out
+    xmin, ymin, _, _ = mercator.TileBounds(txmin, tymin, zoom)
+    _, _, xmax, ymax = mercator.TileBounds(txmax, tymax, zoom)
+    meta = {'zoom': zoom,
+            'tiles': [txmin, txmax, tymin, tymax],
+            'bounds': [xmin, ymin, xmax, ymax],
+            'resolution': mercator.Resolution(zoom),
+            'nodata': None if np.isnan(NODATA) else NODATA}
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+    jobs = ((path, ty, tx, min(tx + JOB_TILES - 1, txmax), txmin, tymin, zoom,
+             download)
+            for ty in range(tymin, tymax + 1)
+            for tx in range(txmin, txmax + 1, JOB_TILES))
+    # Imported here, so the raycasts are not loading it
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    total = nx * ny
+    done = 0
+    missing = []
+    t0 = time.time()
+    try:
+        for n_tiles, job_missing in pool.imap_unordered(_export_tiles, jobs):
+            done += n_tiles
+            missing.extend(job_missing)
+            if verbose:
+                elapsed = time.time() - t0
+                print("{} / {} tiles ({} missing), {:.1f} tiles/s".format(
+                    done, total, len(missing), done / max(elapsed, 1e-6)))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - t0
+    return {'tiles': total,
+            'missing': missing,
+            'time': elapsed,
+            'tiles_per_second': total / max(elapsed, 1e-6)}
+
+
+if __name__ == "__main__":
+    # Call this script with the following command:
+    # python -m mapzen.export latmin lonmin latmax lonmax zoom output.npy
+    #                         [processes [download]]
+    # where:
+    # latmin lonmin latmax lonmax is the region bounding box
+    # zoom is the zoom level
+    # output.npy is the heightmap file, see export()
+    # processes is the number of parallel processes (all the cores by default)
+    # download is 1 to download the tiles not cached yet, 0 otherwise
+    if len(sys.argv) not in (7, 8, 9):
+        raise ValueError('Wrong number of arguments')
+    bbox = [float(v) for v in sys.argv[1:5]]
+    zoom = int(sys.argv[5])
+    processes = int(sys.argv[7]) if len(sys.argv) > 7 else None
+    download = len(sys.argv) > 8 and sys.argv[8] == '1'
+    result = export(sys.argv[6], bbox, zoom, processes, download)
+    for tile in result['missing']:
+        print("Missing {}/{}/{}".format(tile[2], tile[0], tile[1]))
+    print("{} tiles in {:.1f} s, {:.1f} tiles/s".format(
+        result['tiles'], result['time'], result['tiles_per_second']))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import threading
+import traceback
+import Queue
+import urllib2
+
+
+TIMEOUT = 30.0
+MAX_CONNECTIONS = 8
+
+
+def _validators(info):
+    """ Extract the cache validators from the response headers
+    """
+    return {'etag': info.getheader('ETag'),
+            'last_modified': info.getheader('Last-Modified')}
+
+
+class Future(object):
+    def __init__(self):
+        """Result of a request which may be still in flight"""
+        self.__done = threading.Event()
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def set_result(self, result):
+        self.__result = result
+        self.__finish()
+
+    def set_exception(self, exc_info):
+        self.__exc_info = exc_info
+        self.__finish()
+
+    def __finish(self):
+        self.__lock.acquire()
+        self.__done.set()
+        callbacks = self.__callbacks
+        self.__callbacks = []
+        self.__lock.release()
+        for callback in callbacks:
+            self.__call(callback)
+
+    def __call(self, callback):
+        # A failing callback should neither kill the worker nor skip the
+        # other callbacks
+        try:
+            callback(self)
+        except Exception:
+            print("Error in a request callback:")
+            traceback.print_exc()
+
+    def add_done_callback(self, callback):
+        """ Call a function, with the future as the only argument, when the
+        request is finished. If it is already finished, the function is called
+        right now
+        """
+        self.__lock.acquire()
+        if not self.__done.isSet():
+            self.__callbacks.append(callback)
+            callback = None
+        self.__lock.release()
+        if callback is not None:
+            self.__call(callback)
+
+    def done(self):
+        return self.__done.isSet()
+
+    def wait(self, timeout=None):
+        """ Wait for the request to finish, without raising errors
+
+        Keyword arguments:
+        timeout -- Maximum time to wait, in seconds. None to wait forever
+
+        Returned value:
+        True if the request is finished, False otherwise
+        """
+        self.__done.wait(timeout)
+        return self.__done.isSet()
+
+    def exception(self):
+        """ Get the error of a finished request
+
+        Returned value:
+        The raised exception, None if the request succeeded or it is not
+        finished yet
+        """
+        if self.__exc_info is None:
+            return None
+        return self.__exc_info[1]
+
+    def result(self, timeout=None):
+        """ Wait for the request to finish
+
+        Keyword arguments:
+        timeout -- Maximum time to wait, in seconds. None to wait forever
+
+        Returned value:
+        Request result. If the request failed, the exception is raised again
+        """
+        if not self.__done.wait(timeout):
+            raise IOError('Timeout waiting for the request')
+        if self.__exc_info is not None:
+            # Keep the worker traceback
+            exc_type, exc_value, exc_tb = self.__exc_info
+            raise exc_type, exc_value, exc_tb
+        return self.__result
+
+
+class Fetcher(object):
+    def __init__(self, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT,
+                 rate=None):
+        """Tiles fetcher. A bounded pool of workers is downloading the
+        requested URLs in parallel. Just a single request is in flight for each
+        key, such that concurrent requests of the same tile are sharing the
+        same download.
+
+        Keyword arguments:
+        max_connections -- Maximum number of simultaneous downloads
+        timeout -- Timeout of each request, in seconds
+        rate -- Maximum number of requests started per second. None for
+                unlimited
+        """
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.rate = rate
+        self.__next_time = 0.0
+        self.__queue = Queue.Queue()
+        self.__inflight = {}
+        self.__lock = threading.Lock()
+        self.__workers = []
+
+    def __start_workers(self):
+        self.__workers = [w for w in self.__workers if w.is_alive()]
+        while len(self.__workers) < self.max_connections:
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+
+    def __work(self):
+        while True:
+            key, url, process, headers, future = self.__queue.get()
+            try:
+                self.__throttle()
+                try:
+                    data, info = self.urlopen(url, headers)
+                    result = data if process is None else process(data, info)
+                except:
+                    result = None
+                    exc_info = sys.exc_info()
+                else:
+                    exc_info = None
+                # Remove it from the in-flight requests before notifying, so
+                # the callbacks are able to request it again
+                self.__lock.acquire()
+                del self.__inflight[key]
+                self.__lock.release()
+                if exc_info is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exc_info)
+            finally:
+                self.__queue.task_done()
+
+    def __throttle(self):
+        """ Wait for the next request slot, if the rate is limited
+        """
+        if not self.rate:
+            return
+        self.__lock.acquire()
+        now = time.time()
+        t = max(now, self.__next_time)
+        self.__next_time = t + 1.0 / self.rate
+        self.__lock.release()
+        if t > now:
+            time.sleep(t - now)
+
+    def urlopen(self, url, headers=None):
+        """ Download an URL
+
+        Position arguments:
+        url -- URL to download
+
+        Keyword arguments:
+        headers -- Dictionary of additional request headers, e.g.
+                   If-None-Match or If-Modified-Since for conditional requests
+
+        Returned value:
+        Downloaded data, None if the server answered 304 (Not Modified), and
+        dictionary with the 'etag' and 'last_modified' response headers
+        """
+        print(url)
+        request = urllib2.Request(url, headers=headers or {})
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code != 304:
+                raise
+            return None, _validators(e.info())
+        return response.read(), _validators(response.info())
+
+    def submit(self, key, url, process=None, headers=None):
+        """ Request a download, without waiting for it
+
+        Position arguments:
+        key -- Unique key of the resource, e.g. (layer, z, x, y)
+        url -- URL to download
+
+        Keyword arguments:
+        process -- Function to process the downloaded data in the worker, e.g.
+                   to validate it and save it in the cache. It receives the
+                   data (None if it was not modified) and the response
+                   validators, see urlopen(). Its returned value is the
+                   result of the request
+        headers -- Dictionary of additional request headers
+
+        Returned value:
+        Future. If the same key is already in flight, its future is returned
+        """
+        self.__lock.acquire()
+        try:
+            if key in self.__inflight:
+                return self.__inflight[key]
+            future = Future()
+            self.__inflight[key] = future
+            self.__start_workers()
+            self.__queue.put((key, url, process, headers, future))
+            return future
+        finally:
+            self.__lock.release()
+
+    def get(self, key, url, process=None, headers=None):
+        """ Download a resource, waiting for it. See submit()
+        """
+        return self.submit(key, url, process, headers).result()
+
+    def inflight(self):
+        """ Get the number of requests still in flight
+        """
+        self.__lock.acquire()
+        n = len(self.__inflight)
+        self.__lock.release()
+        return n
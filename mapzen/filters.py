@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Numpy image filters, following the scipy.ndimage definitions (reflected
+# borders, kernels truncated at 4 standard deviations), such that scipy is not
+# required to generate the terrain
+
+import numpy as np
+
+
+TRUNCATE = 4.0
+
+
+def _kernel(sigma, order=0):
+    """ Get the gaussian (order=0) or gaussian derivative (order=1)
+    correlation weights
+    """
+    radius = int(TRUNCATE * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float)
+    phi = np.exp(-0.5 * x**2 / sigma**2)
+    phi /= phi.sum()
+    if order == 1:
+        phi *= -x / sigma**2
+    return phi[::-1]
+
+
+def correlate1d(data, weights, axis, out=None):
+    """ Correlate an image along an axis, reflecting the borders
+
+    Position arguments:
+    data -- Image
+    weights -- Odd length list of weights
+    axis -- Axis along which the image is correlated
+
+    Keyword arguments:
+    out -- Array where the result is written, which may be data itself. None
+           to allocate a new one
+
+    Returned value:
+    Correlated image
+    """
+    radius = len(weights) // 2
+    data = np.asarray(data)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float)
+    if out is None:
+        out = np.empty(data.shape, dtype=data.dtype)
+    data = np.swapaxes(data, 0, axis)
+    result = np.swapaxes(out, 0, axis)
+    n = data.shape[0]
+    # The padded copy is also allowing to write the result in the input
+    padded = np.pad(data, [(radius, radius)] + [(0, 0)] * (data.ndim - 1),
+                    mode='symmetric')
+    tmp = np.empty(data.shape, dtype=out.dtype)
+    result[...] = 0
+    for k, w in enumerate(weights):
+        np.multiply(padded[k:k + n], w, out=tmp)
+        result += tmp
+    return out
+
+
+def gaussian_filter(data, sigma, orders=None, out=None):
+    """ Gaussian filter, along all the image axes
+
+    Position arguments:
+    data -- Image
+    sigma -- Standard deviation, in pixels
+
+    Keyword arguments:
+    orders -- List with the derivative order along each axis, 0 or 1. None
+              for no derivatives
+    out -- Array where the result is written, which may be data itself. None
+           to allocate a new one
+
+    Returned value:
+    Filtered image
+    """
+    orders = orders or [0] * np.ndim(data)
+    for axis, order in enumerate(orders):
+        out = correlate1d(data, _kernel(sigma, order), axis, out)
+        data = out
+    return out
+
+
+def gaussian_gradient_magnitude(data, sigma, out=None):
+    """ Gradient magnitude, computed with gaussian derivatives
+
+    Position arguments:
+    data -- Image
+    sigma -- Standard deviation, in pixels
+
+    Keyword arguments:
+    out -- Array where the result is written. None to allocate a new one
+
+    Returned value:
+    Gradient magnitude image
+    """
+    data = np.asarray(data)
+    ndim = data.ndim
+    dtype = data.dtype if data.dtype.kind == 'f' else np.float
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    out[...] = 0
+    derivative = np.empty(data.shape, dtype=dtype)
+    for axis in range(ndim):
+        orders = [0] * ndim
+        orders[axis] = 1
+        gaussian_filter(data, sigma, orders, out=derivative)
+        np.square(derivative, out=derivative)
+        out += derivative
+    return np.sqrt(out, out=out)
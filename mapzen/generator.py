@@ -19,36 +19,122 @@
 
 import time
 import os.path
+import json
 import threading
+from collections import OrderedDict
 import numpy as np
-from scipy.ndimage import gaussian_filter, gaussian_gradient_magnitude
-from skimage import io, img_as_uint
-from skimage.transform import resize
-from skimage.color import rgb2hsv, hsv2rgb
-import urllib2
-import StringIO
 from PIL import Image
 from .globalmaptiles import GlobalMercator
-from .download import elevation, landcover
-from panda3d.core import ShaderTerrainMesh, Shader, SamplerState
+from .download import elevation, landcover, prefetch, upsampled
+from . import textures
+from . import raycast
+from . import memory
+from . import cache
+from .filters import gaussian_filter, gaussian_gradient_magnitude
+from panda3d.core import ShaderTerrainMesh, Shader, SamplerState, Vec2, Vec3
 
 
+VERT_SHADER = "mapzen/rsc/terrain.vert.glsl"
+FRAG_SHADER = "mapzen/rsc/terrain.frag.glsl"
 MIN_ZSCALE = 125.0
 ROCK_COLOR = np.asarray([100, 60, 30], dtype=np.int16)
 ROCK_STEEPNESS = np.tan(np.radians(30.0))
+NORMALS_CACHE_SIZE = 4
+LEVELS_CACHE_SIZE = 16
+PLACEHOLDER_COLOR = np.asarray([120, 140, 90], dtype=np.uint8)
+PLACEHOLDERS = (None, 'flat', 'parent')
+TILE_TIMEOUT = 2.0
+SNAPSHOT_FILE = 'snapshot.json'
+# Elevation mosaic buffers: shown, pending to be shown, and being generated
+ELEVATION_BUFFERS = 3
+RETRY_DELAY = 10.0
 update_mutex = threading.Lock()
 
 
+def load_terrain_shader(defines=()):
+    """ Load the terrain shader variant with the provided preprocessor
+    symbols defined
+
+    Keyword arguments:
+    defines -- List of symbols to become defined right after the GLSL version
+               directive
+
+    Returned value:
+    Panda3D shader
+    """
+    sources = []
+    for fname in (VERT_SHADER, FRAG_SHADER):
+        with open(fname, 'r') as f:
+            lines = f.read().split('\n')
+        # The version directive must be the first statement
+        lines = lines[:1] + ['#define ' + d for d in defines] + lines[1:]
+        sources.append('\n'.join(lines))
+    return Shader.make(Shader.SL_GLSL, sources[0], sources[1])
+
+
+def _arrays(value):
+    """ Get the arrays of a (nested) list of arrays
+    """
+    if isinstance(value, (list, tuple)):
+        return [a for item in value for a in _arrays(item)]
+    return [value]
+
+
 class Generator(threading.Thread):
     def __init__(self, camera, loader, root_node, group=None, target=None,
-                 name=None, verbose=None, zoom=15):
+                 name=None, verbose=None, zoom=15, gpu_rocks=False,
+                 normal_map=False, heightfield_format='r16',
+                 landcover_format='rgb8', landcover_size=None,
+                 compression=None, gsg=None, placeholder='flat',
+                 tile_timeout=TILE_TIMEOUT, rings=1, toroidal=False):
+        if placeholder not in PLACEHOLDERS:
+            raise ValueError('Unknown placeholder {}'.format(placeholder))
+        if heightfield_format not in textures.HEIGHTFIELD_FORMATS:
+            raise ValueError('Unknown heightfield format {}'.format(
+                heightfield_format))
+        if landcover_format not in textures.COLOR_FORMATS:
+            raise ValueError('Unknown landcover format {}'.format(
+                landcover_format))
+        if compression not in textures.COMPRESSIONS:
+            raise ValueError('Unknown compression {}'.format(compression))
+        if rings < 1:
+            raise ValueError('At least 1 ring of tiles should be loaded')
+        if toroidal and compression is not None:
+            raise ValueError('The toroidal textures cannot be compressed')
         self.__camera = camera
         self.__loader = loader
         self.__root = root_node
         self.__zoom = zoom
+        self.__gpu_rocks = gpu_rocks
+        self.__normal_map = normal_map
+        self.__normals_cache = OrderedDict()
+        self.__levels_cache = OrderedDict()
+        self.__cache_lock = threading.Lock()
+        self.__pyramid_back = None
+        self.pyramid = None
+        self.__mosaic_back = None
+        self.__mosaic_front = None
+        self.__buffers = {}
+        self.__heightfield_format = heightfield_format
+        self.__landcover_format = landcover_format
+        self.__landcover_size = landcover_size
+        self.__rings = rings
+        self.__rings_back = rings
+        self.__compression = compression
+        self.__toroidal = toroidal
+        self.__slot_textures = None
+        self.__slots = {}
+        self.__gsg = gsg
+        self.__textures_back = None
+        self.texture_stats = {}
+        self.__placeholder = placeholder
+        self.__tile_timeout = tile_timeout
+        self.__refine_time = None
+        self.missing = set()
         self.__stop = threading.Event()
         self.__tile = None
         self.__tile_back = None
+        self.__tile_front = None
         self.__z0 = 0.0
         self.__zscale = MIN_ZSCALE
         self.__updated = False
@@ -61,11 +147,29 @@ class Generator(threading.Thread):
         self.terrain = root_node.attach_new_node(self.terrain_node)
         self.terrain.set_scale(1024, 1024, 100)
         self.terrain.set_pos(-512, -512, -70.0)
-        terrain_shader = Shader.load(Shader.SL_GLSL,
-                                     "mapzen/rsc/terrain.vert.glsl",
-                                     "mapzen/rsc/terrain.frag.glsl")
-        self.terrain.set_shader(terrain_shader)
+        defines = []
+        if gpu_rocks:
+            defines.append('ROCKS_IN_SHADER')
+        if toroidal:
+            defines.append('TOROIDAL')
+        if normal_map:
+            defines.append('USE_NORMAL_MAP')
+            self.normals_tex = self.__loader.loadTexture(
+                "mapzen/rsc/normals.png")
+            self.terrain.set_shader_input("normal_map", self.normals_tex)
+        self.terrain.set_shader(load_terrain_shader(defines))
         self.terrain.set_shader_input("camera", self.__camera)
+        self.terrain.set_shader_input("terrain_texel", Vec2(1.0, 1.0))
+        self.terrain.set_shader_input("terrain_zscale", MIN_ZSCALE)
+        self.terrain.set_shader_input("rock_color", Vec3(*(ROCK_COLOR / 255.0)))
+        self.terrain.set_shader_input("rock_steepness", ROCK_STEEPNESS)
+        if toroidal:
+            self.terrain.set_shader_input("terrain_heights",
+                                          self.terrain_node.heightfield)
+            self.terrain.set_shader_input("terrain_uv_offset", Vec2(0.0, 0.0))
+            self.terrain.set_shader_input("terrain_uv_scale", 1.0)
+            self.terrain.set_shader_input("terrain_height_map",
+                                          Vec2(1.0, 0.0))
         self.landcover_tex = self.__loader.loadTexture("mapzen/rsc/landcover.png")
         # self.landcover_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
         # self.landcover_tex.set_anisotropic_degree(16)
@@ -73,6 +177,18 @@ class Generator(threading.Thread):
 
         self.mercator = GlobalMercator()
         self.__orig = np.zeros(3, dtype=np.float)
+        self.__memory = [
+            memory.REGISTRY.register(
+                'generator.normals',
+                lambda: self.__cache_bytes(self.__normals_cache),
+                lambda n, keep: self.__evict(self.__normals_cache, n, keep)),
+            memory.REGISTRY.register(
+                'generator.pyramids',
+                lambda: self.__cache_bytes(self.__levels_cache),
+                lambda n, keep: self.__evict(self.__levels_cache, n, keep)),
+            memory.REGISTRY.register('generator.mosaics', self.__mosaic_bytes),
+            memory.REGISTRY.register('generator.textures',
+                                     self.__texture_bytes)]
         threading.Thread.__init__(self, group=group, target=target, name=name,
                                   verbose=verbose)
         return
@@ -89,62 +205,471 @@ class Generator(threading.Thread):
         Edited landcover
         """
         # Compute the steepness of each pixel
-        grad = gaussian_gradient_magnitude(elevation, 1.0)
-        grad /= self.mercator.Resolution(self.__zoom)
+        grad = gaussian_gradient_magnitude(
+            elevation, 1.0, out=self.__work('grad', elevation.shape))
         # Get the mask of rock (with a smooth transition)
-        mask = (grad >= ROCK_STEEPNESS).astype(np.float)
-        mask = gaussian_filter(mask, 3.0)
-        # Blend the images
-        dtype = landcover.dtype
-        rock_image = np.zeros(landcover.shape, dtype=dtype)
-        rock_image[:,:] = ROCK_COLOR
-        for i in range(3):
-            rock_image[:,:,i] = (mask * rock_image[:,:,i]).astype(dtype)
-            landcover[:,:,i] = ((1.0 - mask) * landcover[:,:,i]).astype(dtype)
-        landcover += rock_image
+        mask = self.__work('mask', elevation.shape)
+        threshold = ROCK_STEEPNESS * self.mercator.Resolution(self.__zoom)
+        np.greater_equal(grad, threshold, out=mask)
+        gaussian_filter(mask, 3.0, out=mask)
+        # Blend the images, landcover + mask * (rock - landcover)
+        blend = self.__work('blend', landcover.shape)
+        np.subtract(ROCK_COLOR, landcover, out=blend)
+        blend *= mask[:,:,np.newaxis]
+        blend += landcover
+        np.copyto(landcover, blend, casting='unsafe')
         return landcover
 
+    def __work(self, name, shape, dtype=np.float32):
+        """ Get a persistent work array, which is allocated again just if
+        the requested shape or type changes
+
+        Position arguments:
+        name -- Name of the array
+        shape -- Shape of the array
+
+        Keyword arguments:
+        dtype -- Type of the array
+
+        Returned value:
+        Work array, with undefined content
+        """
+        buf = self.__buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self.__buffers[name] = buf
+        return buf
+
+    def __elevation_buffer(self, shape):
+        """ Get an elevation mosaic buffer which is neither shown nor
+        pending to be shown, since the shown one is kept for the snapshots
+        """
+        update_mutex.acquire()
+        used = [m[0].get('elevation') for m in (self.__mosaic_front,
+                                                self.__mosaic_back)
+                if m is not None]
+        update_mutex.release()
+        for i in range(ELEVATION_BUFFERS):
+            buf = self.__work('elevation{}'.format(i), shape)
+            if not any(buf is u for u in used):
+                return buf
+
+    def bake_normal_map(self, tile, elevation, cache=True):
+        """ Compute the terrain normals, encoded as a RGB image. The last
+        computed normal maps are cached, such that going back to an already
+        visited tile is not requiring to compute them again
+
+        Position arguments:
+        tile -- Center tile of the elevation image
+        elevation -- Elevation image
+
+        Keyword arguments:
+        cache -- False if the elevation image is not final (e.g. it has
+                 placeholders), so the normals should not be cached
+
+        Returned value:
+        Normal map
+        """
+        # The rings of the mosaic, which may be changed while it is generated
+        rings = (elevation.shape[0] // self.mercator.tileSize - 1) // 2
+        key = (int(tile[0]), int(tile[1]), self.__zoom, rings)
+        self.__cache_lock.acquire()
+        normals = self.__normals_cache.pop(key, None)
+        if cache and normals is not None:
+            self.__normals_cache[key] = normals
+        self.__cache_lock.release()
+        if cache and normals is not None:
+            return normals
+        # The image rows are growing southward, while the texture v coordinate
+        # is growing northward
+        dzdrow, dzdx = np.gradient(elevation,
+                                   self.mercator.Resolution(self.__zoom))
+        norm = np.sqrt(dzdx**2 + dzdrow**2 + 1.0)
+        normals = np.empty(elevation.shape + (3,), dtype=np.uint8)
+        normals[:,:,0] = np.round(127.5 * (1.0 - dzdx / norm))
+        normals[:,:,1] = np.round(127.5 * (1.0 + dzdrow / norm))
+        normals[:,:,2] = np.round(127.5 * (1.0 + 1.0 / norm))
+        self.__cache_lock.acquire()
+        if cache:
+            self.__normals_cache[key] = normals
+        if len(self.__normals_cache) > NORMALS_CACHE_SIZE:
+            self.__normals_cache.popitem(last=False)
+        self.__cache_lock.release()
+        return normals
+
+    def __cache_bytes(self, cache):
+        """ Bytes of the arrays stored in a cache
+        """
+        self.__cache_lock.acquire()
+        values = list(cache.values())
+        self.__cache_lock.release()
+        return memory.nbytes(*_arrays(values))
+
+    def __evict(self, cache, nbytes, keep=None):
+        """ Release the least recently used entries of a cache
+
+        Position arguments:
+        cache -- Cache, an OrderedDict of tiles
+        nbytes -- Bytes to release
+
+        Keyword arguments:
+        keep -- Function returning True for the tiles that should be kept,
+                see memory.MemoryRegistry.register(). None to evict any tile
+
+        Returned value:
+        Released bytes
+        """
+        freed = 0
+        self.__cache_lock.acquire()
+        for key in list(cache.keys()):
+            if freed >= nbytes:
+                break
+            if keep is not None and keep(key):
+                continue
+            freed += memory.nbytes(*_arrays(cache.pop(key)))
+        self.__cache_lock.release()
+        return freed
+
+    def height_pyramid(self, tiles, es, missing=()):
+        """ Build the min/max elevation pyramid of the tiles, reusing the
+        pyramids of the tiles already used in previous generations
+
+        Position arguments:
+        tiles -- Mosaic tiles, tiles[i][j] is the tile i along x and j along y
+        es -- Mosaic elevation data
+
+        Keyword arguments:
+        missing -- Tiles replaced by placeholders, which are not reused
+
+        Returned value:
+        raycast.HeightPyramid
+        """
+        levels = []
+        for col_t, col_e in zip(tiles, es):
+            levels.append([])
+            for t, e in zip(col_t, col_e):
+                self.__cache_lock.acquire()
+                lv = self.__levels_cache.pop(t, None)
+                self.__cache_lock.release()
+                if lv is None:
+                    lv = raycast.tile_levels(e)
+                if t not in missing:
+                    self.__cache_lock.acquire()
+                    self.__levels_cache[t] = lv
+                    self.__cache_lock.release()
+                levels[-1].append(lv)
+        # Keep at least the tiles of the previous mosaic
+        size = max(LEVELS_CACHE_SIZE, 2 * len(tiles) * len(tiles[0]))
+        self.__cache_lock.acquire()
+        while len(self.__levels_cache) > size:
+            self.__levels_cache.popitem(last=False)
+        self.__cache_lock.release()
+        xmin, ymin, xmax, _ = self.mercator.TileBounds(tiles[0][0][0],
+                                                       tiles[0][0][1],
+                                                       self.__zoom)
+        res = (xmax - xmin) / es[0][0].shape[1]
+        return raycast.HeightPyramid(levels, xmin, ymin, res)
+
+    def __load(self, load, layer, tile, futures, missing):
+        """ Load a tile layer, unless it is not downloaded yet, or it has
+        failed, in which case None is returned and the tile is refined as soon
+        as it arrives
+
+        Position arguments:
+        load -- Layer loading function, elevation() or landcover()
+        layer -- Layer name
+        tile -- Tuple of 3 values, tilex, tiley and zoom
+        futures -- Downloads in flight, as returned by prefetch()
+        missing -- Set where the tiles without data are added
+
+        Returned value:
+        The layer data, None if it is not available
+        """
+        if self.__placeholder is None:
+            return load(tile)
+        future = futures.get((layer, tile[2], tile[0], tile[1]))
+        if future is None or (future.done() and future.exception() is None):
+            try:
+                return load(tile)
+            except Exception:
+                future = None
+        missing.add(tile)
+        if future is None or future.done():
+            # It has failed, so we should try again later
+            self.__refine_at(time.time() + RETRY_DELAY)
+        else:
+            future.add_done_callback(self.__refined)
+        return None
+
+    def __refined(self, future):
+        if future.exception() is None:
+            self.__refine_at(time.time())
+        else:
+            self.__refine_at(time.time() + RETRY_DELAY)
+
+    def __refine_at(self, t):
+        """ Ask the thread to generate the tiles again at the given time
+        """
+        update_mutex.acquire()
+        if self.__refine_time is None or t < self.__refine_time:
+            self.__refine_time = t
+        update_mutex.release()
+
+    def __fill_placeholders(self, tiles, es, cs):
+        """ Replace the missing tiles data by placeholders, either flat or
+        upsampled from a cached lower zoom ancestor
+
+        Position arguments:
+        tiles -- Mosaic tiles, tiles[i][j] is the tile i along x and j along y
+        es -- Mosaic elevation data, None for the missing tiles
+        cs -- Mosaic landcover data, None for the missing tiles
+        """
+        n = self.mercator.tileSize
+        available = [e for col in es for e in col if e is not None]
+        z0 = min(np.min(e) for e in available) if available else 0.0
+        for i, col in enumerate(tiles):
+            for j, t in enumerate(col):
+                if es[i][j] is None and self.__placeholder == 'parent':
+                    es[i][j] = upsampled(t, 'terrarium')
+                if es[i][j] is None:
+                    es[i][j] = np.full((n, n), z0, dtype=np.float)
+                if cs[i][j] is None and self.__placeholder == 'parent':
+                    cs[i][j] = upsampled(t, 'terrain-background')
+                if cs[i][j] is None:
+                    cs[i][j] = np.empty((n, n, 3), dtype=np.uint8)
+                    cs[i][j][:,:] = PLACEHOLDER_COLOR
+
     def generate(self, tile):
+        # Start downloading all the missing tiles in parallel
+        r = self.__rings
+        tiles = [[(tx, ty, self.__zoom)
+                  for ty in range(tile[1] - r, tile[1] + r + 1)]
+                 for tx in range(tile[0] - r, tile[0] + r + 1)]
+        futures = prefetch([t for col in tiles for t in col])
+        if self.__placeholder is not None:
+            # Wait for them, but no longer than the tile timeout
+            deadline = time.time() + self.__tile_timeout
+            for future in futures.values():
+                future.wait(max(0.0, deadline - time.time()))
         # Generate the terrain elevation and landcover image
-        exy = None
-        cxy = None
-        for tx in range(tile[0] - 1, tile[0] + 2):
-            ey = None
-            cy = None
-            for ty in range(tile[1] - 1, tile[1] + 2):
-                e = elevation((tx, ty, self.__zoom))
-                c = landcover((tx, ty, self.__zoom))
-                ey = e if ey is None else np.concatenate((ey, e), axis=0)
-                cy = c if cy is None else np.concatenate((cy, c), axis=0)
-            exy = ey if exy is None else np.concatenate((exy, ey), axis=1)
-            cxy = cy if cxy is None else np.concatenate((cxy, cy), axis=1)
-        cxy = self.set_rocks_in_grad(exy, cxy)
-        z0 = np.min(exy)
-        zscale = max(MIN_ZSCALE, np.max(exy) - z0)
-        exy = (exy - z0) / zscale
-        exy[exy < 0] = 0
-        exy[exy > 1] = 1
+        missing = set()
+        es = [[self.__load(elevation, 'terrarium', t, futures, missing)
+               for t in col] for col in tiles]
+        cs = [[self.__load(landcover, 'terrain-background', t, futures,
+                           missing)
+               for t in col] for col in tiles]
+        self.__fill_placeholders(tiles, es, cs)
+        pyramid = self.height_pyramid(tiles, es, missing)
+        # Compose the mosaics in the persistent buffers
+        k = len(tiles)
+        n, m = es[0][0].shape[0], cs[0][0].shape[0]
+        elevation_xy = self.__elevation_buffer((k * n, k * n))
+        cxy = self.__work('landcover', (k * m, k * m, 3), np.uint8)
+        for i in range(k):
+            for j in range(k):
+                elevation_xy[j * n:(j + 1) * n, i * n:(i + 1) * n] = es[i][j]
+                cxy[j * m:(j + 1) * m, i * m:(i + 1) * m] = cs[i][j]
+        if not self.__gpu_rocks:
+            cxy = self.set_rocks_in_grad(elevation_xy, cxy)
+        if self.__normal_map:
+            nxy = self.bake_normal_map(tile, elevation_xy, cache=not missing)
+        z0 = float(np.min(elevation_xy))
+        zscale = max(MIN_ZSCALE, float(np.max(elevation_xy)) - z0)
+        exy = self.__work('normalized', elevation_xy.shape)
+        np.subtract(elevation_xy, z0, out=exy)
+        exy /= zscale
+        np.clip(exy, 0.0, 1.0, out=exy)
         # Resize the images, which should be power of 2
         new_shape = (1 << (exy.shape[0] - 1).bit_length(),
                      1 << (exy.shape[1] - 1).bit_length())
-        exy = resize(exy, new_shape)
-        new_shape = (1 << (cxy.shape[0] - 1).bit_length(),
-                     1 << (cxy.shape[1] - 1).bit_length())
+        exy = Image.fromarray(exy, mode='F')
+        exy = np.asarray(exy.resize(new_shape[::-1], Image.BILINEAR))
+        if self.__toroidal:
+            # The tiles are written in the texture slots as they are, see
+            # update()
+            mosaic = {'elevation': elevation_xy,
+                      'heightfield': exy,
+                      'landcover': np.copy(cxy)}
+            if self.__normal_map:
+                mosaic['normals'] = nxy
+            self.__set_back(tile, r, z0, zscale, mosaic, pyramid, missing)
+            return
+        if self.__landcover_size is not None:
+            new_shape = (self.__landcover_size, self.__landcover_size)
+        else:
+            new_shape = (1 << (cxy.shape[0] - 1).bit_length(),
+                         1 << (cxy.shape[1] - 1).bit_length())
         cxy = Image.fromarray(cxy, mode='RGB')
         cxy = cxy.resize(new_shape, Image.ANTIALIAS)
-        # Save the textures
-        io.use_plugin('freeimage')
-        exy = img_as_uint(exy)
+        if self.__normal_map:
+            nxy = Image.fromarray(nxy, mode='RGB')
+            nxy = nxy.resize(new_shape, Image.ANTIALIAS)
+        mosaic = {'elevation': elevation_xy,
+                  'heightfield': exy,
+                  'landcover': np.asarray(cxy)}
+        if self.__normal_map:
+            mosaic['normals'] = np.asarray(nxy)
+        self.__set_back(tile, r, z0, zscale, mosaic, pyramid, missing)
+
+    def __set_back(self, tile, rings, z0, zscale, mosaic, pyramid, missing):
+        """ Create the textures of a mosaic, and make them ready to be shown
+        in the next update()
+        """
+        textures_back = {}
+        stats = {}
+        t0 = time.time()
+        textures_back['heightfield'] = textures.heightfield_texture(
+            'heightfield', mosaic['heightfield'], self.__heightfield_format)
+        stats['heightfield'] = (self.__heightfield_format, time.time() - t0)
+        # With toroidal textures the tiles are written in the texture slots in
+        # update(), and the heightfield is just used to build the mesh
+        if not self.__toroidal:
+            t0 = time.time()
+            textures_back['landcover'] = textures.color_texture(
+                'landcover', mosaic['landcover'], self.__landcover_format,
+                self.__compression)
+            stats['landcover'] = (self.__landcover_format, time.time() - t0)
+        if self.__normal_map and not self.__toroidal:
+            t0 = time.time()
+            textures_back['normals'] = textures.color_texture(
+                'normals', mosaic['normals'])
+            stats['normals'] = ('rgb8', time.time() - t0)
         update_mutex.acquire()
         self.__z0 = z0
         self.__zscale = zscale
-        io.imsave('mapzen/rsc/elevation.png', exy)
-        io.imsave('mapzen/rsc/landcover.png', cxy)
+        self.__textures_back = (textures_back, stats)
+        self.__pyramid_back = pyramid
+        self.__mosaic_back = (mosaic, missing)
         self.__tile_back = np.copy(tile)
+        self.__rings_back = rings
+        self.missing = missing
         # Mark as pending to become updated. The objects should not be updated
         # in a parallel thread, but 
         self.__updated = False
         update_mutex.release()
+        # The new mosaic may take the process beyond the memory budget
+        memory.REGISTRY.set_center((tile[0], tile[1], self.__zoom),
+                                   rings + 1)
+        memory.REGISTRY.enforce()
+
+    def __mosaic_bytes(self):
+        """ Bytes of the shown and pending mosaics, their elevation
+        pyramids, and the work buffers
+        """
+        arrays = list(self.__buffers.values())
+        for m in (self.__mosaic_front, self.__mosaic_back):
+            if m is not None:
+                arrays.extend(m[0].values())
+        for pyramid in (self.pyramid, self.__pyramid_back):
+            if pyramid is not None:
+                arrays.extend((pyramid.min, pyramid.max))
+        return memory.nbytes(*arrays)
+
+    def __texture_bytes(self):
+        """ Bytes of the shown and pending textures RAM images
+        """
+        texs = [self.terrain_node.heightfield, self.landcover_tex,
+                getattr(self, 'normals_tex', None)]
+        if self.__textures_back is not None:
+            texs.extend(self.__textures_back[0].values())
+        if self.__slot_textures is not None:
+            texs.extend(self.__slot_textures.values())
+        seen = set()
+        total = 0
+        for tex in texs:
+            if tex is None or id(tex) in seen:
+                continue
+            seen.add(id(tex))
+            total += tex.get_ram_image_size()
+        return total
+
+    def __snapshot_config(self):
+        """ Generation options which should match to reuse a snapshot
+        """
+        return {'zoom': self.__zoom,
+                'gpu_rocks': self.__gpu_rocks,
+                'normal_map': self.__normal_map,
+                'toroidal': self.__toroidal}
+
+    def save_snapshot(self, folder):
+        """ Save the shown terrain, such that it can be restored in the
+        next session with load_snapshot(). The arrays are saved as numpy
+        files, which can be memory mapped
+
+        Position arguments:
+        folder -- Snapshot folder
+        """
+        update_mutex.acquire()
+        tile_front, mosaic_front = self.__tile_front, self.__mosaic_front
+        orig = self.__orig
+        update_mutex.release()
+        if tile_front is None or mosaic_front is None:
+            return
+        tile, rings, z0, zscale = tile_front
+        mosaic, missing = mosaic_front
+        # The metadata is written the last, invalidating the old arrays first
+        cache.remove(os.path.join(folder, SNAPSHOT_FILE))
+        for name, data in mosaic.items():
+            def write_array(tmp, data=data):
+                with open(tmp, 'wb') as f:
+                    np.save(f, data)
+            cache.save(os.path.join(folder, name + '.npy'), write_array)
+        meta = {'tile': [int(v) for v in tile],
+                'rings': int(rings),
+                'orig': [float(v) for v in orig],
+                'z0': float(z0),
+                'zscale': float(zscale),
+                'missing': [[int(v) for v in t] for t in missing],
+                'arrays': sorted(mosaic.keys()),
+                'config': self.__snapshot_config()}
+        cache.write(os.path.join(folder, SNAPSHOT_FILE), json.dumps(meta))
+
+    def load_snapshot(self, folder):
+        """ Restore the terrain saved by save_snapshot(), if it was saved at
+        the current tile with the same generation options. The terrain is
+        shown in the next update(), and it is generated again in background
+        (if the generator thread is running), such that the tiles changed in
+        the meantime are considered
+
+        Position arguments:
+        folder -- Snapshot folder
+
+        Returned value:
+        True if the snapshot has been restored, False otherwise
+        """
+        fname = os.path.join(folder, SNAPSHOT_FILE)
+        if not cache.is_cached(fname):
+            return False
+        with open(fname, 'r') as f:
+            meta = json.load(f)
+        if self.__tile is None or \
+                list(meta['tile'][:2]) != [int(v) for v in self.__tile[:2]] \
+                or meta['config'] != self.__snapshot_config():
+            return False
+        mosaic = {}
+        for name in meta['arrays']:
+            path = os.path.join(folder, name + '.npy')
+            if not cache.is_cached(path):
+                return False
+            mosaic[name] = np.load(path, mmap_mode='r')
+        if self.__normal_map and 'normals' not in mosaic:
+            return False
+        tile = meta['tile']
+        r = meta.get('rings', 1)
+        k = 2 * r + 1
+        tiles = [[(tx, ty, self.__zoom)
+                  for ty in range(tile[1] - r, tile[1] + r + 1)]
+                 for tx in range(tile[0] - r, tile[0] + r + 1)]
+        n = mosaic['elevation'].shape[0] // k
+        es = [[np.array(mosaic['elevation'][j * n:(j + 1) * n,
+                                            i * n:(i + 1) * n])
+               for j in range(k)] for i in range(k)]
+        missing = set(tuple(t) for t in meta['missing'])
+        pyramid = self.height_pyramid(tiles, es, missing)
+        self.__set_back(tile, r, meta['z0'], meta['zscale'], mosaic, pyramid,
+                        missing)
+        self.__refine_at(time.time())
+        return True
 
 
     def update(self, force=False):
@@ -153,37 +678,190 @@ class Generator(threading.Thread):
             # Nothing to do
             update_mutex.release()
             return
-        tile = self.__tile_back
-        xmin, ymin, _, _ = self.mercator.TileBounds(tile[0] - 1,
-                                                    tile[1] - 1,
+        self.__tile_front = (self.__tile_back, self.__rings_back, self.__z0,
+                             self.__zscale)
+        self.__mosaic_front = self.__mosaic_back
+        self.pyramid = self.__pyramid_back
+        if self.__textures_back is not None:
+            self.__swap_textures(*self.__textures_back)
+            self.__textures_back = None
+        self.terrain_node.generate()
+        self.__place()
+        self.__updated = True
+        update_mutex.release()
+
+    def __swap_textures(self, textures_back, stats):
+        """ Replace the shown textures by the last generated ones. The
+        update mutex should be already acquired
+        """
+        self.terrain_node.heightfield = textures_back['heightfield']
+        if self.__toroidal:
+            self.__write_slots()
+            return
+        self.landcover_tex = textures_back['landcover']
+        self.terrain.set_texture(self.landcover_tex)
+        if self.__normal_map:
+            self.normals_tex = textures_back['normals']
+            self.terrain.set_shader_input("normal_map", self.normals_tex)
+        for name, tex in textures_back.items():
+            fmt, build_time = stats[name]
+            upload_time = None
+            if self.__gsg is not None:
+                upload_time = textures.upload(tex, self.__gsg)
+            self.texture_stats[name] = textures.texture_stats(
+                tex, fmt, build_time, upload_time)
+
+    def __write_slots(self):
+        """ Write the shown tiles which are not in the toroidal textures yet
+        in their slots. The update mutex should be already acquired
+        """
+        tile, r, _, _ = self.__tile_front
+        mosaic, missing = self.__mosaic_front
+        k = 2 * r + 1
+        slots = textures.slot_count(k)
+        layers = [('heights', 'elevation', self.__heightfield_format),
+                  ('landcover', 'landcover', self.__landcover_format)]
+        if self.__normal_map:
+            layers.append(('normals', 'normals', 'rgb8'))
+        n = mosaic['elevation'].shape[0] // k
+        if self.__slot_textures is None or \
+                self.__slot_textures['heights'].get_x_size() != slots * n:
+            self.__slot_textures = {}
+            for name, key, fmt in layers:
+                self.__slot_textures[name] = textures.slot_texture(
+                    name, slots, mosaic[key].shape[0] // k, fmt)
+            self.__slots = {}
+            self.terrain.set_shader_input("terrain_heights",
+                                          self.__slot_textures['heights'])
+            self.landcover_tex = self.__slot_textures['landcover']
+            self.terrain.set_texture(self.landcover_tex)
+            if self.__normal_map:
+                self.normals_tex = self.__slot_textures['normals']
+                self.terrain.set_shader_input("normal_map", self.normals_tex)
+        # The normals, and the rocks computed in the CPU, of the tiles edges
+        # depend on their neighbours, so they are written again next to the
+        # new tiles
+        derived = ['normals'] if self.__normal_map else []
+        if not self.__gpu_rocks:
+            derived.append('landcover')
+        window = [(int(tile[0]) - r + i, int(tile[1]) - r + j, i, j)
+                  for i in range(k) for j in range(k)]
+        new = set(t[:2] for t in window
+                  if self.__slots.get((t[0] % slots, -t[1] % slots)) !=
+                  t[:2])
+        written = dict((name, 0) for name, _, _ in layers)
+        write_time = dict((name, 0.0) for name, _, _ in layers)
+        for tx, ty, i, j in window:
+            t = (tx, ty)
+            # The texture rows are reversed with respect to the tiles y
+            slot = (t[0] % slots, -t[1] % slots)
+            if t in new:
+                names = [name for name, _, _ in layers]
+            elif any((tx + dx, ty + dy) in new
+                     for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+                names = derived
+            else:
+                continue
+            for name, key, fmt in layers:
+                if name not in names:
+                    continue
+                t0 = time.time()
+                m = mosaic[key].shape[0] // k
+                written[name] += textures.write_slot(
+                    self.__slot_textures[name], fmt, slot,
+                    mosaic[key][j * m:(j + 1) * m, i * m:(i + 1) * m])
+                write_time[name] += time.time() - t0
+            # The placeholders should be replaced as soon as the tiles
+            # arrive
+            self.__slots[slot] = None if t + (self.__zoom,) in missing \
+                else t
+        for name, _, fmt in layers:
+            self.texture_stats[name] = textures.texture_stats(
+                self.__slot_textures[name], fmt, write_time[name],
+                written_bytes=written[name])
+
+    def texture_report(self):
+        """ Report the memory usage and the build and upload times of the
+        last generated textures
+
+        Returned value:
+        Report string
+        """
+        return textures.report(self.texture_stats)
+
+    def rebase(self, orig):
+        """ Move the origin of the global coordinates, repositioning the
+        terrain without reloading the textures or regenerating the mesh
+
+        Position arguments:
+        orig -- New origin, in EPSG:900913 coordinates (plus the height)
+        """
+        update_mutex.acquire()
+        self.__orig = np.asarray(orig, dtype=np.float)
+        if self.__tile_front is not None:
+            self.__place()
+        update_mutex.release()
+
+    def __place(self):
+        """ Set the terrain transform from the currently shown tiles and the
+        origin. The update mutex should be already acquired
+        """
+        tile, r, z0, zscale = self.__tile_front
+        xmin, ymin, _, _ = self.mercator.TileBounds(tile[0] - r,
+                                                    tile[1] - r,
                                                     self.__zoom)
-        _, _, xmax, ymax = self.mercator.TileBounds(tile[0] + 1,
-                                                    tile[1] + 1,
+        _, _, xmax, ymax = self.mercator.TileBounds(tile[0] + r,
+                                                    tile[1] + r,
                                                     self.__zoom)
         xmin -= self.__orig[0]
         ymin -= self.__orig[1]
         xmax -= self.__orig[0]
         ymax -= self.__orig[1]
-        self.terrain_node.heightfield.reload()
-        self.landcover_tex.reload()
-        self.terrain_node.generate()
-        self.terrain.set_scale(xmax - xmin, ymax - ymin, self.__zscale)
-        self.terrain.set_pos(xmin, -ymax, self.__z0 - self.__orig[2])
-        self.__updated = True
-        update_mutex.release()
-
+        self.terrain.set_scale(xmax - xmin, ymax - ymin, zscale)
+        self.terrain.set_pos(xmin, -ymax, z0 - self.__orig[2])
+        # Real dimensions, required to compute the normals in the shader
+        heightfield = self.terrain_node.heightfield
+        nx, ny = heightfield.get_x_size(), heightfield.get_y_size()
+        if self.__toroidal and self.__slot_textures is not None:
+            k = 2 * r + 1
+            slots = textures.slot_count(k)
+            nx = ny = self.__slot_textures['heights'].get_x_size() * k // slots
+            # Window of tiles in the texture slots, see __write_slots()
+            self.terrain.set_shader_input(
+                "terrain_uv_offset",
+                Vec2(((tile[0] - r) % slots) / float(slots),
+                     (-(tile[1] + r) % slots) / float(slots)))
+            self.terrain.set_shader_input("terrain_uv_scale",
+                                          k / float(slots))
+            zmin, zmax = textures.SLOT_HEIGHT_RANGE
+            self.terrain.set_shader_input(
+                "terrain_height_map", Vec2((zmax - zmin) / zscale,
+                                           (zmin - z0) / zscale))
+        self.terrain.set_shader_input(
+            "terrain_texel", Vec2((xmax - xmin) / nx, (ymax - ymin) / ny))
+        self.terrain.set_shader_input("terrain_zscale", zscale)
 
     def run(self):
         while not self.__stop.isSet():
             # Check if there is something pe3nding to become updated
             if not self.__updated:
                 continue
-            if self.__tile is not None and np.any(self.__tile != self.__tile_back):
+            if self.__tile is None:
+                pass
+            elif np.any(self.__tile != self.__tile_back):
+                self.__refine_time = None
+                self.generate(self.__tile)
+            elif self.__refine_time is not None and \
+                 time.time() >= self.__refine_time:
+                # Some missing tiles may be available right now
+                self.__refine_time = None
                 self.generate(self.__tile)
             time.sleep(1)
         return
 
     def stop(self):
+        for name in self.__memory:
+            memory.REGISTRY.unregister(name)
         self.__stop.set()
 
     def stopped(self):
@@ -203,8 +881,38 @@ class Generator(threading.Thread):
     def tile(self):
         return self.__tile
 
-    @orig.setter
+    @tile.setter
     def tile(self, tile):
         update_mutex.acquire()
         self.__tile = np.asarray(tile, dtype=np.int)
         update_mutex.release()
+
+    @property
+    def rings(self):
+        return self.__rings
+
+    @rings.setter
+    def rings(self, rings):
+        if rings < 1:
+            raise ValueError('At least 1 ring of tiles should be loaded')
+        if rings != self.__rings:
+            self.__rings = rings
+            self.__refine_at(time.time())
+
+    @property
+    def landcover_size(self):
+        return self.__landcover_size
+
+    @landcover_size.setter
+    def landcover_size(self, size):
+        if size != self.__landcover_size:
+            self.__landcover_size = size
+            self.__refine_at(time.time())
+
+    @property
+    def target_triangle_width(self):
+        return self.terrain_node.target_triangle_width
+
+    @target_triangle_width.setter
+    def target_triangle_width(self, width):
+        self.terrain_node.target_triangle_width = width
@@ -17,18 +17,36 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
 
+import numpy as np
 from direct.task import Task
-from .generator import Generator
+from direct.showbase.MessengerGlobal import messenger
+from panda3d.core import Vec3, ClockObject, PStatCollector
+from . import download
+from . import memory
+from . import spatial
+from .generator import Generator, TILE_TIMEOUT
+from .quality import QualityGovernor
+from .trace import TraceRecorder
 from .globalmaptiles import GlobalMercator
 
 
+REBASE_EVENT = 'mapzen-rebase'
+
+
 class Mapzen():
     def __init__(self, camera, loader, root_node, taskMgr,
-                 tilex, tiley, zoom=14, buildings_zoom=14):
+                 tilex, tiley, zoom=14, buildings_zoom=14,
+                 rebase_distance=None, gpu_rocks=False, normal_map=False,
+                 heightfield_format='r16', landcover_format='rgb8',
+                 landcover_size=None, compression=None, gsg=None,
+                 threaded=True, placeholder='auto',
+                 tile_timeout=TILE_TIMEOUT, snapshot=None, rings=1,
+                 target_fps=None, toroidal=False, trace=None,
+                 memory_budget=None):
         """Mapzen scenario generator. This tool is loading tiles from mapzen,
-        such that 9 tiles are ever shown around the camera position. When the
-        camera is moved out of the tile center, the tool is loading a new set
-        of tiles, and removing the old ones.
+        such that a mosaic of tiles is ever shown around the camera position.
+        When the camera is moved out of the tile center, the tool is loading a
+        new set of tiles, and removing the old ones.
 
         Args:
             camera:         Panda3D camera instance
@@ -46,13 +64,120 @@ class Mapzen():
                             different zoom level can be selected, and the tool
                             will automatically generate buildings along all the
                             tiles required to cover the area required by zoom.
+            rebase_distance: Horizontal distance from the origin at which the
+                            global coordinates are moved to the current tile
+                            center, shifting the camera and the mapzen nodes
+                            back to the origin (floating origin). The
+                            REBASE_EVENT is sent with the applied shift, such
+                            that the application objects can be moved as
+                            well. None to keep a fixed origin.
+            gpu_rocks:      Blend the rocks in the steep areas in the terrain
+                            shader, instead of editing the landcover texture
+                            in the CPU each time the tiles are generated.
+            normal_map:     Bake the terrain normals in a texture each time
+                            the tiles are generated, such that the shader is
+                            sampling it once, instead of computing them from
+                            the heightfield in each fragment.
+            heightfield_format: Heightfield texture format, 'r16' or 'r32f'.
+                            The latter is not quantizing the elevations,
+                            at the cost of doubling the memory.
+            landcover_format: Landcover texture format, 'rgb8' or 'rgb565'.
+            landcover_size: Landcover texture resolution. None to use the
+                            next power of 2 of the tiles resolution.
+            compression:    Landcover texture compression, None, 'dxt1' or
+                            'dxt5'. It is carried out in the generator
+                            thread.
+            gsg:            Graphics state guardian. If provided, the
+                            textures are uploaded as soon as they are
+                            generated, measuring the upload time (see
+                            Generator.texture_report()).
+            threaded:       Generate the tiles in a parallel thread as the
+                            camera moves. If False, the tiles are generated
+                            just when goto() is called, which is useful for
+                            offscreen rendering.
+            placeholder:    What to show while some tiles are not available
+                            yet (e.g. slow or failed downloads): 'flat' for
+                            flat terrain, 'parent' to upsample the nearest
+                            lower zoom tile available in the cache, or None
+                            to wait for all of them. The missing tiles are
+                            refined as soon as they arrive. 'auto' (the
+                            default) is 'flat' when threaded, and None
+                            otherwise, since without the parallel thread the
+                            placeholders would be shown (and e.g.
+                            captured by the snapshots) with no chance to be
+                            refined.
+            tile_timeout:   Maximum time, in seconds, to wait for the tiles
+                            before showing placeholders.
+            snapshot:       Folder where the shown terrain is saved on
+                            stop(). If the next session starts at the same
+                            tile, the terrain is restored from it instead of
+                            generating it, and it is generated again in
+                            background (if threaded). None to disable it.
+            rings:          Number of rings of tiles loaded around the
+                            camera tile, i.e. 1 for 3x3 tiles, 2 for 5x5...
+            target_fps:     Frame rate which should be held by adapting the
+                            terrain quality (mesh triangles width, landcover
+                            resolution and rings of tiles) to the measured
+                            frame time, see QualityGovernor. The quality
+                            settings provided are then overridden. None to
+                            keep them fixed.
+            toroidal:       Store the tiles in wrapped around texture slots,
+                            such that when the camera moves to another tile
+                            just the new tiles are written in the textures,
+                            instead of the whole mosaic. The landcover is
+                            kept at the tiles resolution (landcover_size is
+                            ignored) and cannot be compressed, and the 'r16'
+                            elevations are quantized in a fixed range (see
+                            textures.SLOT_HEIGHT_RANGE), i.e. in steps of
+                            about 0.3 meters. The slots are rounded up to a
+                            power of 2 (4x4 for 1 ring, 8x8 for 2 or 3
+                            rings), so the textures are larger than the
+                            mosaic ones. The whole textures are uploaded
+                            again to the GPU, so the savings are on the CPU
+                            side only.
+            trace:          File where all the tile requests are recorded
+                            (timestamp, layer, tile, hit or miss, latency
+                            and size), to be replayed offline against
+                            different cache settings with
+                            python -m mapzen.trace. None to disable it.
+            memory_budget:  Process memory budget, in bytes. When the
+                            caches and textures exceed it the cached tiles
+                            are evicted, first the far ones and the derived
+                            products, see memory.MemoryRegistry. The memory
+                            usage is also shown in PStats. None for no
+                            limit.
         """
         if not 1 <= zoom <= 15:
             raise ValueError('zoom should be an integer in range [1, 15]')
         self.camera = camera
         self.zoom = zoom
         self.buildings_zoom = buildings_zoom
-        self.generator = Generator(camera, loader, root_node, zoom=zoom)
+        self.rebase_distance = rebase_distance
+        if placeholder == 'auto':
+            placeholder = 'flat' if threaded else None
+        self.generator = Generator(camera, loader, root_node, zoom=zoom,
+                                   gpu_rocks=gpu_rocks,
+                                   normal_map=normal_map,
+                                   heightfield_format=heightfield_format,
+                                   landcover_format=landcover_format,
+                                   landcover_size=landcover_size,
+                                   compression=compression,
+                                   gsg=gsg,
+                                   placeholder=placeholder,
+                                   tile_timeout=tile_timeout,
+                                   rings=rings,
+                                   toroidal=toroidal)
+        self.trace = None
+        if trace is not None:
+            self.trace = TraceRecorder(trace)
+            download.TRACE = self.trace
+        if memory_budget is not None:
+            memory.REGISTRY.budget = memory_budget
+        self.__collectors = {}
+        self.__features_window = None
+        self.quality = None
+        if target_fps is not None:
+            self.quality = QualityGovernor(self.generator, target_fps)
         # Compute the origin for the generator
         self.mercator = GlobalMercator()
         bds = self.mercator.TileBounds(tilex, tiley, zoom)
@@ -64,10 +189,14 @@ class Mapzen():
                                             self.generator.orig[1],
                                             zoom)
         self.generator.tile = tx, ty
-        self.generator.generate((tx, ty))
+        self.snapshot = snapshot
+        self.__stopped = False
+        if snapshot is None or not self.generator.load_snapshot(snapshot):
+            self.generator.generate((tx, ty))
         self.generator.update()
         # Start the threads
-        self.generator.start()
+        if threaded:
+            self.generator.start()
         taskMgr.add(self.update, "mapzen", uponDeath=self.stop)
 
     def update(self, task):
@@ -76,10 +205,277 @@ class Mapzen():
         tx, ty = self.mercator.MetersToTile(x, y, self.zoom)
         self.generator.tile = tx, ty
         self.generator.update()
+        if self.__features_window is not None:
+            self.__request_features(x, y)
+        if self.quality is not None:
+            self.quality.frame(ClockObject.getGlobalClock().getDt())
+        self.__memory_levels()
+        if self.rebase_distance is not None and \
+           self.camera.getPos().getXy().length() > self.rebase_distance:
+            self.rebase(tx, ty)
         return Task.cont
 
+    def __memory_levels(self):
+        """Show the memory usage of each producer in PStats, in MB"""
+        if not PStatCollector('Mapzen memory').is_active():
+            return
+        for name, size in memory.REGISTRY.usage().items():
+            collector = self.__collectors.get(name)
+            if collector is None:
+                collector = PStatCollector('Mapzen memory:' + name)
+                self.__collectors[name] = collector
+            collector.set_level(size / 1048576.0)
+
+    def memory_report(self):
+        """Report the process memory usage, see memory.MemoryRegistry.
+
+        Returns:
+            Report string
+        """
+        return memory.REGISTRY.report()
+
+    def rebase(self, tilex, tiley):
+        """Move the origin of the global coordinates to the center of the
+        provided tile. The camera and the mapzen nodes are shifted in a single
+        pass, keeping the coordinates close to the origin and therefore
+        preserving the floating point precision. The REBASE_EVENT is sent with
+        the shift (Vec3) that should be subtracted from the positions of the
+        objects attached to root_node.
+
+        Args:
+            tilex:          Tile where the new origin should be centered
+            tiley:          Tile where the new origin should be centered
+
+        Returns:
+            The applied shift, in Panda3D coordinates
+        """
+        bds = self.mercator.TileBounds(tilex, tiley, self.zoom)
+        orig = np.asarray([0.5 * (bds[0] + bds[2]),
+                           0.5 * (bds[1] + bds[3]),
+                           self.generator.orig[2]])
+        dx, dy, dz = orig - self.generator.orig
+        # The Y axis is flipped between Panda3D and EPSG:900913
+        shift = Vec3(dx, -dy, dz)
+        self.generator.rebase(orig)
+        self.camera.setPos(self.camera.getPos() - shift)
+        messenger.send(REBASE_EVENT, [shift])
+        return shift
+
+    def goto(self, tilex, tiley):
+        """Synchronously generate the tiles around the provided one, moving
+        the origin to its center. See rebase().
+
+        Args:
+            tilex:          Tile which should be placed at the center
+            tiley:          Tile which should be placed at the center
+
+        Returns:
+            The applied shift, in Panda3D coordinates
+        """
+        self.generator.tile = tilex, tiley
+        self.generator.generate((tilex, tiley))
+        self.generator.update()
+        return self.rebase(tilex, tiley)
+
+    def raycast(self, origins, directions, max_distance=None):
+        """Intersect a batch of rays with the shown terrain, e.g. for mouse
+        picking. The rays are marched along the min/max elevation pyramid,
+        skipping the empty space, such that thousands of rays can be
+        intersected each frame.
+
+        Args:
+            origins:        Array of ray origins, in Panda3D coordinates. A
+                            single origin is shared by all the rays.
+            directions:     Array of ray directions, in Panda3D coordinates.
+                            If they are normalized the ray parameters are
+                            distances.
+            max_distance:   Maximum ray parameter. None to march until the
+                            end of the loaded tiles.
+
+        Returns:
+            Boolean array, True for the rays hitting the terrain, array of ray
+            parameters at the hit (inf for the others), array of hit points
+            (NaN for the others), and boolean array, True for the rays which
+            could not be finished, so it is unknown whether they hit
+        """
+        return self.generator.pyramid.raycast(
+            origins, directions, self.generator.orig, max_t=max_distance)
+
+    def line_of_sight(self, a, b):
+        """Check the visibility between pairs of points. See raycast().
+
+        Args:
+            a:              Array of first points, in Panda3D coordinates
+            b:              Array of second points, in Panda3D coordinates
+
+        Returns:
+            Boolean array, True if the terrain is not in between the points.
+            The unknown ones are considered occluded.
+        """
+        return self.generator.pyramid.line_of_sight(a, b,
+                                                    self.generator.orig)
+
+    def terrain_height(self, points):
+        """Get the terrain height below some positions, e.g. to avoid
+        camera collisions.
+
+        Args:
+            points:         Array of positions, in Panda3D coordinates
+
+        Returns:
+            Array of terrain heights, in Panda3D coordinates. NaN for the
+            positions out of the loaded tiles
+        """
+        return self.generator.pyramid.height(points, self.generator.orig)
+
+    def __to_meters(self, point):
+        """EPSG:900913 coordinates of a Panda3D position"""
+        return (self.generator.orig[0] + point[0],
+                self.generator.orig[1] - point[1])
+
+    def __request_features(self, x, y):
+        """Index in background the vector tiles around a position, i.e.
+        the tile containing it and the surrounding ones"""
+        tx, ty = self.mercator.MetersToTile(x, y, self.buildings_zoom)
+        if self.__features_window == (tx, ty):
+            return
+        self.__features_window = (tx, ty)
+        spatial.request([(i, j, self.buildings_zoom)
+                         for i in range(tx - 1, tx + 2)
+                         for j in range(ty - 1, ty + 2)])
+
+    def __feature_indexes(self, xmin, ymin, xmax, ymax, wait):
+        """Spatial indexes of the vector tiles intersecting a box, in
+        EPSG:900913 coordinates"""
+        if self.__features_window is None:
+            # Start indexing the features around the camera from now on
+            self.__features_window = ()
+            self.__request_features(*self.__to_meters(self.camera.getPos()))
+        z = self.buildings_zoom
+        tx0, ty0 = self.mercator.MetersToTile(xmin, ymin, z)
+        tx1, ty1 = self.mercator.MetersToTile(xmax, ymax, z)
+        indexes = [spatial.tile_index((i, j, z), wait=wait)
+                   for i in range(tx0, tx1 + 1) for j in range(ty0, ty1 + 1)]
+        return [index for index in indexes if index is not None]
+
+    @staticmethod
+    def __unique(found):
+        """Remove the features repeated in several tiles, which have the
+        same layer and id, keeping the first one"""
+        seen = set()
+        result = []
+        for item in found:
+            fid = item[1].get('properties', {}).get('id')
+            if fid is not None:
+                if (item[0], fid) in seen:
+                    continue
+                seen.add((item[0], fid))
+            result.append(item)
+        return result
+
+    def features_in_box(self, a, b, layers=None, wait=False):
+        """Get the OSM features (buildings, roads...) intersecting a box.
+        The vector tiles are indexed the first time they are queried, see
+        spatial.FeatureIndex.
+
+        Args:
+            a:              Corner of the box, in Panda3D coordinates
+            b:              Opposite corner of the box, in Panda3D
+                            coordinates
+            layers:         List of layers, e.g. ['buildings', 'roads'].
+                            None for all the layers.
+            wait:           True to wait for the tiles not indexed yet.
+                            Otherwise they are downloaded and indexed in
+                            background, and just the already indexed ones
+                            are queried.
+
+        Returns:
+            List of (layer, GeoJSON feature) which bounding box intersects
+            the box
+        """
+        (xa, ya), (xb, yb) = self.__to_meters(a), self.__to_meters(b)
+        box = (min(xa, xb), min(ya, yb), max(xa, xb), max(ya, yb))
+        found = []
+        for index in self.__feature_indexes(*(box + (wait,))):
+            found.extend(index.features[i]
+                         for i in index.query_bbox(*(box + (layers,))))
+        return self.__unique(found)
+
+    def features_near(self, point, radius, layers=None, wait=False):
+        """Get the OSM features closer than a distance to a position, e.g.
+        the buildings around the camera. See features_in_box().
+
+        Args:
+            point:          Position, in Panda3D coordinates
+            radius:         Distance, in Panda3D units (meters)
+            layers:         List of layers. None for all the layers.
+            wait:           True to wait for the tiles not indexed yet.
+
+        Returns:
+            List of (layer, GeoJSON feature, distance), sorted by distance.
+            The distance is measured in the horizontal plane, being 0 inside
+            the polygons.
+        """
+        x, y = self.__to_meters(point)
+        found = []
+        for index in self.__feature_indexes(x - radius, y - radius,
+                                            x + radius, y + radius, wait):
+            ids, dists = index.query_radius(x, y, radius, layers)
+            found.extend(index.features[i] + (d,) for i, d in zip(ids, dists))
+        found.sort(key=lambda item: item[2])
+        return self.__unique(found)
+
+    def nearest_feature(self, point, layers=None, max_distance=None,
+                        wait=False):
+        """Get the OSM feature closest to a position, e.g. the nearest road.
+        See features_in_box().
+
+        Args:
+            point:          Position, in Panda3D coordinates
+            layers:         List of layers. None for all the layers.
+            max_distance:   Maximum distance, in Panda3D units (meters).
+                            None to look in the tiles around the position.
+            wait:           True to wait for the tiles not indexed yet.
+
+        Returns:
+            (layer, GeoJSON feature, distance), None if there are no features
+        """
+        x, y = self.__to_meters(point)
+        if max_distance is None:
+            tx, ty = self.mercator.MetersToTile(x, y, self.buildings_zoom)
+            xmin, ymin, _, _ = self.mercator.TileBounds(
+                tx - 1, ty - 1, self.buildings_zoom)
+            _, _, xmax, ymax = self.mercator.TileBounds(
+                tx + 1, ty + 1, self.buildings_zoom)
+        else:
+            xmin, ymin = x - max_distance, y - max_distance
+            xmax, ymax = x + max_distance, y + max_distance
+        best = None
+        for index in self.__feature_indexes(xmin, ymin, xmax, ymax, wait):
+            i, d = index.nearest(x, y, layers, max_distance)
+            if i is not None and (best is None or d < best[2]):
+                best = index.features[i] + (d,)
+        return best
+
+    @property
+    def quality_level(self):
+        """Current terrain quality level, None if it is not adapted to the
+        frame rate (see target_fps)"""
+        if self.quality is None:
+            return None
+        return self.quality.level
+
     def stop(self):
+        if self.__stopped:
+            return
+        self.__stopped = True
         self.generator.stop()
+        if self.trace is not None:
+            if download.TRACE is self.trace:
+                download.TRACE = None
+            self.trace.close()
+        if self.snapshot is not None:
+            self.generator.save_snapshot(self.snapshot)
 
     def __del__(self):
         self.stop()
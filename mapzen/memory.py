@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Process memory accounting. The caches and the textures producers report
+# their bytes to REGISTRY, which evicts the caches when the budget is exceeded
+
+import threading
+import numpy as np
+
+
+# Kinds of memory, in eviction order. The fixed memory (shown textures,
+# mosaics, work buffers...) is accounted, but never evicted
+DERIVED = 'derived'
+RAW = 'raw'
+FIXED = 'fixed'
+KINDS = (DERIVED, RAW, FIXED)
+
+
+def nbytes(*arrays):
+    """ Count the bytes of some arrays, considering just once the arrays
+    repeated, and ignoring the None ones
+    """
+    seen = set()
+    total = 0
+    for a in arrays:
+        if a is None or id(a) in seen:
+            continue
+        seen.add(id(a))
+        total += np.asarray(a).nbytes
+    return total
+
+
+class MemoryRegistry(object):
+    def __init__(self, budget=None):
+        """Central memory accounting. Each producer registers a function
+        reporting its bytes, and the evictable caches a function to release
+        them as well. When the total exceeds the budget the caches are evicted
+        in priority order: first the tiles far from the shown ones (of all the
+        caches), then the derived products (e.g. normal maps or elevation
+        pyramids, which can be computed again), and finally the raw data
+        (e.g. decoded or downloaded tiles)
+
+        Keyword arguments:
+        budget -- Process memory budget, in bytes. None for no limit
+        """
+        self.budget = budget
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.__lock = threading.Lock()
+        self.__enforcing = threading.Lock()
+        # name -> (kind, size function, evict function)
+        self.__producers = {}
+        self.__center = None
+        # True if the budget cannot be met, to warn just once
+        self.__overflow = False
+
+    def register(self, name, size, evict=None, kind=DERIVED):
+        """ Register a memory producer
+
+        Position arguments:
+        name -- Name of the producer. A suffix is appended if it is already
+                registered
+        size -- Function returning the bytes currently used
+
+        Keyword arguments:
+        evict -- Function called as evict(nbytes, keep), which should release
+                 at least nbytes if possible, and return the released bytes.
+                 keep is a function of a tile (tilex, tiley), returning True
+                 if it is near the shown ones, so it should not be evicted
+                 yet, or None to evict any tile. None if the producer cannot
+                 release memory
+        kind -- DERIVED, RAW or FIXED. It is forced to FIXED if no evict
+                function is provided
+
+        Returned value:
+        The registered name, to unregister it
+        """
+        if kind not in KINDS:
+            raise ValueError('Unknown memory kind {}'.format(kind))
+        if evict is None:
+            kind = FIXED
+        self.__lock.acquire()
+        key, i = name, 1
+        while key in self.__producers:
+            i += 1
+            key = '{}-{}'.format(name, i)
+        self.__producers[key] = (kind, size, evict)
+        self.__lock.release()
+        return key
+
+    def unregister(self, name):
+        self.__lock.acquire()
+        self.__producers.pop(name, None)
+        self.__lock.release()
+
+    def set_center(self, tile, radius=1):
+        """ Set the shown tiles, used to decide which ones are far
+
+        Position arguments:
+        tile -- Center tile, (tilex, tiley) or (tilex, tiley, zoom)
+
+        Keyword arguments:
+        radius -- Number of rings of tiles around the center one which are
+                  not considered far
+        """
+        zoom = int(tile[2]) if len(tile) > 2 else None
+        self.__center = (int(tile[0]), int(tile[1]), radius, zoom)
+
+    def near(self, tile):
+        """ Check if a tile is near the shown ones, see set_center()
+
+        Position arguments:
+        tile -- Tile, (tilex, tiley) or (tilex, tiley, zoom). The tiles of
+                a finer zoom level than the center one are compared with the
+                tile containing them, and the tiles of a coarser zoom level
+                are near if any of their subtiles is near
+
+        Returned value:
+        True if the tile is near, or the shown tiles are unknown. False
+        otherwise
+        """
+        center = self.__center
+        if center is None:
+            return True
+        cx, cy, radius, zoom = center
+        x, y = int(tile[0]), int(tile[1])
+        if len(tile) < 3 or zoom is None or int(tile[2]) == zoom:
+            return max(abs(x - cx), abs(y - cy)) <= radius
+        dz = int(tile[2]) - zoom
+        if dz > 0:
+            return max(abs((x >> dz) - cx), abs((y >> dz) - cy)) <= radius
+        # Subtiles range of the coarser tile
+        x0, y0 = x << -dz, y << -dz
+        x1, y1 = ((x + 1) << -dz) - 1, ((y + 1) << -dz) - 1
+        return (x0 <= cx + radius and x1 >= cx - radius and
+                y0 <= cy + radius and y1 >= cy - radius)
+
+    def __items(self):
+        self.__lock.acquire()
+        items = list(self.__producers.items())
+        self.__lock.release()
+        return items
+
+    def usage(self):
+        """ Get the bytes used by each producer
+
+        Returned value:
+        Dictionary with the bytes of each producer name
+        """
+        return dict((name, size()) for name, (_, size, _) in self.__items())
+
+    def total(self):
+        return sum(self.usage().values())
+
+    def enforce(self):
+        """ Evict the caches until the total bytes are within the budget. If
+        the fixed memory alone exceeds the budget nothing is evicted (which
+        would just wipe the caches at each generation), and a warning is
+        printed instead
+
+        Returned value:
+        The released bytes
+        """
+        if self.budget is None:
+            return 0
+        # A single eviction at a time, the others can just skip it
+        if not self.__enforcing.acquire(False):
+            return 0
+        try:
+            items = [(name, kind, size(), evict)
+                     for name, (kind, size, evict) in self.__items()]
+            excess = sum(item[2] for item in items) - self.budget
+            if excess <= 0:
+                self.__overflow = False
+                return 0
+            evictable = sum(item[2] for item in items if item[1] != FIXED)
+            if evictable < excess:
+                if not self.__overflow:
+                    fixed = sum(item[2] for item in items if item[1] == FIXED)
+                    print("Memory budget of {:.1f} MB cannot be met, {:.1f} MB"
+                          " are not evictable".format(self.budget / 1048576.0,
+                                                      fixed / 1048576.0))
+                self.__overflow = True
+                return 0
+            self.__overflow = False
+            freed = 0
+            stages = [(DERIVED, self.near), (RAW, self.near),
+                      (DERIVED, None), (RAW, None)]
+            for kind, keep in stages:
+                for name, k, _, evict in items:
+                    if freed >= excess:
+                        break
+                    if k == kind:
+                        freed += evict(excess - freed, keep)
+            if freed > 0:
+                self.evictions += 1
+                self.evicted_bytes += freed
+            return freed
+        finally:
+            self.__enforcing.release()
+
+    def metrics(self):
+        """ Get the memory usage
+
+        Returned value:
+        Dictionary with the bytes of each producer, the total bytes of each
+        kind, the total bytes, the budget, and the number of evictions and
+        evicted bytes
+        """
+        usage, kinds = {}, dict((kind, 0) for kind in KINDS)
+        for name, (kind, size, _) in self.__items():
+            usage[name] = size()
+            kinds[kind] += usage[name]
+        return {'producers': usage,
+                'kinds': kinds,
+                'total': sum(usage.values()),
+                'budget': self.budget,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes}
+
+    def report(self):
+        """ Pretty format the memory usage
+
+        Returned value:
+        Report string
+        """
+        m = self.metrics()
+        budget = '-' if m['budget'] is None else \
+            '{:.1f} MB'.format(m['budget'] / 1048576.0)
+        lines = ['total {:.1f} MB, budget {}, {} evictions ({:.1f} MB)'.format(
+            m['total'] / 1048576.0, budget, m['evictions'],
+            m['evicted_bytes'] / 1048576.0)]
+        for name in sorted(m['producers'].keys()):
+            lines.append('{}: {:.2f} MB'.format(
+                name, m['producers'][name] / 1048576.0))
+        return '\n'.join(lines)
+
+
+# The process registry
+REGISTRY = MemoryRegistry()
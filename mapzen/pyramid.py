@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import numpy as np
+from PIL import Image
+from .download import CACHE_PATH, decode_elevation, encode_elevation, \
+    _valid_image
+from . import cache
+
+
+LAYERS = ('terrarium', 'terrain-background')
+REDUCTIONS = ('mean', 'max', 'min')
+
+
+def _tile_file(layer, tile):
+    return CACHE_PATH + layer + "/{}/{}/{}.png".format(
+        int(tile[2]), int(tile[0]), int(tile[1]))
+
+
+def block_reduce(data, reduction='mean'):
+    """ Reduce an image to the half of its resolution, combining each 2x2
+    block of pixels
+
+    Position arguments:
+    data -- Image, with the pixels in the first 2 dimensions
+
+    Keyword arguments:
+    reduction -- 'mean', 'max' or 'min'
+
+    Returned value:
+    Reduced image
+    """
+    n, m = data.shape[0] // 2, data.shape[1] // 2
+    blocks = data.reshape((n, 2, m, 2) + data.shape[2:])
+    if reduction == 'max':
+        return blocks.max(axis=3).max(axis=1)
+    if reduction == 'min':
+        return blocks.min(axis=3).min(axis=1)
+    return blocks.mean(axis=3).mean(axis=1)
+
+
+def build_tile(layer, tile, reduction='mean', force=False):
+    """ Build a tile from its 4 children of the next zoom level, which should
+    be already cached
+
+    Position arguments:
+    layer -- 'terrarium' or 'terrain-background'
+    tile -- Tuple of 3 values, tilex, tiley and zoom
+
+    Keyword arguments:
+    reduction -- Elevations reduction, 'mean', 'max' or 'min'. The landcover
+                 is ever reduced with the mean
+    force -- True to build the tile even though it is already cached
+
+    Returned value:
+    True if the tile has been built, False if it was already cached, None if
+    some children are missing
+    """
+    img_file = _tile_file(layer, tile)
+    if not force and cache.is_cached(img_file, _valid_image):
+        return False
+    tx, ty, zoom = int(tile[0]), int(tile[1]), int(tile[2])
+    rows = []
+    for cy in (2 * ty, 2 * ty + 1):
+        row = []
+        for cx in (2 * tx, 2 * tx + 1):
+            child_file = _tile_file(layer, (cx, cy, zoom + 1))
+            # The files cached before the records existed are validated
+            if not cache.is_cached(child_file, _valid_image):
+                return None
+            pic = Image.open(child_file)
+            if layer == 'terrarium':
+                row.append(decode_elevation(pic))
+            else:
+                row.append(np.array(pic.convert('RGB')))
+        rows.append(np.concatenate(row, axis=1))
+    data = np.concatenate(rows, axis=0)
+    if layer == 'terrarium':
+        pic = encode_elevation(block_reduce(data, reduction))
+    else:
+        data = np.round(block_reduce(data.astype(np.float)))
+        pic = Image.fromarray(data.astype(np.uint8), mode='RGB')
+    cache.save(img_file, lambda fname: pic.save(fname, format='PNG'))
+    return True
+
+
+def _build_tile(args):
+    return build_tile(*args)
+
+
+def build(tilesx, tilesy, zoom, levels, reduction='mean', force=False,
+          processes=None):
+    """ Build the lower zoom levels of a region already seeded at a zoom
+    level, without downloading anything
+
+    Position arguments:
+    tilesx -- List of x tile values, at the seeded zoom level
+    tilesy -- List of y tile values, at the seeded zoom level
+    zoom -- Seeded zoom level
+    levels -- Number of lower zoom levels to build
+
+    Keyword arguments:
+    reduction -- Elevations reduction, 'mean', 'max' or 'min'
+    force -- True to build the tiles even though they are already cached
+    processes -- Number of parallel processes, None to use all the cores
+
+    Returned value:
+    Number of built tiles, and list of tiles that could not be built because
+    some of their children are missing
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError('Unknown reduction {}'.format(reduction))
+    # Imported here, so the raycasts are not loading it
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    built = 0
+    incomplete = []
+    tilesx = sorted(set(tilesx))
+    tilesy = sorted(set(tilesy))
+    try:
+        for z in range(zoom - 1, max(zoom - levels, 0) - 1, -1):
+            tilesx = sorted(set(tx // 2 for tx in tilesx))
+            tilesy = sorted(set(ty // 2 for ty in tilesy))
+            jobs = [(layer, (tx, ty, z), reduction, force)
+                    for layer in LAYERS for tx in tilesx for ty in tilesy]
+            for job, result in zip(jobs, pool.map(_build_tile, jobs)):
+                if result:
+                    built += 1
+                elif result is None:
+                    incomplete.append((job[0],) + job[1])
+    finally:
+        pool.close()
+        pool.join()
+    return built, incomplete
+
+
+if __name__ == "__main__":
+    # Call this script with the following command:
+    # python -m mapzen.pyramid zoom startx endx starty endy levels [reduction]
+    # where:
+    # zoom is the seeded zoom level
+    # startx is the first x tile seeded
+    # endx is the last x tile seeded
+    # starty is the first y tile seeded
+    # endy is the last y tile seeded
+    # levels is the number of lower zoom levels to build
+    # reduction is mean (default), max or min, for the elevation
+    if len(sys.argv) not in (7, 8):
+        raise ValueError('Wrong number of arguments')
+    zoom = int(sys.argv[1])
+    tilesx = list(range(int(sys.argv[2]), int(sys.argv[3]) + 1))
+    tilesy = list(range(int(sys.argv[4]), int(sys.argv[5]) + 1))
+    levels = int(sys.argv[6])
+    reduction = sys.argv[7] if len(sys.argv) > 7 else 'mean'
+    built, incomplete = build(tilesx, tilesy, zoom, levels, reduction)
+    for tile in incomplete:
+        print("Missing children of {}/{}/{}/{}".format(*tile))
+    print("{} tiles built".format(built))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+
+
+# Quality levels, from the lowest to the highest one, as tuples of terrain
+# mesh triangles width (pixels), landcover texture size (None for the tiles
+# resolution) and rings of tiles loaded around the center one
+QUALITY_LEVELS = ((40.0, 512, 1),
+                  (20.0, 1024, 1),
+                  (10.0, None, 1),
+                  (10.0, None, 2),
+                  (5.0, None, 2))
+# Level matching the Generator defaults
+DEFAULT_LEVEL = 2
+# Number of frames averaged to measure the frame time
+WINDOW_FRAMES = 60
+# Relative deviation of the frame time from the target one before changing
+# the quality
+HYSTERESIS = 0.15
+# Time, in seconds, to wait after a quality change before measuring again,
+# letting the new tiles be generated
+COOLDOWN = 2.0
+# Maximum factor applied to the cooldown when the quality oscillates
+MAX_BACKOFF = 16.0
+
+
+class QualityGovernor(object):
+    def __init__(self, generator, target_fps=60.0, levels=QUALITY_LEVELS,
+                 level=DEFAULT_LEVEL, window=WINDOW_FRAMES,
+                 hysteresis=HYSTERESIS, cooldown=COOLDOWN):
+        """Adapt the terrain quality to hold a target frame rate. The frame
+        time is averaged along a rolling window of frames, and the quality is
+        lowered if it is larger than the target one, or raised if it is
+        smaller. A dead band around the target frame time, and a cooldown
+        after each change (which is doubled each time the quality is lowered
+        right after raising it), avoid oscillating between two levels.
+
+        Position arguments:
+        generator -- Generator which quality is controlled
+
+        Keyword arguments:
+        target_fps -- Target frame rate
+        levels -- List of quality levels, see QUALITY_LEVELS
+        level -- Starting quality level
+        window -- Number of frames averaged
+        hysteresis -- Relative dead band around the target frame time
+        cooldown -- Time, in seconds, without changes after each change
+        """
+        if not 0 <= level < len(levels):
+            raise ValueError('Invalid quality level {}'.format(level))
+        self.generator = generator
+        self.target = 1.0 / target_fps
+        self.levels = levels
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.changes = 0
+        self.__frames = deque(maxlen=window)
+        self.__wait = 0.0
+        self.__penalty = 1.0
+        self.__raised = False
+        self.__level = level
+        self.__apply()
+
+    def __apply(self):
+        """ Set the current quality level in the generator
+        """
+        width, landcover_size, rings = self.levels[self.__level]
+        self.generator.target_triangle_width = width
+        self.generator.landcover_size = landcover_size
+        self.generator.rings = rings
+
+    def frame(self, dt):
+        """ Register a frame, changing the quality if required
+
+        Position arguments:
+        dt -- Frame time, in seconds
+
+        Returned value:
+        The quality level
+        """
+        if self.__wait > 0.0:
+            self.__wait -= dt
+            return self.__level
+        self.__frames.append(dt)
+        if len(self.__frames) < self.__frames.maxlen:
+            return self.__level
+        frame_time = self.frame_time
+        if frame_time > self.target * (1.0 + self.hysteresis):
+            if self.__level > 0:
+                # Lowering right after raising, wait longer the next time
+                self.__penalty = min(2.0 * self.__penalty, MAX_BACKOFF) \
+                    if self.__raised else 1.0
+                self.__raised = False
+                self.__change(self.__level - 1)
+        elif frame_time < self.target * (1.0 - self.hysteresis):
+            if self.__level < len(self.levels) - 1:
+                self.__raised = True
+                self.__change(self.__level + 1, self.__penalty)
+        return self.__level
+
+    def __change(self, level, penalty=1.0):
+        """ Move to another quality level, restarting the measures
+        """
+        self.__level = level
+        self.__apply()
+        self.__frames.clear()
+        self.__wait = self.cooldown * penalty
+        self.changes += 1
+
+    @property
+    def level(self):
+        return self.__level
+
+    @level.setter
+    def level(self, level):
+        if not 0 <= level < len(self.levels):
+            raise ValueError('Invalid quality level {}'.format(level))
+        self.__change(level)
+
+    @property
+    def frame_time(self):
+        """Average frame time along the window, None if there are no frames
+        yet"""
+        if not self.__frames:
+            return None
+        return sum(self.__frames) / len(self.__frames)
+
+    def metrics(self):
+        """ Get the current quality level and frame time
+
+        Returned value:
+        Dictionary with the quality level (and the number of levels), its
+        settings, the averaged frame time and rate, the target frame time and
+        the number of quality changes
+        """
+        width, landcover_size, rings = self.levels[self.__level]
+        frame_time = self.frame_time
+        return {'level': self.__level,
+                'levels': len(self.levels),
+                'target_triangle_width': width,
+                'landcover_size': landcover_size,
+                'rings': rings,
+                'frame_time': frame_time,
+                'fps': 1.0 / frame_time if frame_time else None,
+                'target_frame_time': self.target,
+                'changes': self.changes}
+
+    def report(self):
+        """ Report the quality level and frame rate
+
+        Returned value:
+        Report string
+        """
+        m = self.metrics()
+        fps = '-' if m['fps'] is None else '{:.1f}'.format(m['fps'])
+        return 'quality {}/{} (triangle width {}, landcover {}, rings {}), ' \
+               'fps {} (target {:.1f}), {} changes'.format(
+                   m['level'], m['levels'] - 1, m['target_triangle_width'],
+                   m['landcover_size'] or 'auto', m['rings'], fps,
+                   1.0 / m['target_frame_time'], m['changes'])
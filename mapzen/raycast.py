@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from .pyramid import block_reduce
+
+
+# Maximum number of traversal steps of each ray, per texel of the mosaic size
+STEPS_PER_TEXEL = 4
+# Distance the rays are moved forward when leaving a cell, in texels
+CELL_EPS = 1e-4
+
+
+def tile_levels(data):
+    """ Compute the min/max pyramid of a tile elevation
+
+    Position arguments:
+    data -- Square elevation array, with a power of 2 size
+
+    Returned value:
+    List of (min, max) arrays, from the tile resolution down to a single
+    texel
+    """
+    n = data.shape[0]
+    if data.shape[1] != n or n & (n - 1):
+        raise ValueError('The tiles should be square with power of 2 size')
+    data = np.asarray(data, dtype=np.float32)
+    levels = [(data, data)]
+    while levels[-1][0].shape[0] > 1:
+        lmin, lmax = levels[-1]
+        levels.append((block_reduce(lmin, 'min'), block_reduce(lmax, 'max')))
+    return levels
+
+
+class HeightPyramid(object):
+    def __init__(self, tiles, xmin, ymin, res):
+        """Hierarchical min/max elevation pyramid of the tiles mosaic,
+        used to march rays on the terrain skipping the empty space. The
+        mosaic is padded to a power of 2 number of tiles, such that the
+        pyramid is composed from the pyramid of each tile, which can be
+        reused when the tiles window is shifted.
+
+        Position arguments:
+        tiles -- Square list of tile pyramids (see tile_levels()), with the
+                 same layout than the generator tiles, i.e. tiles[i][j] is
+                 the tile i along x and j along y
+        xmin -- Minimum x of the mosaic, in EPSG:900913 coordinates
+        ymin -- Minimum y of the mosaic, in EPSG:900913 coordinates
+        res -- Texel size, in meters
+        """
+        nx, ny = len(tiles), len(tiles[0])
+        n = tiles[0][0][0][0].shape[0]
+        m = 1 << (max(nx, ny) - 1).bit_length()
+        self.xmin, self.ymin, self.res = xmin, ymin, res
+        self.nu, self.nv = nx * n, ny * n
+        self.size = m * n
+        lmins, lmaxs = [], []
+        for k in range(len(tiles[0][0])):
+            s = n >> k
+            # The padding never stops the rays
+            lmin = np.full((m * s, m * s), np.inf, dtype=np.float32)
+            lmax = np.full((m * s, m * s), -np.inf, dtype=np.float32)
+            for i in range(nx):
+                for j in range(ny):
+                    tmin, tmax = tiles[i][j][k]
+                    lmin[j * s:(j + 1) * s, i * s:(i + 1) * s] = tmin
+                    lmax[j * s:(j + 1) * s, i * s:(i + 1) * s] = tmax
+            lmins.append(lmin)
+            lmaxs.append(lmax)
+        while lmins[-1].shape[0] > 1:
+            lmins.append(block_reduce(lmins[-1], 'min'))
+            lmaxs.append(block_reduce(lmaxs[-1], 'max'))
+        self.top = len(lmaxs) - 1
+        # Flattened levels, so the rays at different levels are looked up at
+        # once
+        self.offsets = np.cumsum([0] + [l.size for l in lmaxs[:-1]])
+        self.min = np.concatenate([l.ravel() for l in lmins])
+        self.max = np.concatenate([l.ravel() for l in lmaxs])
+
+    def __grid(self, points, orig):
+        """ Transform Panda3D positions into texel coordinates (plus the
+        elevation)
+        """
+        p = np.asarray(points, dtype=np.float)
+        u = (p[..., 0] + orig[0] - self.xmin) / self.res
+        v = (orig[1] - p[..., 1] - self.ymin) / self.res
+        return u, v, p[..., 2] + orig[2]
+
+    def height(self, points, orig=(0.0, 0.0, 0.0)):
+        """ Get the terrain elevation below some positions
+
+        Position arguments:
+        points -- Array of positions, in Panda3D coordinates. Just x and y
+                  are considered
+
+        Keyword arguments:
+        orig -- Origin of the Panda3D coordinates, see Generator.orig
+
+        Returned value:
+        Array of elevations, in Panda3D coordinates. NaN for the positions
+        out of the mosaic
+        """
+        points = np.asarray(points, dtype=np.float)
+        u, v, _ = self.__grid(np.concatenate(
+            (points[..., :2], np.zeros(points.shape[:-1] + (1,))), axis=-1),
+            orig)
+        inside = (u >= 0) & (u < self.nu) & (v >= 0) & (v < self.nv)
+        iu = np.clip(np.floor(u), 0, self.nu - 1).astype(np.int)
+        iv = np.clip(np.floor(v), 0, self.nv - 1).astype(np.int)
+        z = self.max[iv * self.size + iu] - orig[2]
+        return np.where(inside, z, np.nan)
+
+    def raycast(self, origins, directions, orig=(0.0, 0.0, 0.0),
+                max_t=None, max_steps=None):
+        """ Intersect a batch of rays with the terrain. The terrain texels are
+        considered as flat columns
+
+        Position arguments:
+        origins -- Array of ray origins, in Panda3D coordinates
+        directions -- Array of ray directions, in Panda3D coordinates. A
+                      single origin or direction is broadcasted to all the
+                      rays
+
+        Keyword arguments:
+        orig -- Origin of the Panda3D coordinates, see Generator.orig
+        max_t -- Maximum ray parameter, in units of the direction vectors.
+                 None to march until the mosaic end
+        max_steps -- Maximum number of traversal steps. None to allow
+                     STEPS_PER_TEXEL steps per texel of the mosaic size,
+                     which is enough for any ray crossing it
+
+        Returned value:
+        Boolean array, True for the rays hitting the terrain, array of ray
+        parameters at the hit (inf for the others), array of hit points
+        (NaN for the others), and boolean array, True for the rays not
+        finished within max_steps, which are neither hits nor misses
+        """
+        if max_steps is None:
+            max_steps = STEPS_PER_TEXEL * max(self.nu, self.nv)
+        origins = np.atleast_2d(np.asarray(origins, dtype=np.float))
+        directions = np.atleast_2d(np.asarray(directions, dtype=np.float))
+        origins, directions = np.broadcast_arrays(origins, directions)
+        n = len(origins)
+        gu, gv, gz = self.__grid(origins, orig)
+        du = directions[:, 0] / self.res
+        dv = -directions[:, 1] / self.res
+        dz = directions[:, 2]
+        # Clip the rays to the mosaic
+        t0 = np.zeros(n)
+        t1 = np.full(n, np.inf if max_t is None else float(max_t))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for p, dp, size in ((gu, du, self.nu), (gv, dv, self.nv)):
+                ta = -p / dp
+                tb = (size - p) / dp
+                parallel = dp == 0
+                inside = (p >= 0) & (p < size)
+                lo = np.where(parallel, np.where(inside, -np.inf, np.inf),
+                              np.minimum(ta, tb))
+                hi = np.where(parallel, np.where(inside, np.inf, -np.inf),
+                              np.maximum(ta, tb))
+                t0 = np.maximum(t0, lo)
+                t1 = np.minimum(t1, hi)
+            eps = CELL_EPS / np.maximum(np.maximum(np.abs(du), np.abs(dv)),
+                                        1e-12)
+        t = t0
+        level = np.full(n, self.top, dtype=np.int)
+        hit = np.zeros(n, dtype=np.bool)
+        active = t0 < t1
+        steps = 0
+        while steps < max_steps and np.any(active):
+            steps += 1
+            idx = np.nonzero(active)[0]
+            tt, lv = t[idx], level[idx]
+            c = (1 << lv).astype(np.float)
+            size = self.size >> lv
+            pu = gu[idx] + tt * du[idx]
+            pv = gv[idx] + tt * dv[idx]
+            iu = np.clip(np.floor(pu / c), 0, size - 1)
+            iv = np.clip(np.floor(pv / c), 0, size - 1)
+            # Cell exit point
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tu = (np.where(du[idx] > 0, iu + 1, iu) * c - pu) / du[idx]
+                tv = (np.where(dv[idx] > 0, iv + 1, iv) * c - pv) / dv[idx]
+            tu[du[idx] == 0] = np.inf
+            tv[dv[idx] == 0] = np.inf
+            t_exit = np.minimum(tt + np.minimum(tu, tv), t1[idx])
+            z_enter = gz[idx] + tt * dz[idx]
+            with np.errstate(invalid='ignore'):
+                z_low = np.minimum(z_enter, gz[idx] + t_exit * dz[idx])
+            cell = self.offsets[lv] + (iv * size + iu).astype(np.int)
+            top = self.max[cell]
+            # The ray is above the cell, move to the next one, going up
+            skip = z_low > top
+            s = idx[skip]
+            t[s] = t_exit[skip] + eps[s]
+            level[s] = np.minimum(lv[skip] + 1, self.top)
+            active[s[t[s] >= t1[s]]] = False
+            # The ray may hit the cell, look at its children
+            down = ~skip & (lv > 0)
+            level[idx[down]] -= 1
+            # Hitting a texel column
+            found = ~skip & (lv == 0)
+            f = idx[found]
+            zf, ze = top[found], z_enter[found]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t[f] = np.where(ze <= zf, tt[found],
+                                tt[found] + (zf - ze) / dz[f])
+            hit[f] = True
+            active[f] = False
+        t = np.where(hit, t, np.inf)
+        with np.errstate(invalid='ignore'):
+            points = np.where(hit[:, None],
+                              origins + t[:, None] * directions, np.nan)
+        return hit, t, points, active
+
+    def line_of_sight(self, a, b, orig=(0.0, 0.0, 0.0)):
+        """ Check the visibility between pairs of points
+
+        Position arguments:
+        a -- Array of first points, in Panda3D coordinates
+        b -- Array of second points, in Panda3D coordinates
+
+        Keyword arguments:
+        orig -- Origin of the Panda3D coordinates, see Generator.orig
+
+        Returned value:
+        Boolean array, True if the terrain is not in between the points. The
+        rays not finished (see raycast()) are considered occluded
+        """
+        a = np.asarray(a, dtype=np.float)
+        hit, _, _, unknown = self.raycast(
+            a, np.asarray(b, dtype=np.float) - a, orig, max_t=1.0)
+        return ~(hit | unknown)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from .globalmaptiles import GlobalMercator
+
+
+mercator = GlobalMercator()
+# Polar areas are clipped off by the spherical mercator projection
+MAX_LAT = 85.05112878
+
+
+def tile_range(bbox, zoom):
+    """ Get the tiles covering a latitude/longitude bounding box
+
+    Position arguments:
+    bbox -- Bounding box, (lat_min, lon_min, lat_max, lon_max)
+    zoom -- Zoom level
+
+    Returned value:
+    First and last x tiles, and first and last y tiles
+    """
+    mxmin, mymin = mercator.LatLonToMeters(max(bbox[0], -MAX_LAT), bbox[1])
+    mxmax, mymax = mercator.LatLonToMeters(min(bbox[2], MAX_LAT), bbox[3])
+    txmin, tymin = mercator.MetersToTile(mxmin, mymin, zoom)
+    txmax, tymax = mercator.MetersToTile(mxmax, mymax, zoom)
+    n = (1 << zoom) - 1
+    return (max(txmin, 0), min(txmax, n), max(tymin, 0), min(tymax, n))
+
+
+def inside_polygon(x, y, xs, ys):
+    """ Vectorized even-odd test of points inside a polygon
+
+    Position arguments:
+    x -- Points x coordinates array
+    y -- Points y coordinates array
+    xs -- Polygon vertices x coordinates
+    ys -- Polygon vertices y coordinates
+
+    Returned value:
+    Boolean array, True for the points inside the polygon
+    """
+    inside = np.zeros(np.shape(x), dtype=np.bool)
+    j = len(xs) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(len(xs)):
+            crossing = (ys[i] > y) != (ys[j] > y)
+            xc = (xs[j] - xs[i]) * (y - ys[i]) / (ys[j] - ys[i]) + xs[i]
+            inside ^= crossing & (x < xc)
+            j = i
+    return inside
+
+
+def edge_tiles(xs, ys, zoom):
+    """ Get the tiles crossed by the edges of a polygon
+
+    Position arguments:
+    xs -- Polygon vertices x coordinates
+    ys -- Polygon vertices y coordinates
+    zoom -- Zoom level
+
+    Returned value:
+    Set of tiles, (tilex, tiley)
+    """
+    res = mercator.Resolution(zoom) * mercator.tileSize
+    # Coordinates in tiles units
+    us = (np.asarray(xs, dtype=np.float) + mercator.originShift) / res
+    vs = (np.asarray(ys, dtype=np.float) + mercator.originShift) / res
+    tiles = set()
+    j = len(us) - 1
+    for i in range(len(us)):
+        u0, v0, u1, v1 = us[j], vs[j], us[i], vs[i]
+        j = i
+        if u0 > u1:
+            u0, v0, u1, v1 = u1, v1, u0, v0
+        for tx in range(int(np.floor(u0)), int(np.floor(u1)) + 1):
+            # Edge segment clipped to the tiles column
+            if u1 > u0:
+                ua, ub = max(u0, tx), min(u1, tx + 1)
+                va = v0 + (v1 - v0) * (ua - u0) / (u1 - u0)
+                vb = v0 + (v1 - v0) * (ub - u0) / (u1 - u0)
+            else:
+                va, vb = v0, v1
+            for ty in range(int(np.floor(min(va, vb))),
+                            int(np.floor(max(va, vb))) + 1):
+                tiles.add((tx, ty))
+    return tiles
+
+
+def region_tiles(zoom, bbox=None, polygon=None):
+    """ Iterate the tiles of a region, in a deterministic order
+
+    Position arguments:
+    zoom -- Zoom level
+
+    Keyword arguments:
+    bbox -- Bounding box, (lat_min, lon_min, lat_max, lon_max)
+    polygon -- List of (lat, lon) vertices. The tiles whose center is inside
+               the polygon, or which are crossed by its edges, are
+               considered. If a bbox is provided as well, the tiles should be
+               also inside it
+
+    Returned value:
+    Generator of tiles, tuples of 3 values, tilex, tiley and zoom
+    """
+    if polygon is not None:
+        lats, lons = zip(*polygon)
+        pbox = (min(lats), min(lons), max(lats), max(lons))
+        if bbox is not None:
+            pbox = (max(pbox[0], bbox[0]), max(pbox[1], bbox[1]),
+                    min(pbox[2], bbox[2]), min(pbox[3], bbox[3]))
+        bbox = pbox
+        xs, ys = zip(*[mercator.LatLonToMeters(lat, lon)
+                       for lat, lon in polygon])
+        xs, ys = np.asarray(xs), np.asarray(ys)
+        edges = edge_tiles(xs, ys, zoom)
+    elif bbox is None:
+        raise ValueError('Either a bbox or a polygon should be provided')
+    txmin, txmax, tymin, tymax = tile_range(bbox, zoom)
+    tys = np.arange(tymin, tymax + 1)
+    for tx in range(txmin, txmax + 1):
+        selected = tys
+        if polygon is not None:
+            # Tiles centers
+            res = mercator.Resolution(zoom) * mercator.tileSize
+            x = np.full(tys.shape, (tx + 0.5) * res - mercator.originShift)
+            y = (tys + 0.5) * res - mercator.originShift
+            mask = inside_polygon(x, y, xs, ys)
+            mask |= np.asarray([(tx, ty) in edges for ty in tys],
+                               dtype=np.bool)
+            selected = tys[mask]
+        for ty in selected:
+            yield (tx, int(ty), zoom)
+
+
+def count_tiles(zooms, bbox=None, polygon=None):
+    """ Count the tiles of a region. See region_tiles()
+
+    Position arguments:
+    zooms -- List of zoom levels
+
+    Returned value:
+    Number of tiles
+    """
+    n = 0
+    for zoom in zooms:
+        if polygon is None:
+            txmin, txmax, tymin, tymax = tile_range(bbox, zoom)
+            n += max(txmax - txmin + 1, 0) * max(tymax - tymin + 1, 0)
+        else:
+            n += sum(1 for _ in region_tiles(zoom, bbox, polygon))
+    return n
@@ -22,25 +22,86 @@ uniform struct {
 uniform sampler2D p3d_Texture0;
 uniform vec3 wspos_camera;
 
+// Size of each heightfield texel, in meters, and the height range of the
+// terrain, both set by the generator
+uniform vec2 terrain_texel;
+uniform float terrain_zscale;
+
+#ifdef USE_NORMAL_MAP
+// Normals baked by the generator
+uniform sampler2D normal_map;
+#endif
+
+#ifdef ROCKS_IN_SHADER
+uniform vec3 rock_color;
+uniform float rock_steepness;
+#endif
+
+#ifdef TOROIDAL
+// Wrapped around tiles, see the vertex shader. The coordinates are the window
+// ones, clamped to it when sampling the slots
+in vec2 window_uv;
+uniform sampler2D terrain_heights;
+uniform vec2 terrain_uv_offset;
+uniform float terrain_uv_scale;
+uniform vec2 terrain_height_map;
+
+float texel_size() {
+  return 1.0 / (textureSize(terrain_heights, 0).x * terrain_uv_scale);
+}
+
+vec2 slot_uv(vec2 window) {
+  float half_texel = 0.5 * texel_size();
+  return terrain_uv_offset + clamp(window, half_texel, 1.0 - half_texel) * terrain_uv_scale;
+}
+
+float get_terrain_height(vec2 uv) {
+  return texture(terrain_heights, slot_uv(uv)).x * terrain_height_map.x + terrain_height_map.y;
+}
+#define TERRAIN_UV window_uv
+#define SAMPLE_UV slot_uv(window_uv)
+#else
+float texel_size() {
+  return 1.0 / textureSize(ShaderTerrainMesh.heightfield, 0).x;
+}
+
+float get_terrain_height(vec2 uv) {
+  return texture(ShaderTerrainMesh.heightfield, uv).x;
+}
+#define TERRAIN_UV terrain_uv
+#define SAMPLE_UV terrain_uv
+#endif
+
 // Compute normal from the heightmap, this assumes the terrain is facing z-up
 vec3 get_terrain_normal() {
-  const float terrain_height = 50.0;
-  vec3 pixel_size = vec3(1.0, -1.0, 0) / textureSize(ShaderTerrainMesh.heightfield, 0).xxx;
-  float u0 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.yz).x * terrain_height;
-  float u1 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.xz).x * terrain_height;
-  float v0 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.zy).x * terrain_height;
-  float v1 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.zx).x * terrain_height;
-  vec3 tangent = normalize(vec3(1.0, 0, u1 - u0));
-  vec3 binormal = normalize(vec3(0, 1.0, v1 - v0));
+#ifdef USE_NORMAL_MAP
+  return normalize(texture(normal_map, SAMPLE_UV).xyz * 2.0 - 1.0);
+#else
+  vec3 pixel_size = vec3(1.0, -1.0, 0) * texel_size();
+  float u0 = get_terrain_height(TERRAIN_UV + pixel_size.yz) * terrain_zscale;
+  float u1 = get_terrain_height(TERRAIN_UV + pixel_size.xz) * terrain_zscale;
+  float v0 = get_terrain_height(TERRAIN_UV + pixel_size.zy) * terrain_zscale;
+  float v1 = get_terrain_height(TERRAIN_UV + pixel_size.zx) * terrain_zscale;
+  vec3 tangent = normalize(vec3(2.0 * terrain_texel.x, 0, u1 - u0));
+  vec3 binormal = normalize(vec3(0, 2.0 * terrain_texel.y, v1 - v0));
   return normalize(cross(tangent, binormal));
+#endif
 }
 
 
 
 void main() {
-  vec3 diffuse = texture(p3d_Texture0, terrain_uv).xyz;
+  vec3 diffuse = texture(p3d_Texture0, SAMPLE_UV).xyz;
   vec3 normal = get_terrain_normal();
 
+#ifdef ROCKS_IN_SHADER
+  // Replace the landcover by rocks in the steep areas, with a smooth
+  // transition
+  float steepness = length(normal.xy) / max(normal.z, 1e-4);
+  float rock = smoothstep(0.75 * rock_steepness, 1.25 * rock_steepness, steepness);
+  diffuse = mix(diffuse, rock_color, rock);
+#endif
+
   // Add some fake lighting - you usually want to use your own lighting code here
   vec3 fake_sun = normalize(vec3(0.7, 0.2, 0.6));
   vec3 shading = max(0.0, dot(normal, fake_sun)) * diffuse;
@@ -15,6 +15,26 @@ uniform struct {
   int chunk_size;
 } ShaderTerrainMesh;
 
+#ifdef TOROIDAL
+// The tiles are stored in wrapped around texture slots, so the window of
+// shown tiles starts at an offset. The elevations are not normalized to the
+// mosaic, so they are mapped to the terrain height range
+uniform sampler2D terrain_heights;
+uniform vec2 terrain_uv_offset;
+uniform float terrain_uv_scale;
+uniform vec2 terrain_height_map;
+
+// Texture coordinates of a point of the window, in the (0, 0), (1, 1) range.
+// The sampling is clamped to the window, since the neighbouring slots may
+// hold stale tiles
+vec2 slot_uv(vec2 window) {
+  float half_texel = 0.5 / (textureSize(terrain_heights, 0).x * terrain_uv_scale);
+  return terrain_uv_offset + clamp(window, half_texel, 1.0 - half_texel) * terrain_uv_scale;
+}
+
+out vec2 window_uv;
+#endif
+
 out vec2 terrain_uv;
 out vec3 vtx_pos;
 
@@ -42,12 +62,22 @@ void main() {
   chunk_position.xy += terrain_data.xy / float(ShaderTerrainMesh.terrain_size);
 
   // Compute the terrain UV coordinates
+#ifdef TOROIDAL
+  window_uv = chunk_position.xy;
+  terrain_uv = slot_uv(window_uv);
+#else
   terrain_uv = chunk_position.xy;
+#endif
 
   // Sample the heightfield and offset the terrain - we do not need to multiply
   // the height with anything since the terrain transform is included in the
   // model view projection matrix.
+#ifdef TOROIDAL
+  chunk_position.z += texture(terrain_heights, terrain_uv).x * terrain_height_map.x
+                      + terrain_height_map.y;
+#else
   chunk_position.z += texture(ShaderTerrainMesh.heightfield, terrain_uv).x;
+#endif
   gl_Position = p3d_ModelViewProjectionMatrix * vec4(chunk_position, 1);
 
   // Output the vertex world space position - in this case we use this to render
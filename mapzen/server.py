@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shared read-through tiles cache. Call this script with the following
+# command:
+# python -m mapzen.server [port] [folder]
+# and point the tile sources of the render nodes to it, e.g.
+# sources.register('terrarium', sources.TileSource(
+#     "http://host:port/terrarium/{z}/{x}/{y}.png"))
+# such that all of them are sharing a single upstream download per tile.
+# The osm layer is served as osm/all/{z}/{x}/{y}.json
+
+import sys
+import os
+import hashlib
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+from . import cache
+from . import memory
+from . import sources
+from .download import TTL
+
+
+PORT = 8421
+SERVER_CACHE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                 "rsc/server/")
+CONTENT_TYPES = {'.png': 'image/png', '.json': 'application/json'}
+# Maximum size of the in-memory tier, in bytes
+HOT_BYTES = 256 * 1024 * 1024
+
+
+def _etag(data):
+    return '"{}"'.format(hashlib.md5(data).hexdigest())
+
+
+class TileStore(object):
+    def __init__(self, root=SERVER_CACHE_PATH, upstreams=None,
+                 hot_bytes=HOT_BYTES, ttl=None):
+        """Read-through tiles store. The tiles are looked for in an in-memory
+        tier of the most recently served ones, then in the disk, and finally
+        downloaded from the upstream server. The concurrent requests of the
+        same tile are sharing a single upstream download.
+
+        Keyword arguments:
+        root -- Disk cache folder
+        upstreams -- Dictionary with the upstream sources.TileSource of each
+                     layer. None to use the registered sources
+        hot_bytes -- Maximum size of the in-memory tier, in bytes
+        ttl -- Dictionary with the time to live of each layer, in seconds.
+               The expired tiles are served anyway, but revalidated in
+               background. See download.TTL
+        """
+        self.root = root
+        self.upstreams = upstreams or sources.SOURCES
+        self.hot_bytes = hot_bytes
+        self.ttl = TTL if ttl is None else ttl
+        self.__hot = OrderedDict()
+        self.__hot_size = 0
+        self.__lock = threading.Lock()
+        self.hits = {'memory': 0, 'disk': 0, 'upstream': 0}
+        self.memory_name = memory.REGISTRY.register(
+            'server.hot', lambda: self.__hot_size, self.__evict, memory.RAW)
+
+    def __parse(self, path):
+        """ Check that a requested path is a tile, layer/.../z/x/y.ext
+
+        Returned value:
+        Layer name and tile
+        """
+        parts = path.split('/')
+        ext = os.path.splitext(parts[-1])[1]
+        if len(parts) < 4 or parts[0] not in self.upstreams or \
+                ext not in CONTENT_TYPES or '..' in parts or '' in parts:
+            raise KeyError(path)
+        try:
+            tile = (int(parts[-2]), int(os.path.splitext(parts[-1])[0]),
+                    int(parts[-3]))
+        except ValueError:
+            raise KeyError(path)
+        return parts[0], tile
+
+    def __remember(self, path, data):
+        entry = (data, _etag(data))
+        self.__lock.acquire()
+        if path in self.__hot:
+            self.__hot_size -= len(self.__hot.pop(path)[0])
+        self.__hot[path] = entry
+        self.__hot_size += len(data)
+        while self.__hot_size > self.hot_bytes and len(self.__hot) > 1:
+            _, (old, _) = self.__hot.popitem(last=False)
+            self.__hot_size -= len(old)
+        self.__lock.release()
+        memory.REGISTRY.enforce()
+        return entry
+
+    def __evict(self, nbytes, keep):
+        """ Release the least recently served tiles, see
+        memory.MemoryRegistry.register()
+        """
+        freed = 0
+        self.__lock.acquire()
+        for path in list(self.__hot.keys()):
+            if freed >= nbytes:
+                break
+            if keep is not None and keep(self.__parse(path)[1]):
+                continue
+            data, _ = self.__hot.pop(path)
+            self.__hot_size -= len(data)
+            freed += len(data)
+        self.__lock.release()
+        return freed
+
+    def __fetch(self, layer, tile, path, revalidate=False):
+        """ Start the upstream download of a tile
+
+        Returned value:
+        Future, with the tile data and its ETag as result
+        """
+        fname = os.path.join(self.root, path)
+        headers = {}
+        if revalidate:
+            meta = cache.read_meta(fname)
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        def process(data, info):
+            if data is None:
+                with open(fname, 'rb') as f:
+                    data = f.read()
+            else:
+                cache.write(fname, data)
+            cache.write_meta(fname, info['etag'], info['last_modified'])
+            return self.__remember(path, data)
+        upstream = self.upstreams[layer]
+        return upstream.fetcher.submit(path, upstream.url(tile), process,
+                                       headers)
+
+    def __count(self, tier):
+        self.__lock.acquire()
+        self.hits[tier] += 1
+        self.__lock.release()
+
+    def get(self, path):
+        """ Get a tile
+
+        Position arguments:
+        path -- Tile path, e.g. terrarium/14/8185/6100.png
+
+        Returned value:
+        Tile data and its ETag. KeyError is raised if the path is not a tile,
+        and the download error if it cannot be downloaded
+        """
+        layer, tile = self.__parse(path)
+        self.__lock.acquire()
+        entry = self.__hot.get(path)
+        if entry is not None:
+            self.__hot[path] = self.__hot.pop(path)
+            self.hits['memory'] += 1
+        self.__lock.release()
+        if entry is not None:
+            return entry
+        fname = os.path.join(self.root, path)
+        if cache.is_cached(fname):
+            if not cache.is_fresh(fname, self.ttl.get(layer)):
+                self.__fetch(layer, tile, path, revalidate=True)
+            with open(fname, 'rb') as f:
+                data = f.read()
+            self.__count('disk')
+            return self.__remember(path, data)
+        self.__count('upstream')
+        return self.__fetch(layer, tile, path).result()
+
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep the connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.path.split('?')[0].lstrip('/')
+        try:
+            data, etag = self.server.store.get(path)
+        except KeyError:
+            self.send_error(404, 'Not a tile')
+            return
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                self.send_error(404, 'Not found upstream')
+            else:
+                self.send_error(502, 'Upstream failure: {}'.format(e))
+            return
+        except Exception as e:
+            self.send_error(502, 'Upstream failure: {}'.format(e))
+            return
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         CONTENT_TYPES[os.path.splitext(path)[1]])
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('', PORT), store=None, verbose=False):
+        """Tiles HTTP server, serving layer/z/x/y paths from a TileStore
+
+        Keyword arguments:
+        address -- Tuple with the host and port to listen
+        store -- TileStore. None to create one with the default options
+        verbose -- True to log each request
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, TileHandler)
+        self.store = store or TileStore()
+        self.verbose = verbose
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    root = sys.argv[2] if len(sys.argv) > 2 else SERVER_CACHE_PATH
+    server = TileServer(('', port), TileStore(root), verbose=True)
+    print("Serving tiles at port {}".format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
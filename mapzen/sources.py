@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tile sources registry. The sources can be replaced, e.g. by a mirror or by
+# a local tiles folder, either registering them:
+# sources.register('terrarium', TileSource('/data/terrarium/{z}/{x}/{y}.png'))
+# or loading a JSON file like the following one:
+# {"terrain-background": {
+#      "template": "http://{s}.tile.example.com/{z}/{x}/{y}.png",
+#      "subdomains": ["a", "b", "c"], "max_connections": 4, "rate": 20}}
+
+import os
+import json
+import urllib
+from .fetch import Fetcher, MAX_CONNECTIONS, TIMEOUT
+
+
+class TileSource(object):
+    def __init__(self, template, subdomains=None,
+                 max_connections=MAX_CONNECTIONS, rate=None, timeout=TIMEOUT):
+        """Tiles source
+
+        Position arguments:
+        template -- URL template, where {z}, {x} and {y} are replaced by the
+                    tile zoom and coordinates, and {s} by a subdomain. file://
+                    URLs and local paths are accepted as well
+
+        Keyword arguments:
+        subdomains -- List of subdomains. The tiles are distributed among
+                      them, such that the load is spread along the hosts
+        max_connections -- Maximum number of simultaneous downloads
+        rate -- Maximum number of requests per second. None for unlimited
+        timeout -- Timeout of each request, in seconds
+        """
+        if '://' not in template:
+            # Local folder
+            template = 'file:' + urllib.pathname2url(
+                os.path.abspath(template)).replace(
+                    '%7B', '{').replace('%7D', '}')
+        if '{s}' in template and not subdomains:
+            raise ValueError('No subdomains for {}'.format(template))
+        self.template = template
+        self.subdomains = subdomains or ['']
+        self.fetcher = Fetcher(max_connections, timeout, rate)
+
+    def url(self, tile):
+        """ Get the URL of a tile
+
+        Position arguments:
+        tile -- Tuple of 3 values, tilex, tiley and zoom
+
+        Returned value:
+        Tile URL
+        """
+        x, y, z = int(tile[0]), int(tile[1]), int(tile[2])
+        s = self.subdomains[(x + y) % len(self.subdomains)]
+        return self.template.format(x=x, y=y, z=z, s=s)
+
+
+SOURCES = {
+    'terrarium': TileSource(
+        "https://s3.amazonaws.com/elevation-tiles-prod/terrarium/"
+        "{z}/{x}/{y}.png"),
+    'terrain-background': TileSource(
+        "http://{s}.tile.stamen.com/terrain-background/{z}/{x}/{y}.png",
+        subdomains=['a', 'b', 'c', 'd']),
+    # The original Mapzen vector tiles service is gone, so a compatible
+    # mirror should be registered to get the OSM data
+    'osm': TileSource("http://vector.mapzen.com/osm/all/{z}/{x}/{y}.json"),
+}
+
+
+def register(layer, source):
+    """ Set the source of a layer
+
+    Position arguments:
+    layer -- 'terrarium', 'terrain-background' or 'osm'
+    source -- TileSource
+    """
+    SOURCES[layer] = source
+
+
+def get(layer):
+    """ Get the source of a layer
+
+    Position arguments:
+    layer -- 'terrarium', 'terrain-background' or 'osm'
+
+    Returned value:
+    TileSource
+    """
+    try:
+        return SOURCES[layer]
+    except KeyError:
+        raise ValueError('Unknown layer {}'.format(layer))
+
+
+def load(fname):
+    """ Register the sources of a JSON file, with an object per layer, each
+    one with the TileSource arguments
+
+    Position arguments:
+    fname -- JSON file path
+    """
+    with open(fname, 'r') as f:
+        config = json.load(f)
+    for layer, kwargs in config.items():
+        register(layer, TileSource(**kwargs))
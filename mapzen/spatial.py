@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Spatial index of the OSM vector tiles features (buildings, roads...), to
+# query the features in a box or around a point without scanning the GeoJSON
+
+import time
+import heapq
+import threading
+import Queue
+from collections import OrderedDict
+import numpy as np
+from . import cache
+from . import download
+from . import memory
+from .globalmaptiles import GlobalMercator
+
+
+# Number of children of each R-tree node
+NODE_SIZE = 16
+# Bits per coordinate of the Hilbert curve used to sort the features
+HILBERT_ORDER = 16
+# Number of tile indexes kept in memory
+INDEX_CACHE_SIZE = 64
+# Time, in seconds, before requesting again a tile which has failed
+RETRY_DELAY = 10.0
+# Approximated memory of the decoded GeoJSON, per feature (dictionaries and
+# properties) and per coordinate (list of 2 floats)
+FEATURE_BYTES = 2048
+COORD_BYTES = 136
+
+
+def _hilbert(x, y, order=HILBERT_ORDER):
+    """ Distance along the Hilbert curve of integer coordinates
+
+    Position arguments:
+    x -- Array of x coordinates, in range [0, 2^order)
+    y -- Array of y coordinates, in range [0, 2^order)
+
+    Keyword arguments:
+    order -- Bits per coordinate
+
+    Returned value:
+    Array of distances
+    """
+    n = 1 << order
+    x = np.asarray(x, dtype=np.int64).copy()
+    y = np.asarray(y, dtype=np.int64).copy()
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = rx & ~ry
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return d
+
+
+def _parts(geometry):
+    """ Get the coordinates lists of a GeoJSON geometry
+
+    Position arguments:
+    geometry -- GeoJSON geometry
+
+    Returned value:
+    List of coordinates lists, and True if they are polygon rings
+    """
+    kind, coords = geometry.get('type'), geometry.get('coordinates')
+    if kind == 'Point':
+        return [[coords]], False
+    elif kind == 'MultiPoint':
+        return [[c] for c in coords], False
+    elif kind == 'LineString':
+        return [coords], False
+    elif kind == 'MultiLineString':
+        return coords, False
+    elif kind == 'Polygon':
+        return coords, True
+    elif kind == 'MultiPolygon':
+        return [ring for polygon in coords for ring in polygon], True
+    elif kind == 'GeometryCollection':
+        parts, polygon = [], False
+        for g in geometry.get('geometries', ()):
+            p, poly = _parts(g)
+            parts.extend(p)
+            polygon = polygon or poly
+        return parts, polygon
+    return [], False
+
+
+class FeatureIndex(object):
+    def __init__(self, data, arrays=None):
+        """Packed Hilbert R-tree of the features of an OSM vector tile. The
+        features are sorted along the Hilbert curve of their bounding box
+        centers, and packed in nodes of NODE_SIZE, such that the boxes of
+        each tree level are stored in contiguous arrays, filtered at once.
+        The features geometry is kept as an array of segments (a degenerated
+        one for the points), to compute the exact distances.
+
+        Position arguments:
+        data -- Vector tile JSON, either a dictionary of layers (as served by
+                Mapzen) or a single GeoJSON FeatureCollection
+
+        Keyword arguments:
+        arrays -- Packed arrays of an index of the same data, see arrays(), to
+                  load it instead of building it again
+        """
+        if data.get('type') == 'FeatureCollection':
+            data = {'': data}
+        self.layer_names = sorted(data.keys())
+        if arrays is not None:
+            self.__load(data, arrays)
+            return
+        mercator = GlobalMercator()
+        features, layers, positions, polygons = [], [], [], []
+        coords, part_feature, part_size = [], [], []
+        for l, name in enumerate(self.layer_names):
+            for i, feature in enumerate(data[name].get('features', ())):
+                parts, polygon = _parts(feature.get('geometry') or {})
+                parts = [p for p in parts if len(p)]
+                if not parts:
+                    continue
+                for p in parts:
+                    coords.extend(c[:2] for c in p)
+                    part_feature.append(len(features))
+                    part_size.append(len(p))
+                features.append((name, feature))
+                layers.append(l)
+                positions.append(i)
+                polygons.append(polygon)
+        self.json_bytes = len(features) * FEATURE_BYTES + \
+            len(coords) * COORD_BYTES
+        coords = np.asarray(coords, dtype=np.float).reshape(-1, 2)
+        xy = np.empty(coords.shape, dtype=np.float)
+        xy[:, 0] = coords[:, 0] * mercator.originShift / 180.0
+        xy[:, 1] = np.log(np.tan((90.0 + coords[:, 1]) * np.pi / 360.0)) * \
+            mercator.originShift / np.pi
+        # Segments between the consecutive points of each part, and a single
+        # degenerated segment for the single point parts
+        part_size = np.asarray(part_size, dtype=np.int64)
+        start = np.cumsum(part_size) - part_size
+        last = np.zeros(len(xy), dtype=bool)
+        last[start + part_size - 1] = True
+        a = np.flatnonzero(~last)
+        b = a + 1
+        single = start[part_size == 1]
+        a, b = np.concatenate((a, single)), np.concatenate((b, single))
+        point_part = np.repeat(np.arange(len(part_size)), part_size)
+        seg_feature = np.asarray(part_feature, dtype=np.int64)[point_part[a]]
+        # Sort the features along the Hilbert curve
+        n = len(features)
+        nseg = np.bincount(seg_feature, minlength=n)
+        order = np.argsort(seg_feature, kind='mergesort')
+        segments = np.column_stack((xy[a], xy[b]))[order]
+        offsets = np.concatenate(([0], np.cumsum(nseg)))
+        boxes = np.empty((n, 4), dtype=np.float)
+        if n:
+            boxes[:, 0] = np.minimum.reduceat(
+                np.minimum(segments[:, 0], segments[:, 2]), offsets[:-1])
+            boxes[:, 1] = np.minimum.reduceat(
+                np.minimum(segments[:, 1], segments[:, 3]), offsets[:-1])
+            boxes[:, 2] = np.maximum.reduceat(
+                np.maximum(segments[:, 0], segments[:, 2]), offsets[:-1])
+            boxes[:, 3] = np.maximum.reduceat(
+                np.maximum(segments[:, 1], segments[:, 3]), offsets[:-1])
+        rank = self.__hilbert_order(boxes)
+        self.features = [features[i] for i in rank]
+        self.layers = np.asarray(layers, dtype=np.int32)[rank]
+        # Position of each feature in its layer, to load the index
+        self.positions = np.asarray(positions, dtype=np.int32)[rank]
+        self.polygons = np.asarray(polygons, dtype=bool)[rank]
+        self.nsegments = nseg[rank]
+        self.offsets = np.concatenate(([0], np.cumsum(self.nsegments)))
+        self.segments = segments[self.__gather(offsets[:-1][rank],
+                                               self.nsegments)]
+        # Tree levels, from the features boxes to the root
+        self.levels = [boxes[rank]]
+        while len(self.levels[-1]) > 1:
+            child = self.levels[-1]
+            starts = np.arange(0, len(child), NODE_SIZE)
+            node = np.empty((len(starts), 4), dtype=np.float)
+            node[:, :2] = np.minimum.reduceat(child[:, :2], starts)
+            node[:, 2:] = np.maximum.reduceat(child[:, 2:], starts)
+            self.levels.append(node)
+
+    def arrays(self):
+        """ Get the packed arrays of the index, to store it
+
+        Returned value:
+        Dictionary of arrays, see FeatureIndex()
+        """
+        return {'layer_names': np.asarray(self.layer_names, dtype=np.unicode_),
+                'layers': self.layers,
+                'positions': self.positions,
+                'polygons': self.polygons,
+                'nsegments': self.nsegments,
+                'segments': self.segments,
+                'levels': np.concatenate(self.levels),
+                'level_sizes': np.asarray([len(l) for l in self.levels],
+                                          dtype=np.int64),
+                'json_bytes': np.asarray(self.json_bytes, dtype=np.int64)}
+
+    def __load(self, data, arrays):
+        """ Load the packed arrays of an index, see arrays()
+        """
+        if list(arrays['layer_names']) != self.layer_names:
+            raise ValueError('The index layers do not match the data')
+        self.layers = arrays['layers']
+        self.positions = arrays['positions']
+        self.polygons = arrays['polygons']
+        self.nsegments = arrays['nsegments']
+        self.offsets = np.concatenate(([0], np.cumsum(self.nsegments)))
+        self.segments = arrays['segments']
+        bounds = np.cumsum(arrays['level_sizes'])[:-1]
+        self.levels = np.split(arrays['levels'], bounds)
+        self.json_bytes = int(arrays['json_bytes'])
+        features = [data[name].get('features', ())
+                    for name in self.layer_names]
+        self.features = [(self.layer_names[l], features[l][i])
+                         for l, i in zip(self.layers, self.positions)]
+
+    @staticmethod
+    def __hilbert_order(boxes):
+        """ Sort the boxes along the Hilbert curve of their centers
+        """
+        if not len(boxes):
+            return np.zeros(0, dtype=np.int64)
+        cx = 0.5 * (boxes[:, 0] + boxes[:, 2])
+        cy = 0.5 * (boxes[:, 1] + boxes[:, 3])
+        scale = (1 << HILBERT_ORDER) - 1
+        span = max(np.ptp(cx), np.ptp(cy)) or 1.0
+        x = np.round((cx - cx.min()) / span * scale)
+        y = np.round((cy - cy.min()) / span * scale)
+        return np.argsort(_hilbert(x, y), kind='mergesort')
+
+    @staticmethod
+    def __gather(offsets, counts):
+        """ Concatenate the ranges [offsets, offsets + counts)
+        """
+        starts = np.cumsum(counts) - counts
+        return np.repeat(offsets - starts, counts) + np.arange(counts.sum())
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def nbytes(self):
+        """Bytes of the index arrays, plus an estimation of the features
+        GeoJSON kept, see FEATURE_BYTES and COORD_BYTES"""
+        return self.json_bytes + memory.nbytes(
+            self.layers, self.positions, self.polygons, self.nsegments,
+            self.offsets, self.segments, *self.levels)
+
+    def layer_mask(self, layers=None):
+        """ Get the features of some layers
+
+        Keyword arguments:
+        layers -- List of layer names. None for all the layers
+
+        Returned value:
+        Boolean array, True for the features of the layers
+        """
+        if layers is None:
+            return np.ones(len(self.features), dtype=bool)
+        ids = [i for i, name in enumerate(self.layer_names) if name in layers]
+        return np.in1d(self.layers, ids)
+
+    def query_bbox(self, xmin, ymin, xmax, ymax, layers=None):
+        """ Get the features which bounding box intersects a box
+
+        Position arguments:
+        xmin -- Minimum x of the box, in EPSG:900913 coordinates
+        ymin -- Minimum y of the box, in EPSG:900913 coordinates
+        xmax -- Maximum x of the box, in EPSG:900913 coordinates
+        ymax -- Maximum y of the box, in EPSG:900913 coordinates
+
+        Keyword arguments:
+        layers -- List of layer names. None for all the layers
+
+        Returned value:
+        Array of feature indexes
+        """
+        nodes = np.zeros(min(len(self.features), 1), dtype=np.int64)
+        for k in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[k]
+            if k < len(self.levels) - 1:
+                nodes = (nodes[:, np.newaxis] * NODE_SIZE +
+                         np.arange(NODE_SIZE)).ravel()
+                nodes = nodes[nodes < len(level)]
+            b = level[nodes]
+            nodes = nodes[(b[:, 0] <= xmax) & (b[:, 2] >= xmin) &
+                          (b[:, 1] <= ymax) & (b[:, 3] >= ymin)]
+            if not len(nodes):
+                break
+        if layers is not None and len(nodes):
+            nodes = nodes[self.layer_mask(layers)[nodes]]
+        return nodes
+
+    def distances(self, x, y, indexes):
+        """ Distance from a point to some features, which is 0 inside the
+        polygons
+
+        Position arguments:
+        x -- Point x, in EPSG:900913 coordinates
+        y -- Point y, in EPSG:900913 coordinates
+        indexes -- Array of feature indexes
+
+        Returned value:
+        Array of distances, in meters
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if not len(indexes):
+            return np.zeros(0, dtype=np.float)
+        counts = self.nsegments[indexes]
+        starts = np.cumsum(counts) - counts
+        seg = self.__gather(self.offsets[indexes], counts)
+        x0, y0, x1, y1 = self.segments[seg].T
+        dx, dy = x1 - x0, y1 - y0
+        l2 = dx * dx + dy * dy
+        t = np.clip(((x - x0) * dx + (y - y0) * dy) /
+                    np.where(l2 > 0.0, l2, 1.0), 0.0, 1.0)
+        d = np.hypot(x0 + t * dx - x, y0 + t * dy - y)
+        d = np.minimum.reduceat(d, starts)
+        # Even-odd rule, the rings of each polygon are closed
+        cross = ((y0 > y) != (y1 > y)) & \
+            (x < x0 + (y - y0) * dx / np.where(dy != 0.0, dy, 1.0))
+        inside = np.add.reduceat(cross.astype(np.int64), starts) % 2 == 1
+        d[inside & self.polygons[indexes]] = 0.0
+        return d
+
+    def query_radius(self, x, y, radius, layers=None):
+        """ Get the features closer than a distance to a point
+
+        Position arguments:
+        x -- Point x, in EPSG:900913 coordinates
+        y -- Point y, in EPSG:900913 coordinates
+        radius -- Distance, in meters
+
+        Keyword arguments:
+        layers -- List of layer names. None for all the layers
+
+        Returned value:
+        Array of feature indexes, and array of distances, sorted by distance
+        """
+        indexes = self.query_bbox(x - radius, y - radius, x + radius,
+                                  y + radius, layers)
+        d = self.distances(x, y, indexes)
+        mask = d <= radius
+        indexes, d = indexes[mask], d[mask]
+        order = np.argsort(d, kind='mergesort')
+        return indexes[order], d[order]
+
+    def nearest(self, x, y, layers=None, max_distance=None):
+        """ Get the feature closest to a point
+
+        Position arguments:
+        x -- Point x, in EPSG:900913 coordinates
+        y -- Point y, in EPSG:900913 coordinates
+
+        Keyword arguments:
+        layers -- List of layer names. None for all the layers
+        max_distance -- Maximum distance, in meters. None for no limit
+
+        Returned value:
+        Feature index and distance, None and inf if there are no features
+        """
+        if not len(self.features):
+            return None, np.inf
+        ids = None
+        if layers is not None:
+            ids = [i for i, name in enumerate(self.layer_names)
+                   if name in layers]
+        limit = np.inf if max_distance is None else max_distance
+        # Best first descent. The box distance is a lower bound of the
+        # distance to everything inside, so when a feature is popped it is
+        # the closest one. The features are pushed with the exact distance,
+        # as level -1
+        top = len(self.levels) - 1
+        if top == 0:
+            # A single feature
+            if ids is not None and self.layers[0] not in ids:
+                return None, np.inf
+            heap = [(self.distances(x, y, [0])[0], -1, 0)]
+        else:
+            heap = [(self.__box_distance(x, y, self.levels[top])[0], top, 0)]
+        while heap:
+            d, k, node = heapq.heappop(heap)
+            if d > limit:
+                break
+            if k < 0:
+                return node, d
+            children = np.arange(node * NODE_SIZE,
+                                 min((node + 1) * NODE_SIZE,
+                                     len(self.levels[k - 1])))
+            if k == 1:
+                # The children are features
+                if ids is not None:
+                    children = children[np.in1d(self.layers[children], ids)]
+                dc = self.distances(x, y, children)
+                kc = -1
+            else:
+                dc = self.__box_distance(x, y, self.levels[k - 1][children])
+                kc = k - 1
+            for c, dist in zip(children, dc):
+                if dist <= limit:
+                    heapq.heappush(heap, (dist, kc, int(c)))
+        return None, np.inf
+
+    @staticmethod
+    def __box_distance(x, y, boxes):
+        """ Distance from a point to some boxes, 0 inside them
+        """
+        return np.hypot(
+            np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 2]), 0.0),
+            np.maximum(np.maximum(boxes[:, 1] - y, y - boxes[:, 3]), 0.0))
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_queue = Queue.Queue()
+_pending = set()
+# Failed tiles, with the time when they can be requested again
+_failed = {}
+_builder = None
+
+
+def _cache_bytes():
+    _cache_lock.acquire()
+    indexes = list(_cache.values())
+    _cache_lock.release()
+    return sum(index.nbytes for index in indexes)
+
+
+def _evict(nbytes, keep=None):
+    """ Release the least recently used indexes, see
+    memory.MemoryRegistry.register()
+    """
+    freed = 0
+    _cache_lock.acquire()
+    for tile in list(_cache.keys()):
+        if freed >= nbytes:
+            break
+        if keep is not None and keep(tile):
+            continue
+        freed += _cache.pop(tile).nbytes
+    _cache_lock.release()
+    return freed
+
+
+memory.REGISTRY.register('spatial.indexes', _cache_bytes, _evict)
+
+
+def tile_index(tile, wait=True):
+    """ Get the spatial index of a tile, which is built the first time the
+    tile vector data is loaded, and cached along the next ones
+
+    Position arguments:
+    tile -- Tuple of 3 values, tilex, tiley and zoom (<= 15)
+
+    Keyword arguments:
+    wait -- False to not wait for the index, which is downloaded and built in
+            background if it is not available yet
+
+    Returned value:
+    FeatureIndex, None if wait is False and it is not available yet
+    """
+    tile = (int(tile[0]), int(tile[1]), int(tile[2]))
+    _cache_lock.acquire()
+    index = _cache.pop(tile, None)
+    if index is not None:
+        _cache[tile] = index
+    _cache_lock.release()
+    if index is not None:
+        return index
+    if not wait:
+        request([tile])
+        return None
+    data = download.vector_data(tile)
+    json_file = download._request('osm', tile)[0]
+    index = _load_index(json_file, data)
+    if index is None:
+        index = FeatureIndex(data)
+        _save_index(json_file, index)
+    _cache_lock.acquire()
+    _cache[tile] = index
+    while len(_cache) > INDEX_CACHE_SIZE:
+        _cache.popitem(last=False)
+    _cache_lock.release()
+    memory.REGISTRY.enforce()
+    return index
+
+
+def _load_index(json_file, data):
+    """ Load the index stored next to a cached vector tile
+
+    Position arguments:
+    json_file -- Cached vector tile
+    data -- Vector tile JSON
+
+    Returned value:
+    FeatureIndex, None if it is not stored, or it was built from another
+    version of the tile
+    """
+    record = cache.read_record(json_file)
+    if record is None:
+        return None
+    try:
+        with np.load(json_file + cache.INDEX_EXT) as f:
+            arrays = dict((k, f[k]) for k in f.files)
+        if (int(arrays['size']), str(arrays['checksum'])) != record:
+            return None
+        return FeatureIndex(data, arrays)
+    except Exception:
+        return None
+
+
+def _save_index(json_file, index):
+    """ Store the packed arrays of an index next to its cached vector tile,
+    such that the next sessions are not building it again
+
+    Position arguments:
+    json_file -- Cached vector tile
+    index -- FeatureIndex
+    """
+    record = cache.read_record(json_file)
+    if record is None:
+        return
+    arrays = index.arrays()
+    # The tile version, to not load the index of an outdated tile
+    arrays['size'] = np.asarray(record[0], dtype=np.int64)
+    arrays['checksum'] = np.asarray(record[1])
+
+    def write_index(tmp):
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+    try:
+        cache._write_atomic(json_file + cache.INDEX_EXT, write_index)
+    except (IOError, OSError):
+        pass
+
+
+def request(tiles):
+    """ Start downloading and indexing, in background, the tiles which are
+    not indexed yet
+
+    Position arguments:
+    tiles -- List of tiles, each one a tuple of 3 values, tilex, tiley and zoom
+    """
+    global _builder
+    now = time.time()
+    _cache_lock.acquire()
+    tiles = [t for t in tiles if t not in _cache and t not in _pending and
+             _failed.get(t, now) <= now]
+    _pending.update(tiles)
+    if tiles and _builder is None:
+        _builder = threading.Thread(target=_build, name='spatial')
+        _builder.daemon = True
+        _builder.start()
+    _cache_lock.release()
+    if not tiles:
+        return
+    # The downloads are anyway done in parallel
+    download.prefetch(tiles, layers=('osm',))
+    for tile in tiles:
+        _queue.put(tile)
+
+
+def _build():
+    """ Indexing thread, see request()
+    """
+    while True:
+        tile = _queue.get()
+        try:
+            tile_index(tile)
+            retry = None
+        except Exception:
+            # Do not request it again on each query
+            retry = time.time() + RETRY_DELAY
+        _cache_lock.acquire()
+        _pending.discard(tile)
+        if retry is None:
+            _failed.pop(tile, None)
+        else:
+            _failed[tile] = retry
+        _cache_lock.release()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+from panda3d.core import Texture, SamplerState
+
+
+# Name: (component type, texture format, numpy dtype, scale, GPU bytes/texel)
+HEIGHTFIELD_FORMATS = {
+    'r16': (Texture.T_unsigned_short, Texture.F_r16, np.uint16, 65535.0, 2),
+    'r32f': (Texture.T_float, Texture.F_r32, np.float32, 1.0, 4),
+}
+# Name: (texture format, GPU bytes/texel). The RAM image is ever 8 bits per
+# component, the driver is storing rgb565 as 5/6/5 bits per texel
+COLOR_FORMATS = {
+    'rgb8': (Texture.F_rgb8, 3),
+    'rgb565': (Texture.F_rgb5, 2),
+}
+COMPRESSIONS = {
+    None: Texture.CM_off,
+    'dxt1': Texture.CM_dxt1,
+    'dxt5': Texture.CM_dxt5,
+}
+# Elevation range, in meters, of the slot heightfields (see slot_texture()),
+# which are not normalized to each mosaic, so the tiles can be reused
+SLOT_HEIGHT_RANGE = (-11000.0, 9000.0)
+
+
+def heightfield_texture(name, data, fmt='r16'):
+    """ Create a heightfield texture
+
+    Position arguments:
+    name -- Name of the texture
+    data -- Normalized elevations, in the range [0, 1]
+
+    Keyword arguments:
+    fmt -- Format of the texture, one of HEIGHTFIELD_FORMATS
+
+    Returned value:
+    Panda3D texture
+    """
+    ctype, tformat, dtype, scale, _ = HEIGHTFIELD_FORMATS[fmt]
+    if scale != 1.0:
+        data = np.round(data * scale)
+    # Panda3D is storing the images starting from the bottom row
+    data = np.ascontiguousarray(data[::-1], dtype=dtype)
+    tex = Texture(name)
+    tex.setup_2d_texture(data.shape[1], data.shape[0], ctype, tformat)
+    tex.set_ram_image(data.tobytes())
+    tex.set_wrap_u(SamplerState.WM_clamp)
+    tex.set_wrap_v(SamplerState.WM_clamp)
+    return tex
+
+
+def color_texture(name, data, fmt='rgb8', compression=None):
+    """ Create a RGB texture
+
+    Position arguments:
+    name -- Name of the texture
+    data -- RGB image, with 8 bits per component
+
+    Keyword arguments:
+    fmt -- Format of the texture, one of COLOR_FORMATS
+    compression -- None, or a compression mode of COMPRESSIONS. The
+                   compression is carried out right now, so it can be
+                   executed in a parallel thread
+
+    Returned value:
+    Panda3D texture
+    """
+    tformat, _ = COLOR_FORMATS[fmt]
+    # Panda3D is storing the images starting from the bottom row, in BGR order
+    data = np.ascontiguousarray(data[::-1, :, ::-1], dtype=np.uint8)
+    tex = Texture(name)
+    tex.setup_2d_texture(data.shape[1], data.shape[0],
+                         Texture.T_unsigned_byte, tformat)
+    tex.set_ram_image(data.tobytes())
+    if compression is not None:
+        tex.compress_ram_image(COMPRESSIONS[compression])
+    return tex
+
+
+def slot_count(window):
+    """ Get the number of slots along each direction of a toroidal texture,
+    the smallest power of 2 holding a window of tiles, such that the texture
+    size is a power of 2 as well (see slot_texture())
+
+    Position arguments:
+    window -- Number of tiles of the window along each direction
+
+    Returned value:
+    Number of slots
+    """
+    slots = 1
+    while slots < window:
+        slots *= 2
+    return slots
+
+
+def slot_texture(name, slots, tile_size, fmt):
+    """ Create an empty texture of slots x slots tiles with toroidal
+    addressing, i.e. a window of tiles is stored in the slots given by the
+    tile indexes modulo the number of slots, and the texture wraps around, so
+    when the window is moved just the new tiles should be written (see
+    write_slot()). The wrapping requires a power of 2 size, see slot_count().
+    The terrain shader clamps the sampling to the window, since the slots
+    around it may still hold old tiles
+
+    The elevations are stored in the fixed SLOT_HEIGHT_RANGE, instead of the
+    range of each mosaic, so with the 'r16' format they are quantized in
+    steps of about 0.3 meters
+
+    Position arguments:
+    name -- Name of the texture
+    slots -- Number of slots along each direction
+    tile_size -- Size of each tile, in texels
+    fmt -- Format of the texture, one of HEIGHTFIELD_FORMATS or
+           COLOR_FORMATS
+
+    Returned value:
+    Panda3D texture
+    """
+    size = slots * tile_size
+    if size & (size - 1):
+        raise ValueError('The slot textures size should be a power of 2, '
+                         'not {}'.format(size))
+    tex = Texture(name)
+    if fmt in HEIGHTFIELD_FORMATS:
+        ctype, tformat = HEIGHTFIELD_FORMATS[fmt][:2]
+    else:
+        ctype, tformat = Texture.T_unsigned_byte, COLOR_FORMATS[fmt][0]
+    tex.setup_2d_texture(size, size, ctype, tformat)
+    tex.make_ram_image()
+    tex.set_wrap_u(SamplerState.WM_repeat)
+    tex.set_wrap_v(SamplerState.WM_repeat)
+    return tex
+
+
+def _ram_image(tex, dtype):
+    """ Get a writable array view of the RAM image of a texture, marking it
+    as modified
+    """
+    return np.asarray(memoryview(tex.modify_ram_image())).view(dtype)
+
+
+def write_slot(tex, fmt, slot, data):
+    """ Write a tile in a slot of a texture created by slot_texture()
+
+    Position arguments:
+    tex -- Panda3D texture
+    fmt -- Format of the texture, one of HEIGHTFIELD_FORMATS or
+           COLOR_FORMATS
+    slot -- Column and row of the slot. The rows are the texture ones, i.e.
+            the rows of the tiles images are reversed
+    data -- Tile image, with the same rows order than the generator mosaics.
+            Elevations, in meters, for heightfields, or RGB images with 8 bits
+            per component
+
+    Returned value:
+    Number of bytes written
+    """
+    n = data.shape[0]
+    size = tex.get_x_size()
+    rows = slice(slot[1] * n, (slot[1] + 1) * n)
+    cols = slice(slot[0] * n, (slot[0] + 1) * n)
+    if fmt in HEIGHTFIELD_FORMATS:
+        _, _, dtype, scale, texel_bytes = HEIGHTFIELD_FORMATS[fmt]
+        image = _ram_image(tex, dtype).reshape(size, size)
+        zmin, zmax = SLOT_HEIGHT_RANGE
+        data = np.clip((data[::-1] - zmin) / (zmax - zmin), 0.0, 1.0)
+        if scale != 1.0:
+            data = np.round(data * scale)
+        image[rows, cols] = data
+    else:
+        texel_bytes = 3
+        image = _ram_image(tex, np.uint8).reshape(size, size, 3)
+        # Starting from the bottom row, in BGR order, see color_texture()
+        image[rows, cols] = data[::-1, :, ::-1]
+    return n * n * texel_bytes
+
+
+def texture_stats(tex, fmt, build_time, upload_time=None,
+                  written_bytes=None):
+    """ Get the memory usage and timing of a texture
+
+    Position arguments:
+    tex -- Panda3D texture
+    fmt -- Format name, from HEIGHTFIELD_FORMATS or COLOR_FORMATS
+    build_time -- Time spent creating the texture, in seconds
+
+    Keyword arguments:
+    upload_time -- Time spent uploading the texture to the GPU, in seconds
+    written_bytes -- Bytes actually written, if just some slots have been
+                     updated (see write_slot())
+
+    Returned value:
+    Dictionary with the format, size, RAM bytes, GPU bytes, written bytes and
+    times
+    """
+    if fmt in HEIGHTFIELD_FORMATS:
+        texel_bytes = HEIGHTFIELD_FORMATS[fmt][-1]
+    else:
+        texel_bytes = COLOR_FORMATS[fmt][-1]
+    size = (tex.get_x_size(), tex.get_y_size())
+    gpu_bytes = size[0] * size[1] * texel_bytes
+    if tex.get_ram_image_compression() != Texture.CM_off:
+        gpu_bytes = tex.get_ram_image_size()
+    return {'format': fmt,
+            'size': size,
+            'ram_bytes': tex.get_ram_image_size(),
+            'gpu_bytes': gpu_bytes,
+            'written_bytes': written_bytes,
+            'build_time': build_time,
+            'upload_time': upload_time}
+
+
+def upload(tex, gsg):
+    """ Upload a texture to the GPU right now
+
+    Position arguments:
+    tex -- Panda3D texture
+    gsg -- Graphics state guardian
+
+    Returned value:
+    Time spent, in seconds
+    """
+    t0 = time.time()
+    tex.prepare_now(0, gsg.get_prepared_objects(), gsg)
+    return time.time() - t0
+
+
+def report(stats):
+    """ Pretty format the textures statistics
+
+    Position arguments:
+    stats -- Dictionary of texture_stats() outputs, with the textures names as
+             keys
+
+    Returned value:
+    Report string
+    """
+    lines = []
+    for name in sorted(stats.keys()):
+        s = stats[name]
+        upload_time = '-' if s['upload_time'] is None else \
+            '{:.1f} ms'.format(1000.0 * s['upload_time'])
+        line = '{}: {} {}x{}, RAM {:.2f} MB, GPU {:.2f} MB, build {:.1f} ms, ' \
+               'upload {}'.format(name, s['format'], s['size'][0],
+                                  s['size'][1], s['ram_bytes'] / 1048576.0,
+                                  s['gpu_bytes'] / 1048576.0,
+                                  1000.0 * s['build_time'], upload_time)
+        if s.get('written_bytes') is not None:
+            line += ', written {:.2f} MB'.format(
+                s['written_bytes'] / 1048576.0)
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tile access traces, and an offline cache simulator replaying them, such that
+# the cache quotas and policies can be chosen from real flights
+
+import sys
+import os
+import heapq
+import struct
+import threading
+from collections import OrderedDict
+
+
+MAGIC = b'MZTRACE1'
+# Layers, stored by index
+LAYERS = ('terrarium', 'terrain-background', 'osm')
+# Timestamp, layer, zoom, hit, x, y, latency (seconds) and size (bytes)
+RECORD = struct.Struct('<dBBBIIfI')
+# Number of records buffered before writing them
+BUFFER_RECORDS = 256
+POLICIES = ('lru', 'lfu', 'arc')
+
+
+class TraceRecorder(object):
+    def __init__(self, path):
+        """Record the tile accesses in a compact binary file, to be replayed
+        by simulate(). The records are appended if the file already exists
+
+        Position arguments:
+        path -- Trace file
+        """
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__buffer = []
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.__file = open(path, 'ab')
+        if self.__file.tell() == 0:
+            self.__file.write(MAGIC)
+
+    def record(self, t, layer, tile, hit, latency, size):
+        """ Record a tile access
+
+        Position arguments:
+        t -- Timestamp, in seconds
+        layer -- 'terrarium', 'terrain-background' or 'osm'
+        tile -- Tuple of 3 values, tilex, tiley and zoom
+        hit -- True if the tile was cached, False otherwise
+        latency -- Time spent getting the tile, in seconds
+        size -- Size of the tile, in bytes. 0 if unknown
+        """
+        data = RECORD.pack(t, LAYERS.index(layer), int(tile[2]), bool(hit),
+                           int(tile[0]), int(tile[1]), latency, size)
+        self.__lock.acquire()
+        self.__buffer.append(data)
+        if len(self.__buffer) >= BUFFER_RECORDS:
+            self.__flush()
+        self.__lock.release()
+
+    def __flush(self):
+        """ Write the buffered records. The lock should be already acquired
+        """
+        if self.__file is not None and self.__buffer:
+            self.__file.write(b''.join(self.__buffer))
+            self.__file.flush()
+        self.__buffer = []
+
+    def flush(self):
+        self.__lock.acquire()
+        self.__flush()
+        self.__lock.release()
+
+    def close(self):
+        self.__lock.acquire()
+        self.__flush()
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        self.__lock.release()
+
+
+def read(path):
+    """ Read a trace file
+
+    Position arguments:
+    path -- Trace file
+
+    Returned value:
+    Generator of (timestamp, layer, tile, hit, latency, size) tuples. A
+    truncated last record is ignored
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a trace file'.format(path))
+        while True:
+            data = f.read(RECORD.size * BUFFER_RECORDS)
+            n = len(data) // RECORD.size
+            for i in range(n):
+                t, layer, zoom, hit, x, y, latency, size = \
+                    RECORD.unpack_from(data, i * RECORD.size)
+                yield (t, LAYERS[layer], (x, y, zoom), bool(hit), latency,
+                       size)
+            if len(data) < RECORD.size * BUFFER_RECORDS:
+                break
+
+
+class LRUCache(object):
+    def __init__(self, capacity):
+        """Least recently used cache simulator
+
+        Position arguments:
+        capacity -- Capacity, in bytes
+        """
+        self.capacity = capacity
+        self.used = 0
+        self.__items = OrderedDict()
+
+    def access(self, key, size):
+        """ Request a file, inserting it if it is not cached
+
+        Position arguments:
+        key -- File key
+        size -- File size, in bytes
+
+        Returned value:
+        True if the file was cached, False otherwise
+        """
+        if key in self.__items:
+            self.__items[key] = self.__items.pop(key)
+            return True
+        self.insert(key, size)
+        return False
+
+    def insert(self, key, size):
+        """ Insert a file (e.g. prefetched), unless it is already cached
+
+        Position arguments:
+        key -- File key
+        size -- File size, in bytes
+
+        Returned value:
+        True if the file has been inserted, False otherwise
+        """
+        if key in self.__items:
+            return False
+        self.__items[key] = size
+        self.used += size
+        while self.used > self.capacity and self.__items:
+            _, evicted = self.__items.popitem(last=False)
+            self.used -= evicted
+        return True
+
+
+class LFUCache(object):
+    def __init__(self, capacity):
+        """Least frequently used cache simulator, evicting the least recently
+        used file on ties. The access counts are forgotten on eviction
+
+        Position arguments:
+        capacity -- Capacity, in bytes
+        """
+        self.capacity = capacity
+        self.used = 0
+        self.__tick = 0
+        # key -> [count, tick, size]
+        self.__items = {}
+        # Entries (count, tick, key), outdated ones are discarded on eviction
+        self.__heap = []
+
+    def __touch(self, key, count, size):
+        self.__tick += 1
+        self.__items[key] = [count, self.__tick, size]
+        heapq.heappush(self.__heap, (count, self.__tick, key))
+        if len(self.__heap) > 4 * len(self.__items) + 64:
+            # Drop the outdated entries
+            self.__heap = [(c, t, k) for k, (c, t, _) in self.__items.items()]
+            heapq.heapify(self.__heap)
+
+    def access(self, key, size):
+        """ Request a file, inserting it if it is not cached. See
+        LRUCache.access()
+        """
+        item = self.__items.get(key)
+        if item is not None:
+            self.__touch(key, item[0] + 1, item[2])
+            return True
+        self.insert(key, size, 1)
+        return False
+
+    def insert(self, key, size, count=0):
+        """ Insert a file, unless it is already cached. See LRUCache.insert()
+        """
+        if key in self.__items:
+            return False
+        # Make room first, so the new file is never the evicted one
+        while self.used + size > self.capacity and self.__heap:
+            _, tick, k = heapq.heappop(self.__heap)
+            item = self.__items.get(k)
+            if item is None or item[1] != tick:
+                continue
+            del self.__items[k]
+            self.used -= item[2]
+        self.__touch(key, count, size)
+        self.used += size
+        return True
+
+
+class ARCCache(object):
+    def __init__(self, capacity):
+        """Adaptive replacement cache simulator, measuring the lists in bytes.
+        The recently and frequently used lists are balanced using the ghost
+        lists of evicted keys
+
+        Position arguments:
+        capacity -- Capacity, in bytes
+        """
+        self.capacity = capacity
+        # Target size of the recently used list
+        self.target = 0.0
+        # Recent (t1) and frequent (t2) lists, and their ghosts (b1, b2)
+        self.__lists = dict((name, OrderedDict())
+                            for name in ('t1', 't2', 'b1', 'b2'))
+        self.__bytes = dict((name, 0) for name in self.__lists)
+
+    @property
+    def used(self):
+        return self.__bytes['t1'] + self.__bytes['t2']
+
+    def __pop(self, name, key=None):
+        """ Remove a key (the least recently used one if None) from a list
+        """
+        if key is None:
+            key, size = self.__lists[name].popitem(last=False)
+        else:
+            size = self.__lists[name].pop(key)
+        self.__bytes[name] -= size
+        return key, size
+
+    def __push(self, name, key, size):
+        self.__lists[name][key] = size
+        self.__bytes[name] += size
+
+    def __replace(self, size, in_b2=False):
+        """ Evict files to the ghost lists, until there is room for a new one
+        """
+        while self.used + size > self.capacity and self.used > 0:
+            t1 = self.__bytes['t1']
+            if self.__lists['t1'] and \
+                    (t1 > self.target or (in_b2 and t1 >= self.target) or
+                     not self.__lists['t2']):
+                self.__push('b1', *self.__pop('t1'))
+            else:
+                self.__push('b2', *self.__pop('t2'))
+
+    def __trim_ghosts(self):
+        while self.__lists['b1'] and \
+                self.__bytes['t1'] + self.__bytes['b1'] > self.capacity:
+            self.__pop('b1')
+        while self.__lists['b2'] and \
+                sum(self.__bytes.values()) > 2 * self.capacity:
+            self.__pop('b2')
+
+    def access(self, key, size):
+        """ Request a file, inserting it if it is not cached. See
+        LRUCache.access()
+        """
+        lists, nbytes = self.__lists, self.__bytes
+        for name in ('t1', 't2'):
+            if key in lists[name]:
+                self.__push('t2', *self.__pop(name, key))
+                return True
+        if key in lists['b1']:
+            delta = max(1.0, nbytes['b2'] / float(nbytes['b1'])) * size
+            self.target = min(self.capacity, self.target + delta)
+            self.__pop('b1', key)
+            self.__replace(size)
+            self.__push('t2', key, size)
+        elif key in lists['b2']:
+            delta = max(1.0, nbytes['b1'] / float(nbytes['b2'])) * size
+            self.target = max(0.0, self.target - delta)
+            self.__pop('b2', key)
+            self.__replace(size, in_b2=True)
+            self.__push('t2', key, size)
+        else:
+            self.__replace(size)
+            self.__push('t1', key, size)
+        self.__trim_ghosts()
+        return False
+
+    def insert(self, key, size):
+        """ Insert a file, unless it is already cached. See LRUCache.insert()
+        """
+        lists = self.__lists
+        if key in lists['t1'] or key in lists['t2']:
+            return False
+        for name in ('b1', 'b2'):
+            if key in lists[name]:
+                self.__pop(name, key)
+        self.__replace(size)
+        self.__push('t1', key, size)
+        self.__trim_ghosts()
+        return True
+
+
+CACHES = {'lru': LRUCache, 'lfu': LFUCache, 'arc': ARCCache}
+
+
+def simulate(records, policy, capacity, horizon=0, sizes=None):
+    """ Replay a trace against a cache simulator, starting empty
+
+    Position arguments:
+    records -- List of trace records, see read()
+    policy -- Cache policy, one of POLICIES
+    capacity -- Cache capacity, in bytes
+
+    Keyword arguments:
+    horizon -- Prefetch horizon, i.e. number of rings of tiles around each
+               requested one fetched as well, on the same layer and zoom
+    sizes -- Dictionary of file sizes, with (layer, tile) keys, used for the
+             prefetched tiles and the records without size. None to compute
+             it from the records
+
+    Returned value:
+    Dictionary with the number of requests, the hit ratio, the bytes fetched
+    (demanded and prefetched), and the fraction of prefetched files used
+    """
+    if policy not in POLICIES:
+        raise ValueError('Unknown policy {}'.format(policy))
+    if sizes is None:
+        sizes = tile_sizes(records)
+    means = _mean_sizes(sizes)
+    cache = CACHES[policy](capacity)
+    requests = hits = fetched = prefetched = 0
+    # Prefetched files not requested yet
+    pending = set()
+    n_prefetched = used = 0
+    for _, layer, tile, _, _, size in records:
+        key = (layer, tile)
+        size = size or sizes.get(key) or means.get(layer, 0)
+        requests += 1
+        if cache.access(key, size):
+            hits += 1
+            if key in pending:
+                used += 1
+                pending.discard(key)
+        else:
+            fetched += size
+            pending.discard(key)
+        x, y, zoom = tile
+        n = 1 << zoom
+        for i in range(x - horizon, x + horizon + 1):
+            for j in range(max(0, y - horizon), min(n, y + horizon + 1)):
+                other = (layer, (i % n, j, zoom))
+                other_size = sizes.get(other) or means.get(layer, 0)
+                if other != key and cache.insert(other, other_size):
+                    prefetched += other_size
+                    n_prefetched += 1
+                    pending.add(other)
+    return {'requests': requests,
+            'hit_ratio': hits / float(max(requests, 1)),
+            'fetched_bytes': fetched,
+            'prefetched_bytes': prefetched,
+            'prefetch_usage': used / float(max(n_prefetched, 1))}
+
+
+def tile_sizes(records):
+    """ Get the size of each tile in a trace
+
+    Position arguments:
+    records -- List of trace records, see read()
+
+    Returned value:
+    Dictionary of sizes, in bytes, with (layer, tile) keys
+    """
+    return dict(((layer, tile), size)
+                for _, layer, tile, _, _, size in records if size)
+
+
+def _mean_sizes(sizes):
+    """ Average tile size of each layer
+    """
+    totals = {}
+    for (layer, _), size in sizes.items():
+        total = totals.setdefault(layer, [0, 0])
+        total[0] += size
+        total[1] += 1
+    return dict((layer, t[0] // t[1]) for layer, t in totals.items())
+
+
+def summary(records):
+    """ Summarize a trace
+
+    Position arguments:
+    records -- List of trace records, see read()
+
+    Returned value:
+    Dictionary with the number of requests and unique tiles, the recorded
+    hit ratio, the mean and maximum latencies of the hits and misses, and
+    the bytes of all the unique tiles (i.e. the cache size which never
+    evicts)
+    """
+    sizes = tile_sizes(records)
+    means = _mean_sizes(sizes)
+    unique = set((layer, tile) for _, layer, tile, _, _, _ in records)
+    latencies = {True: [], False: []}
+    for _, _, _, hit, latency, _ in records:
+        latencies[hit].append(latency)
+    s = {'requests': len(records),
+         'tiles': len(unique),
+         'hit_ratio': len(latencies[True]) / float(max(len(records), 1)),
+         'bytes': sum(sizes.get(k) or means.get(k[0], 0) for k in unique)}
+    for hit, name in ((True, 'hit'), (False, 'miss')):
+        values = latencies[hit]
+        s[name + '_latency'] = sum(values) / len(values) if values else None
+        s[name + '_latency_max'] = max(values) if values else None
+    return s
+
+
+if __name__ == "__main__":
+    # Call this script with the following commands:
+    # python -m mapzen.trace summary trace
+    # python -m mapzen.trace simulate trace [capacities [policies [horizons]]]
+    # where:
+    # trace is a trace file recorded by Mapzen (see its trace argument)
+    # capacities is a comma separated list of cache sizes, in MB
+    # policies is a comma separated list of policies, lru, lfu or arc
+    # horizons is a comma separated list of prefetch rings around each tile
+    #
+    # For instance:
+    # python -m mapzen.trace simulate flight.trace 50,100,200 lru,arc 0,1
+    if len(sys.argv) < 3 or sys.argv[1] not in ('summary', 'simulate'):
+        raise ValueError('Unknown command')
+    records = list(read(sys.argv[2]))
+    s = summary(records)
+    print("{} requests, {} tiles ({:.1f} MB), recorded hit ratio "
+          "{:.3f}".format(s['requests'], s['tiles'], s['bytes'] / 1048576.0,
+                          s['hit_ratio']))
+    for name in ('hit', 'miss'):
+        if s[name + '_latency'] is not None:
+            print("{} latency: {:.1f} ms mean, {:.1f} ms max".format(
+                name, 1000.0 * s[name + '_latency'],
+                1000.0 * s[name + '_latency_max']))
+    if sys.argv[1] == 'summary':
+        sys.exit()
+    capacities = [50.0, 100.0, 200.0, 500.0]
+    policies = POLICIES
+    horizons = [0, 1]
+    if len(sys.argv) > 3:
+        capacities = [float(v) for v in sys.argv[3].split(',')]
+    if len(sys.argv) > 4:
+        policies = sys.argv[4].split(',')
+    if len(sys.argv) > 5:
+        horizons = [int(v) for v in sys.argv[5].split(',')]
+    sizes = tile_sizes(records)
+    print("{:>6} {:>10} {:>8} {:>9} {:>12} {:>15} {:>9}".format(
+        'policy', 'capacity', 'horizon', 'hit ratio', 'fetched MB',
+        'prefetched MB', 'used'))
+    for policy in policies:
+        for capacity in capacities:
+            for horizon in horizons:
+                r = simulate(records, policy, capacity * 1048576.0, horizon,
+                             sizes)
+                print("{:>6} {:>7.0f} MB {:>8} {:>9.3f} {:>12.1f} {:>15.1f} "
+                      "{:>9.2f}".format(
+                          policy, capacity, horizon, r['hit_ratio'],
+                          r['fetched_bytes'] / 1048576.0,
+                          r['prefetched_bytes'] / 1048576.0,
+                          r['prefetch_usage']))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Memory allocation benchmark of the tiles generation. Call this script with
+# the following command:
+# python memory_benchmark.py [-z zoom] [-n crossings] [--software] [lat lon]
+#
+# The camera is moved along a row of tiles, generating the terrain on each
+# tile crossing, and the generation time, the peak resident memory and (if
+# tracemalloc is available) the peak of memory allocated while generating are
+# reported. The tiles should be already cached, otherwise the download time is
+# measured as well.
+
+import gc
+import time
+import resource
+import argparse
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def max_rss():
+    """ Peak resident memory of the process, in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux is reporting it in KB
+    return rss / 1024.0
+
+
+def crossings(lat, lon, zoom, n, software=False):
+    """ Generate the terrain along a row of tiles
+
+    Position arguments:
+    lat -- Latitude of the first tile
+    lon -- Longitude of the first tile
+    zoom -- Zoom level
+    n -- Number of tile crossings
+
+    Keyword arguments:
+    software -- Use the Mesa software renderer
+
+    Returned value:
+    List of (generation time, peak RSS, peak allocated memory) per crossing,
+    the latter None if tracemalloc is not available
+    """
+    from snapshot import TerrainSnapshots
+    from mapzen import Mapzen
+    app = TerrainSnapshots(software=software)
+    mx, my = app.mercator.LatLonToMeters(lat, lon)
+    tx, ty = app.mercator.MetersToTile(mx, my, zoom)
+    mzen = Mapzen(app.camera, app.loader, app.render, app.taskMgr, tx, ty,
+                  zoom=zoom, threaded=False)
+    results = []
+    gc.collect()
+    for i in range(1, n + 1):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        t0 = time.time()
+        mzen.goto(tx + i, ty)
+        app.graphicsEngine.render_frame()
+        elapsed = time.time() - t0
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1] / 1048576.0
+            tracemalloc.stop()
+        results.append((elapsed, max_rss(), peak))
+    mzen.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Memory benchmark')
+    parser.add_argument('lat', type=float, nargs='?', default=43.0)
+    parser.add_argument('lon', type=float, nargs='?', default=-0.25)
+    parser.add_argument('-z', '--zoom', type=int, default=12,
+                        help='Zoom level, in range [1, 15]')
+    parser.add_argument('-n', '--crossings', type=int, default=10,
+                        help='Number of tile crossings')
+    parser.add_argument('--software', action='store_true',
+                        help='Use the Mesa software renderer (no GPU required)')
+    args = parser.parse_args()
+
+    results = crossings(args.lat, args.lon, args.zoom, args.crossings,
+                        args.software)
+    for i, (elapsed, rss, peak) in enumerate(results):
+        line = "crossing {}: {:.3f} s, peak RSS {:.1f} MB".format(
+            i + 1, elapsed, rss)
+        if peak is not None:
+            line += ", {:.1f} MB allocated at peak".format(peak)
+        print(line)
+    times = [r[0] for r in results]
+    print("mean generation time: {:.3f} s".format(sum(times) / len(times)))
+    print("peak RSS growth after the first crossing: {:.1f} MB".format(
+        results[-1][1] - results[0][1]))
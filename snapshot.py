@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless terrain snapshots. Call this script with the following command:
+# python snapshot.py viewpoints.txt [-o output] [-z zoom] [-s 800x600]
+#                                   [--software]
+# where each line of viewpoints.txt has the following fields:
+# lat lon altitude heading pitch roll
+#
+# The viewpoints sharing the same tile are rendered consecutively, such that
+# the terrain is generated just once for all of them.
+
+import os
+import time
+import argparse
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import load_prc_file_data, Filename
+from mapzen import Mapzen
+from mapzen.globalmaptiles import GlobalMercator
+
+
+class TerrainSnapshots(ShowBase):
+    def __init__(self, size=(800, 600), software=False):
+        # Load some configuration variables, its important for this to happen
+        # before the ShowBase is initialized
+        load_prc_file_data("", """
+            window-type offscreen
+            win-size {} {}
+            gl-debug #f
+            sync-video #f
+            audio-library-name null
+            textures-power-2 none
+            gl-coordinate-system default
+        """.format(size[0], size[1]))
+        if software:
+            # The terrain requires GLSL shaders, not supported by
+            # p3tinydisplay, so the Mesa software rasterizer is used instead
+            os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+
+        # Initialize the showbase
+        ShowBase.__init__(self)
+        self.camLens.set_fov(90)
+        self.camLens.set_near_far(0.1, 10000)
+        self.setBackgroundColor(0.7, 0.7, 0.8)
+        self.mercator = GlobalMercator()
+        self.mzen = None
+
+    def render_viewpoints(self, viewpoints, output, zoom=12):
+        """ Render a set of viewpoints
+
+        Position arguments:
+        viewpoints -- List of (lat, lon, altitude, heading, pitch, roll)
+        output -- Folder where the images are saved, named by the viewpoint
+                  index
+
+        Keyword arguments:
+        zoom -- Zoom level
+
+        Returned value:
+        Number of rendered frames, number of generated terrains and time
+        spent rendering (in seconds)
+        """
+        # Group the viewpoints by tile
+        views = []
+        for i, (lat, lon, alt, h, p, r) in enumerate(viewpoints):
+            mx, my = self.mercator.LatLonToMeters(lat, lon)
+            tile = self.mercator.MetersToTile(mx, my, zoom)
+            views.append((tile, i, mx, my, alt, (h, p, r)))
+        views.sort()
+
+        n_tiles = 0
+        t0 = time.time()
+        for tile, i, mx, my, alt, hpr in views:
+            if self.mzen is None:
+                self.mzen = Mapzen(self.camera, self.loader, self.render,
+                                   self.taskMgr, tile[0], tile[1], zoom=zoom,
+                                   threaded=False, placeholder=None)
+                n_tiles += 1
+            elif tuple(self.mzen.generator.tile) != tile:
+                self.mzen.goto(*tile)
+                n_tiles += 1
+            orig = self.mzen.generator.orig
+            self.camera.set_pos(mx - orig[0], orig[1] - my, alt - orig[2])
+            self.camera.set_hpr(*hpr)
+            self.graphicsEngine.render_frame()
+            self.win.save_screenshot(
+                Filename.from_os_specific(
+                    os.path.join(output, '{:05d}.png'.format(i))))
+        return len(views), n_tiles, time.time() - t0
+
+
+def read_viewpoints(fname):
+    """ Read the viewpoints file
+
+    Position arguments:
+    fname -- Path of the file, with a viewpoint per line, composed by the
+             fields lat lon altitude heading pitch roll. Lines starting by
+             '#' are ignored
+
+    Returned value:
+    List of viewpoints
+    """
+    viewpoints = []
+    with open(fname, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            viewpoints.append(tuple(float(v) for v in line.split()))
+    return viewpoints
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Headless terrain snapshots')
+    parser.add_argument('viewpoints',
+                        help='File with a "lat lon alt h p r" line per view')
+    parser.add_argument('-o', '--output', default='snapshots',
+                        help='Output folder')
+    parser.add_argument('-z', '--zoom', type=int, default=12,
+                        help='Zoom level, in range [1, 15]')
+    parser.add_argument('-s', '--size', default='800x600',
+                        help='Images size, WIDTHxHEIGHT')
+    parser.add_argument('--software', action='store_true',
+                        help='Use the Mesa software renderer (no GPU required)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    size = tuple(int(v) for v in args.size.split('x'))
+    app = TerrainSnapshots(size=size, software=args.software)
+    n_frames, n_tiles, elapsed = app.render_viewpoints(
+        read_viewpoints(args.viewpoints), args.output, zoom=args.zoom)
+    app.mzen.stop()
+    print("{} frames ({} terrains generated) in {:.2f} s: {:.2f} frames/sec"
+          .format(n_frames, n_tiles, elapsed, n_frames / max(elapsed, 1e-6)))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Startup benchmark. Call this script with the following command:
+# python startup_benchmark.py [-z zoom] [-r repeats] [--software] [lat lon]
+#
+# It measures the time spent importing the mapzen package, in a fresh
+# interpreter each time, and the time to the first rendered terrain (window
+# creation, tiles loading and generation, and the first frame). The tiles
+# should be already cached, otherwise the download time is measured as well.
+
+import sys
+import time
+import argparse
+import subprocess
+
+
+# Modules which should not be loaded just by importing mapzen
+HEAVY_MODULES = ('scipy', 'skimage', 'matplotlib')
+IMPORT_SCRIPT = """
+import sys, time
+t0 = time.time()
+import mapzen
+print(time.time() - t0)
+print(' '.join(m for m in {} if m in sys.modules))
+""".format(HEAVY_MODULES)
+
+
+def import_time():
+    """ Measure the mapzen package import time, in a new interpreter
+
+    Returned value:
+    Import time, in seconds, and list of heavy modules loaded
+    """
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT])
+    lines = out.decode().strip().split('\n')
+    return float(lines[0]), lines[1].split() if len(lines) > 1 else []
+
+
+def first_terrain_time(lat, lon, zoom, software=False):
+    """ Measure the time to the first rendered terrain
+
+    Position arguments:
+    lat -- Latitude of the camera
+    lon -- Longitude of the camera
+    zoom -- Zoom level
+
+    Keyword arguments:
+    software -- Use the Mesa software renderer
+
+    Returned value:
+    Window creation time, terrain generation time and first frame time, in
+    seconds
+    """
+    from snapshot import TerrainSnapshots
+    from mapzen import Mapzen
+    t0 = time.time()
+    app = TerrainSnapshots(software=software)
+    t1 = time.time()
+    mx, my = app.mercator.LatLonToMeters(lat, lon)
+    tx, ty = app.mercator.MetersToTile(mx, my, zoom)
+    mzen = Mapzen(app.camera, app.loader, app.render, app.taskMgr, tx, ty,
+                  zoom=zoom, threaded=False)
+    t2 = time.time()
+    app.camera.set_pos(0, 0, 1000)
+    app.camera.set_hpr(0, -30, 0)
+    app.graphicsEngine.render_frame()
+    t3 = time.time()
+    mzen.stop()
+    return t1 - t0, t2 - t1, t3 - t2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Startup benchmark')
+    parser.add_argument('lat', type=float, nargs='?', default=43.0)
+    parser.add_argument('lon', type=float, nargs='?', default=-0.25)
+    parser.add_argument('-z', '--zoom', type=int, default=12,
+                        help='Zoom level, in range [1, 15]')
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help='Number of import time measures')
+    parser.add_argument('--software', action='store_true',
+                        help='Use the Mesa software renderer (no GPU required)')
+    args = parser.parse_args()
+
+    times = []
+    for _ in range(args.repeats):
+        t, heavy = import_time()
+        times.append(t)
+    print("import mapzen: {:.3f} s (best of {}), {:.3f} s (mean)".format(
+        min(times), len(times), sum(times) / len(times)))
+    if heavy:
+        print("    heavy modules loaded: {}".format(', '.join(heavy)))
+    window, generation, frame = first_terrain_time(
+        args.lat, args.lon, args.zoom, args.software)
+    print("window: {:.3f} s".format(window))
+    print("terrain generation: {:.3f} s".format(generation))
+    print("first frame: {:.3f} s".format(frame))
+    print("time to first terrain: {:.3f} s".format(
+        window + generation + frame))
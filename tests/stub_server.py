@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Local HTTP server standing in for the tiles servers in the tests
+
+import time
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+LAST_MODIFIED = 'Mon, 01 Feb 2016 00:00:00 GMT'
+
+
+class StubServer(object):
+    def __init__(self, files=None, delay=0.0):
+        """Threaded HTTP server serving files from memory, with ETag and
+        Last-Modified validators, answering 304 (Not Modified) to the
+        matching conditional requests. The requests are counted.
+
+        Keyword arguments:
+        files -- Dictionary of served files, path -> content
+        delay -- Time, in seconds, spent on each request
+        """
+        self.files = dict(files or {})
+        self.delay = delay
+        self.requests = {}
+        self.not_modified = 0
+        self.active = 0
+        self.max_active = 0
+        self.__lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def etag(self, path):
+        return '"{}"'.format(hashlib.md5(self.files[path]).hexdigest())
+
+    def _handle(self, handler):
+        path = handler.path
+        self.__lock.acquire()
+        self.requests[path] = self.requests.get(path, 0) + 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.__lock.release()
+        try:
+            time.sleep(self.delay)
+            if path not in self.files:
+                handler.send_error(404)
+                return
+            etag = self.etag(path)
+            if handler.headers.getheader('If-None-Match') == etag:
+                self.__lock.acquire()
+                self.not_modified += 1
+                self.__lock.release()
+                handler.send_response(304)
+                handler.send_header('ETag', etag)
+                handler.end_headers()
+                return
+            data = self.files[path]
+            handler.send_response(200)
+            handler.send_header('Content-Length', str(len(data)))
+            handler.send_header('ETag', etag)
+            handler.send_header('Last-Modified', LAST_MODIFIED)
+            handler.end_headers()
+            handler.wfile.write(data)
+        finally:
+            self.__lock.acquire()
+            self.active -= 1
+            self.__lock.release()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run the tests with the following command:
+# python -m unittest discover tests
+
+import sys
+import traceback
+import unittest
+from mapzen.fetch import Fetcher
+from stub_server import StubServer
+
+
+def _failing_process(data, info):
+    raise ValueError('Bad tile')
+
+
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(
+            dict(('/{}.png'.format(i), b'tile {}'.format(i))
+                 for i in range(12)), delay=0.1)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_coalescing(self):
+        fetcher = Fetcher(max_connections=4)
+        url = self.server.url + '/0.png'
+        futures = [fetcher.submit(('terrarium', 1, 0, 0), url)
+                   for _ in range(10)]
+        self.assertTrue(all(f is futures[0] for f in futures))
+        self.assertEqual(futures[0].result(), b'tile 0')
+        self.assertEqual(self.server.requests, {'/0.png': 1})
+        # Once finished, it is downloaded again
+        self.assertEqual(fetcher.get(('terrarium', 1, 0, 0), url), b'tile 0')
+        self.assertEqual(self.server.requests, {'/0.png': 2})
+
+    def test_concurrency_bound(self):
+        fetcher = Fetcher(max_connections=3)
+        futures = [fetcher.submit(('terrarium', 4, i, 0),
+                                  self.server.url + '/{}.png'.format(i))
+                   for i in range(12)]
+        results = [f.result() for f in futures]
+        self.assertEqual(results,
+                         [b'tile {}'.format(i) for i in range(12)])
+        self.assertEqual(self.server.max_active, 3)
+        self.assertEqual(fetcher.inflight(), 0)
+
+    def test_error_traceback(self):
+        fetcher = Fetcher(max_connections=1)
+        future = fetcher.submit(('terrarium', 1, 0, 0),
+                                self.server.url + '/0.png',
+                                _failing_process)
+        try:
+            future.result()
+        except ValueError:
+            frames = traceback.extract_tb(sys.exc_info()[2])
+        else:
+            self.fail('The process error is not raised')
+        self.assertIn('_failing_process', [frame[2] for frame in frames])
+        self.assertIsInstance(future.exception(), ValueError)
+
+    def test_failing_callback(self):
+        fetcher = Fetcher(max_connections=1)
+        called = []
+
+        def failing(future):
+            raise RuntimeError('Bad callback')
+        future = fetcher.submit(('terrarium', 1, 0, 0),
+                                self.server.url + '/0.png')
+        future.add_done_callback(failing)
+        future.add_done_callback(lambda f: called.append(f.result()))
+        self.assertEqual(future.result(), b'tile 0')
+        # The worker survives, and the other callbacks are called
+        url = self.server.url + '/1.png'
+        self.assertEqual(fetcher.submit(('terrarium', 1, 1, 0),
+                                        url).result(5.0), b'tile 1')
+        self.assertEqual(called, [b'tile 0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
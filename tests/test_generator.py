@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run the tests with the following command:
+# python -m unittest discover tests
+
+import unittest
+import numpy as np
+from panda3d.core import NodePath, TexturePool
+from mapzen import generator
+
+
+class Loader(object):
+    def loadTexture(self, fname):
+        return TexturePool.loadTexture(fname)
+
+
+class NormalMapTest(unittest.TestCase):
+    def setUp(self):
+        root = NodePath('root')
+        camera = root.attach_new_node('camera')
+        self.generator = generator.Generator(camera, Loader(), root, zoom=12,
+                                             normal_map=True)
+
+    def tearDown(self):
+        self.generator.stop()
+
+    def test_rings_change(self):
+        tile = (10, 20)
+        for rings in (1, 2, 1):
+            self.generator.rings = rings
+            n = (2 * rings + 1) * 256
+            elevation = np.random.rand(n, n) * 100.0
+            normals = self.generator.bake_normal_map(tile, elevation)
+            self.assertEqual(normals.shape, (n, n, 3))
+            # Cached, so computed just once for each rings
+            self.assertIs(self.generator.bake_normal_map(tile, elevation),
+                          normals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import StringIO
+import numpy as np
+from mapzen import cache, download, sources
+from stub_server import StubServer, LAST_MODIFIED
+
+
+TILE = (3, 5, 4)
+
+
+class RevalidateTest(unittest.TestCase):
+    def setUp(self):
+        png = StringIO.StringIO()
+        download.encode_elevation(np.full((256, 256), 100.0)).save(
+            png, format='PNG')
+        self.data = png.getvalue()
+        self.path = '/terrarium/4/3/5.png'
+        self.server = StubServer({self.path: self.data})
+        self.folder = tempfile.mkdtemp()
+        self.cache_path = download.CACHE_PATH
+        self.source = sources.get('terrarium')
+        self.ttl = download.TTL['terrarium']
+        download.CACHE_PATH = self.folder + '/'
+        download.TTL['terrarium'] = 60.0
+        sources.register('terrarium', sources.TileSource(
+            self.server.url + '/terrarium/{z}/{x}/{y}.png'))
+
+    def tearDown(self):
+        download.CACHE_PATH = self.cache_path
+        download.TTL['terrarium'] = self.ttl
+        sources.register('terrarium', self.source)
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def test_not_modified(self):
+        elevation = download.elevation(TILE)
+        self.assertTrue(np.allclose(elevation, 100.0))
+        cached = os.path.join(self.folder, 'terrarium/4/3/5.png')
+        meta = cache.read_meta(cached)
+        self.assertEqual(meta['etag'], self.server.etag(self.path))
+        self.assertEqual(meta['last_modified'], LAST_MODIFIED)
+        # Expire the tile
+        meta['fetched'] -= 3600.0
+        with open(cached + cache.META_EXT, 'w') as f:
+            json.dump(meta, f)
+        self.assertFalse(cache.is_fresh(cached, download.TTL['terrarium']))
+        futures = download.prefetch([TILE], layers=('terrarium',),
+                                    refresh=True)
+        self.assertEqual(len(futures), 1)
+        for future in futures.values():
+            future.result()
+        self.assertEqual(self.server.not_modified, 1)
+        self.assertEqual(self.server.requests[self.path], 2)
+        # The TTL is refreshed, and the cached tile kept
+        self.assertTrue(cache.is_fresh(cached, download.TTL['terrarium']))
+        self.assertEqual(cache.read_meta(cached)['etag'],
+                         self.server.etag(self.path))
+        with open(cached, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertTrue(cache.is_cached(cached))
+        self.assertTrue(np.allclose(download.elevation(TILE), 100.0))
+        self.assertEqual(self.server.requests[self.path], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Jose Luis Cercos-Pita
+#
+#    This file is part of Panda3D-mapzen.
+#
+#    Panda3D-mapzen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Panda3D-mapzen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Panda3D-mapzen.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run the tests with the following command:
+# python -m unittest discover tests
+
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+from mapzen import memory, sources
+from mapzen.server import TileServer, TileStore
+from stub_server import StubServer
+
+
+class TileServerTest(unittest.TestCase):
+    def setUp(self):
+        self.upstream = StubServer(
+            dict(('/4/{}/0.png'.format(i), b'tile {}'.format(i))
+                 for i in range(8)))
+        self.folder = tempfile.mkdtemp()
+        source = sources.TileSource(self.upstream.url + '/{z}/{x}/{y}.png')
+        self.store = TileStore(self.folder, {'terrarium': source})
+        self.server = TileServer(('127.0.0.1', 0), self.store)
+        self.url = 'http://127.0.0.1:{}'.format(
+            self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        memory.REGISTRY.unregister(self.store.memory_name)
+        self.upstream.stop()
+        shutil.rmtree(self.folder)
+
+    def get(self, path):
+        return urllib2.urlopen(self.url + path, timeout=10).read()
+
+    def test_upstream_not_found(self):
+        try:
+            self.get('/terrarium/4/9/0.png')
+        except urllib2.HTTPError as e:
+            self.assertEqual(e.code, 404)
+        else:
+            self.fail('The missing tile is served')
+
+    def test_hits(self):
+        paths = ['/terrarium/4/{}/0.png'.format(i % 8) for i in range(64)]
+        results = {}
+
+        def get(i):
+            results[i] = self.get(paths[i])
+        threads = [threading.Thread(target=get, args=(i,))
+                   for i in range(len(paths))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results,
+                         dict((i, b'tile {}'.format(i % 8))
+                              for i in range(64)))
+        self.assertEqual(sum(self.store.hits.values()), 64)
+
+
+if __name__ == '__main__':
+    unittest.main()